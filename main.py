@@ -1,17 +1,33 @@
+import argparse
+from array import array
+from collections import OrderedDict, deque
+from concurrent.futures import Future, ThreadPoolExecutor
+from contextlib import contextmanager, nullcontext
 from enum import Enum, auto
+import gc
+from typing import NamedTuple
+import hashlib
 import heapq
+import json
+import mmap
 import os
+import queue
 import random
+import shutil
 import sys
+import threading
 import time
+import tracemalloc
 import pygame as pg
 import math
 
 
-WIDTH = 1100  # ゲームウィンドウの幅
-HEIGHT = 640  # ゲームウィンドウの高さ
+WIDTH = 1100  # ゲーム画面の論理的な幅(座標・当たり判定はこの大きさで扱う)
+HEIGHT = 640  # ゲーム画面の論理的な高さ
+WINDOW_SIZE = (1280, 720)  # ウィンドウの初期サイズ(ブラウザ版のキャンバスと同じ)。描画はウィンドウに合わせて拡大縮小する
 GRID_SIZE = 20
 PLAYER_SPEED = 3
+SUBPIXEL = 256  # 1ピクセルあたりのサブピクセル数(位置と速度はこの単位の整数で扱う)
 PLAYER_SIZE = 20
 ENEMY_SIZE = 30
 
@@ -20,8 +36,171 @@ BLACK = (0, 0, 0)
 WHITE = (255, 255, 255)
 RED   = (255, 0, 0)
 
+# ゲームを進める1ティックの長さ(ミリ秒)と、1フレームで追いつくために進める最大ティック数
+TICK_MS = 20
+MAX_TICKS_PER_FRAME = 5
+# 画面のあるゲームで、前のティックに依頼した経路探索の結果を待つ最大時間(秒)。間に合わなければ次のティックに回す
+PLAN_WAIT_BUDGET = 0.002
+
+# 方向キーと移動方向
+DIRECTION_KEYS = {pg.K_LEFT: (-1, 0), pg.K_RIGHT: (1, 0), pg.K_UP: (0, -1), pg.K_DOWN: (0, 1)}
+
+# 静止画面で入力を待つときの最大待機時間(ミリ秒)。イベントが無くてもこの間隔でだけ起きる
+IDLE_WAIT_MS = 500
+
+# マップのセル種別
+CELL_PATH   = 0  # 通路(エサなし)
+CELL_WALL   = 1  # 壁
+CELL_DOT    = 2  # 通常エサ
+CELL_POWER  = 3  # パワーエサ
+CELL_ENEMY  = 4  # ゴーストの家の入り口(CELL_SPAWN が無いマップでは、先頭から ENEMY_COUNT 個が敵の初期位置)
+CELL_TUNNEL = 5  # ワープトンネル
+CELL_SPAWN  = 6  # 敵の初期位置(通路。あればこのセルの数だけ敵を出す)
+
+# CELL_SPAWN の無いマップの敵の数
+ENEMY_COUNT = 4
+
 os.chdir(os.path.dirname(os.path.abspath(__file__)))
 
+class GameClock:
+    """
+    ゲーム内の時刻(秒)を管理するクラス。
+    通常は実時間(単調増加する時計)に従い、環境API(PacmanEnv)ではティックごとに手動で進めることで
+    実時間と無関係に高速にゲームを進められる。一時停止中は時刻が止まる。
+    """
+    def __init__(self) -> None:
+        self.manual = False
+        self.time = 0.0
+        self.paused_at = None  # 一時停止した時のゲーム内時刻
+        self.offset = 0.0      # これまでに一時停止していた合計時間
+
+    def now(self) -> float:
+        """現在のゲーム内時刻を返す。"""
+        if self.paused_at is not None:
+            return self.paused_at
+        return self.time if self.manual else time.monotonic() - self.offset
+
+    def pause(self) -> None:
+        """時刻を止める。scheduler のタイマーも全て一緒に止まる。"""
+        if self.paused_at is None:
+            self.paused_at = self.now()
+
+    def resume(self) -> None:
+        """止めた時刻から再開する。"""
+        if self.paused_at is not None:
+            if not self.manual:
+                self.offset = time.monotonic() - self.paused_at
+            self.paused_at = None
+
+    def advance(self, seconds: float) -> None:
+        """手動モードで時刻を進める。"""
+        self.time += seconds
+
+
+game_clock = GameClock()
+
+
+class Timer:
+    """
+    Scheduler に登録した予定(1回だけ呼ばれる)。cancel で取り消せる。
+    """
+    __slots__ = ("callback", "active")
+
+    def __init__(self, callback) -> None:
+        self.callback = callback
+        self.active = True  # まだ呼ばれておらず、取り消されてもいない
+
+    def cancel(self) -> None:
+        """予定を取り消す。"""
+        self.active = False
+
+
+class Scheduler:
+    """
+    ゲーム内時刻(game_clock)で動くタイマーをまとめて管理するクラス。
+    予定時刻順の優先度付きキュー(ヒープ)で持ち、時刻が来たものだけをティックの最初に呼び出すため、
+    各キャラクターが毎フレーム時刻を調べる必要はない。game_clock を止めると全てのタイマーが一緒に止まる。
+    """
+    def __init__(self) -> None:
+        self.queue: list[tuple[float, int, Timer]] = []  # (予定時刻, 登録順, 予定)
+        self.sequence = 0
+
+    def schedule(self, delay: float, callback) -> Timer:
+        """
+        delay 秒後に callback を呼ぶ予定を登録する。
+        
+        引数:
+            delay (float): 現在からの秒数
+            callback (Callable[[], None]): 呼び出す関数
+        戻り値:
+            Timer: 登録した予定
+        """
+        return self.schedule_at(game_clock.now() + delay, callback)
+
+    def schedule_at(self, when: float, callback) -> Timer:
+        """
+        ゲーム内時刻 when に callback を呼ぶ予定を登録する。
+        
+        引数:
+            when (float): 予定時刻
+            callback (Callable[[], None]): 呼び出す関数
+        戻り値:
+            Timer: 登録した予定
+        """
+        timer = Timer(callback)
+        heapq.heappush(self.queue, (when, self.sequence, timer))
+        self.sequence += 1
+        return timer
+
+    def run_due(self, now: float) -> None:
+        """
+        予定時刻が now 以前の予定を時刻順に呼び出す。取り消された予定は捨てる。
+        
+        引数:
+            now (float): 現在のゲーム内時刻
+        """
+        queue = self.queue
+        while queue and queue[0][0] <= now:
+            _, _, timer = heapq.heappop(queue)
+            if timer.active:
+                timer.active = False
+                timer.callback()
+
+    def clear(self) -> None:
+        """全ての予定を取り消す(レベルの開始時など)。"""
+        for _, _, timer in self.queue:
+            timer.active = False
+        self.queue = []
+
+    def get_state(self, now: float) -> tuple:
+        """
+        スナップショット用に、残っている予定を now からの残り時間付きで返す。
+        
+        引数:
+            now (float): 現在のゲーム内時刻
+        戻り値:
+            tuple: ((残り秒数, 登録順, 予定), ...)
+        """
+        return tuple((when - now, sequence, timer) for when, sequence, timer in self.queue if timer.active)
+
+    def set_state(self, state: tuple, now: float) -> None:
+        """
+        get_state で得た予定に戻す。
+        
+        引数:
+            state (tuple): get_state の戻り値
+            now (float): 現在のゲーム内時刻
+        """
+        self.clear()
+        for remaining, sequence, timer in state:
+            timer.active = True
+            self.queue.append((now + remaining, sequence, timer))
+        heapq.heapify(self.queue)
+
+
+scheduler = Scheduler()
+
+
 def fade_in_image(image: pg.Surface, screen: pg.Surface, duration: float = 2.0) -> None:
     """
     渡されたSurfaceをフェードイン表示する簡易関数。
@@ -56,87 +235,135 @@ def run_difficulty_menu_with_title(screen: pg.Surface) -> int:
     """
     タイトル画面の描画と、EASY / NORMAL / HARD を横に並べたカーソル操作を行う。
     戻り値として 1=EASY, 2=NORMAL, 3=HARD を返す。
+    画面はカーソルが動いたときだけ描き直し、それ以外は入力を待って休止する。
     
     引数:
         screen (pg.Surface): メイン画面
     戻り値:
         int: 選択した難易度(1,2,3)
     """
-    clock = pg.time.Clock()
     font_title = pg.font.Font(None, 100)
     font_menu  = pg.font.Font(None, 60)
 
     menu_items = ["EASY", "NORMAL", "HARD"]
     current_index = 0  # 0=EASY, 1=NORMAL, 2=HARD
+    redraw = True
+    canvas = pg.Surface((WIDTH, HEIGHT))
 
     while True:
-        # ---------- イベント処理 ------------
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
-                pg.quit()
-                sys.exit()
-            elif event.type == pg.KEYDOWN:
-                if event.key == pg.K_LEFT:
-                    current_index = (current_index - 1) % len(menu_items)
-                elif event.key == pg.K_RIGHT:
-                    current_index = (current_index + 1) % len(menu_items)
-                elif event.key == pg.K_RETURN:
-                    return current_index + 1  # 1,2,3
-
-        # ---------- 画面描画 ------------
-        screen.fill((0,0,0))
-
-        # 1) タイトル文字を描画
-        title_text = font_title.render("PacmanGame", True, (255, 255, 0))
-        screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, 50))
-
-        # 2) パックマンのイラスト（背景の一部として毎フレーム描画）
-        pacman_center = (WIDTH // 2, HEIGHT // 2 - 50)
-        pacman_radius = 100
-        pacman_color = (255, 255, 0)
-        pacman_mouth_angle = 30
-
-        points = [pacman_center]
-        for angle in range(pacman_mouth_angle, 360 - pacman_mouth_angle + 1):
-            x = pacman_center[0] + pacman_radius * math.cos(math.radians(angle))
-            y = pacman_center[1] - pacman_radius * math.sin(math.radians(angle))
-            points.append((x, y))
-        pg.draw.polygon(screen, pacman_color, points)
-
-        # 目
-        eye_position = (pacman_center[0] + pacman_radius // 4, pacman_center[1] - pacman_radius // 2)
-        eye_radius = 10
-        pg.draw.circle(screen, (0, 0, 0), eye_position, eye_radius)
-
-        # 3) カーソル付き難易度メニュー(横並び)
-        offset = 50  # 項目の間隔
-        y_base = HEIGHT // 2 + 100
-
-        # テキストを赤/白で切り替え
-        easy_surf   = font_menu.render("EASY",   True, (  0,   0, 255) if current_index==0 else (255, 255, 255))
-        normal_surf = font_menu.render("NORMAL", True, (  0, 255,   0) if current_index==1 else (255, 255, 255))
-        hard_surf   = font_menu.render("HARD",   True, (255,   0,   0) if current_index==2 else (255, 255, 255))
-
-        total_width = easy_surf.get_width() + normal_surf.get_width() + hard_surf.get_width() + offset*2
-        start_x = WIDTH // 2 - total_width // 2
-
-        x = start_x
-        screen.blit(easy_surf,   (x, y_base))
-        x += easy_surf.get_width() + offset
-        screen.blit(normal_surf, (x, y_base))
-        x += normal_surf.get_width() + offset
-        screen.blit(hard_surf,   (x, y_base))
-
-        font_copyright = pg.font.Font(None, 30)
-        copyright_text = font_copyright.render("(c) 2025 Group15", True, (255, 255, 255))
-        screen.blit(
-            copyright_text,
-            (WIDTH - copyright_text.get_width() - 10, HEIGHT - copyright_text.get_height() - 10)
-        )
+        # ---------- 画面描画(変化があったときのみ) ------------
+        if redraw:
+            draw_difficulty_menu(canvas, font_title, font_menu, current_index)
+            screen.fill(BLACK)
+            view.present(screen, canvas)
+            pg.display.update()
+            redraw = False
+
+        # ---------- イベント処理(入力があるまで待機) ------------
+        event = pg.event.wait(IDLE_WAIT_MS)
+        if event.type == pg.QUIT:
+            pg.quit()
+            sys.exit()
+        elif event.type == pg.VIDEORESIZE:
+            screen = pg.display.get_surface()
+            view.resize(screen.get_size())
+            redraw = True
+        elif event.type == pg.KEYDOWN:
+            if event.key == pg.K_LEFT:
+                current_index = (current_index - 1) % len(menu_items)
+                redraw = True
+            elif event.key == pg.K_RIGHT:
+                current_index = (current_index + 1) % len(menu_items)
+                redraw = True
+            elif event.key == pg.K_RETURN:
+                return current_index + 1  # 1,2,3
+
+
+def draw_difficulty_menu(screen: pg.Surface, font_title: pg.font.Font, font_menu: pg.font.Font,
+                         current_index: int) -> None:
+    """
+    タイトルと難易度メニューを描画する。
+    
+    引数:
+        screen (pg.Surface): メイン画面
+        font_title (pg.font.Font): タイトル用フォント
+        font_menu (pg.font.Font): メニュー用フォント
+        current_index (int): 選択中の項目(0=EASY, 1=NORMAL, 2=HARD)
+    """
+    screen.fill((0,0,0))
 
-        # 4) 画面更新
-        pg.display.update()
-        clock.tick(60)
+    # 1) タイトル文字を描画
+    title_text = font_title.render("PacmanGame", True, (255, 255, 0))
+    screen.blit(title_text, (WIDTH // 2 - title_text.get_width() // 2, 50))
+
+    # 2) パックマンのイラスト
+    pacman_center = (WIDTH // 2, HEIGHT // 2 - 50)
+    pacman_radius = 100
+    pacman_color = (255, 255, 0)
+    pacman_mouth_angle = 30
+
+    points = [pacman_center]
+    for angle in range(pacman_mouth_angle, 360 - pacman_mouth_angle + 1):
+        x = pacman_center[0] + pacman_radius * math.cos(math.radians(angle))
+        y = pacman_center[1] - pacman_radius * math.sin(math.radians(angle))
+        points.append((x, y))
+    pg.draw.polygon(screen, pacman_color, points)
+
+    # 目
+    eye_position = (pacman_center[0] + pacman_radius // 4, pacman_center[1] - pacman_radius // 2)
+    eye_radius = 10
+    pg.draw.circle(screen, (0, 0, 0), eye_position, eye_radius)
+
+    # 3) カーソル付き難易度メニュー(横並び)
+    offset = 50  # 項目の間隔
+    y_base = HEIGHT // 2 + 100
+
+    # テキストを赤/白で切り替え
+    easy_surf   = font_menu.render("EASY",   True, (  0,   0, 255) if current_index==0 else (255, 255, 255))
+    normal_surf = font_menu.render("NORMAL", True, (  0, 255,   0) if current_index==1 else (255, 255, 255))
+    hard_surf   = font_menu.render("HARD",   True, (255,   0,   0) if current_index==2 else (255, 255, 255))
+
+    total_width = easy_surf.get_width() + normal_surf.get_width() + hard_surf.get_width() + offset*2
+    start_x = WIDTH // 2 - total_width // 2
+
+    x = start_x
+    screen.blit(easy_surf,   (x, y_base))
+    x += easy_surf.get_width() + offset
+    screen.blit(normal_surf, (x, y_base))
+    x += normal_surf.get_width() + offset
+    screen.blit(hard_surf,   (x, y_base))
+
+    font_copyright = pg.font.Font(None, 30)
+    copyright_text = font_copyright.render("(c) 2025 Group15", True, (255, 255, 255))
+    screen.blit(
+        copyright_text,
+        (WIDTH - copyright_text.get_width() - 10, HEIGHT - copyright_text.get_height() - 10)
+    )
+
+
+def wait_for_key(*keys: int) -> int:
+    """
+    静止画面用に、指定したキーが押されるまで画面を描き直さずに待機する。
+    ウィンドウが閉じられたら終了する。
+    
+    引数:
+        *keys (int): 待つキー
+    戻り値:
+        int: 押されたキー
+    """
+    while True:
+        event = pg.event.wait(IDLE_WAIT_MS)
+        if event.type == pg.QUIT:
+            pg.quit()
+            sys.exit()
+        if event.type == pg.VIDEORESIZE:
+            # 表示中の画面を新しい大きさで描き直す
+            screen = pg.display.get_surface()
+            view.resize(screen.get_size())
+            view.redraw(screen)
+            pg.display.update()
+        if event.type == pg.KEYDOWN and event.key in keys:
+            return event.key
 
 
 def get_grid_pos(pixel_x: int, pixel_y: int) -> tuple[int, int]:
@@ -167,6 +394,347 @@ def get_pixel_pos(grid_x: int, grid_y: int) -> tuple[int, int]:
     return pixel_x, pixel_y
 
 
+# 難易度ごとのマップファイル
+MAP_FILES = {1: "map2.txt", 2: "map3.txt", 3: "map1.txt"}
+
+# マップの派生データ(交差点・隣接・連結成分など)のキャッシュ。マップファイルの隣に「マップファイル名.mapcache」で置く
+MAP_CACHE_SUFFIX = ".mapcache"
+MAP_CACHE_MAGIC = b"PACMAP01"
+MAP_CACHE_VERSION = 3  # 派生データの作り方を変えたら上げる(古いキャッシュは作り直される)
+
+# タイトル画面の表示中に読み込んでおく画像(パス, サイズ)
+PRELOAD_IMAGES = (
+    [
+        ("fig/pacman_open.png", (PLAYER_SIZE, PLAYER_SIZE)),
+        ("fig/pacman_circle.png", (PLAYER_SIZE, PLAYER_SIZE)),
+        ("fig/pacman_circle.png", (int(PLAYER_SIZE * 0.8), int(PLAYER_SIZE * 0.8))),
+        ("fig/pac-man1.png", (50, 50)),
+    ]
+    + [(f"fig/pacman_death/pacman_open_{i:02d}.png", (PLAYER_SIZE, PLAYER_SIZE)) for i in range(20)]
+    + [
+        (f"fig/{name}.png", (ENEMY_SIZE, ENEMY_SIZE))
+        for name in ["0", "4", "5", "7", "chicken", "food_christmas_chicken", "chicken_honetsuki", "pet_hone"]
+    ]
+)
+
+# 画像をまとめたアトラス(--build-atlas で作成)。存在すれば個別の画像ファイルの代わりに使う
+# (ブラウザ版は --build-web で、アトラスだけを入れたフォルダを作ってから pygbag でまとめる)
+ATLAS_IMAGE = "fig/atlas.png"
+ATLAS_INDEX = "fig/atlas.json"
+
+_image_cache: dict[tuple[str, tuple[int, int]], pg.Surface] = {}
+_image_sources: dict[pg.Surface, tuple[str, tuple[int, int], int, bool]] = {}  # 画像 -> (元画像のパス, サイズ, 回転角度, 左右反転)
+_transform_cache: dict[tuple[pg.Surface, int, bool], pg.Surface] = {}
+_atlas: tuple[pg.Surface, dict[str, list[int]]] | None = None
+_atlas_lock = threading.Lock()
+_map_cache: dict[str, 'Map'] = {}  # マップファイル -> 最後に読み込んだ Map(内容が変わったら読み直す)
+_preload_futures: dict[tuple, Future] = {}
+
+
+def preload_assets(map_files: list[str]) -> None:
+    """
+    画像のデコードとマップの読み込みをバックグラウンドのスレッドで始める。
+    タイトル画面の表示中に呼び、ゲーム開始時の読み込み待ちをなくす。
+    スレッドが使えない環境(ブラウザ版など)では何もせず、使用時に同期で読み込む。
+    
+    引数:
+        map_files (list[str]): 先に読み込んでおくマップファイル
+    """
+    try:
+        executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="preload")
+        for path, size in PRELOAD_IMAGES:
+            if (path, size) not in _image_cache:
+                _preload_futures[("image", path, size)] = executor.submit(
+                    lambda path=path, size=size: pg.transform.scale(load_source_image(path), size)
+                )
+        for map_file in map_files:
+            if map_file not in _map_cache:
+                _preload_futures[("map", map_file)] = executor.submit(Map, map_file)
+        executor.shutdown(wait=False)
+    except RuntimeError:
+        pass
+
+
+def take_preloaded(key: tuple):
+    """
+    バックグラウンドで読み込んだ結果を取り出す(読み込み中なら完了を待つ)。
+    
+    引数:
+        key (tuple): ("image", パス, サイズ) または ("map", マップファイル)
+    戻り値:
+        読み込んだ結果。先読みしていない、または失敗した場合は None
+    """
+    future = _preload_futures.pop(key, None)
+    if future is None or future.exception() is not None:
+        return None
+    return future.result()
+
+
+def load_image(path: str, size: tuple[int, int]) -> pg.Surface:
+    """
+    画像を読み込み、指定サイズに拡大縮小して返す。convert_alpha を使うので、メインスレッドから呼ぶ。
+    同じ画像・サイズは一度だけ読み込み、以降は共有のSurfaceを返す(書き換えないこと)。
+    
+    引数:
+        path (str): 画像ファイルのパス
+        size (tuple[int, int]): 拡大縮小後のサイズ
+    戻り値:
+        pg.Surface: 画像
+    """
+    key = (path, size)
+    if key not in _image_cache:
+        image = take_preloaded(("image", path, size))
+        if image is None:
+            image = pg.transform.scale(load_source_image(path), size)
+        _image_cache[key] = image.convert_alpha()
+        _image_sources[_image_cache[key]] = (path, size, 0, False)
+    return _image_cache[key]
+
+
+def transform_image(image: pg.Surface, angle: int = 0, flip: bool = False) -> pg.Surface:
+    """
+    画像を左右反転・回転して返す。同じ画像・変換は一度だけ作り、以降は共有のSurfaceを返す(書き換えないこと)。
+    
+    引数:
+        image (pg.Surface): load_image で読み込んだ画像
+        angle (int): 回転角度(度、反時計回り)
+        flip (bool): True なら左右反転してから回転する
+    戻り値:
+        pg.Surface: 変換した画像
+    """
+    angle %= 360
+    if angle == 0 and not flip:
+        return image
+    key = (image, angle, flip)
+    if key not in _transform_cache:
+        transformed = pg.transform.rotate(pg.transform.flip(image, flip, False), angle)
+        source = _image_sources.get(image)
+        if source is not None:
+            _image_sources[transformed] = (source[0], source[1], angle, flip)
+        _transform_cache[key] = transformed
+    return _transform_cache[key]
+
+
+def load_source_image(path: str) -> pg.Surface:
+    """
+    元画像を返す。アトラスにあればアトラスから切り出し(デコードは初回の1回のみ)、
+    無ければ画像ファイルを読み込む。
+    
+    引数:
+        path (str): 画像ファイルのパス
+    戻り値:
+        pg.Surface: 元画像(convert前)
+    """
+    global _atlas
+    with _atlas_lock:
+        if _atlas is None:
+            if os.path.exists(ATLAS_IMAGE) and os.path.exists(ATLAS_INDEX):
+                with open(ATLAS_INDEX, 'r') as f:
+                    _atlas = (pg.image.load(ATLAS_IMAGE), json.load(f))
+            else:
+                _atlas = (None, {})
+    atlas, index = _atlas
+    if path in index:
+        return atlas.subsurface(pg.Rect(index[path]))
+    return pg.image.load(path)
+
+
+def build_atlas(image_files: list[str], atlas_file: str = ATLAS_IMAGE, index_file: str = ATLAS_INDEX,
+                max_width: int = 1024) -> None:
+    """
+    複数の画像を1枚のアトラス画像に詰め、各画像の位置を書いたインデックス(JSON)と共に保存する。
+    アトラスがあれば実行時の読み込みとデコードは1回になる。
+    
+    引数:
+        image_files (list[str]): アトラスに入れる画像ファイル
+        atlas_file (str): アトラス画像の保存先
+        index_file (str): インデックスの保存先(画像パス -> [x, y, 幅, 高さ])
+        max_width (int): アトラスの最大幅(ピクセル)
+    """
+    images = []
+    for path in sorted(set(image_files)):
+        image = pg.image.load(path)
+        # アルファ無しの画像も含め、RGBAとしてそのままコピーできる形にそろえる
+        images.append((path, pg.image.frombytes(pg.image.tobytes(image, "RGBA"), image.get_size(), "RGBA")))
+
+    # 高さの大きい順に、左から棚状に詰めていく
+    images.sort(key=lambda item: item[1].get_height(), reverse=True)
+    index = {}
+    x = y = shelf_height = atlas_width = 0
+    for path, image in images:
+        w, h = image.get_size()
+        if x > 0 and x + w > max_width:
+            x, y, shelf_height = 0, y + shelf_height, 0
+        index[path] = [x, y, w, h]
+        x += w
+        shelf_height = max(shelf_height, h)
+        atlas_width = max(atlas_width, x)
+
+    atlas = pg.Surface((atlas_width, y + shelf_height), pg.SRCALPHA)
+    atlas.fill((0, 0, 0, 0))
+    for path, image in images:
+        atlas.blit(image, index[path][:2], special_flags=pg.BLEND_RGBA_ADD)
+    pg.image.save(atlas, atlas_file)
+    with open(index_file, 'w') as f:
+        json.dump(index, f)
+
+
+def build_web(out_dir: str, map_files: list[str]) -> None:
+    """
+    ブラウザ版(pygbag)でまとめるフォルダを作る。
+    スクリプトとマップに加えて画像はアトラスだけを入れ、個別の画像ファイルは入れない
+    (ブラウザは画像を1枚だけ取得・デコードすればよい)。作ったフォルダを pygbag に渡す。
+    
+    引数:
+        out_dir (str): 作るフォルダ(既にあれば FileExistsError。古い画像が残らないように、毎回新しく作る)
+        map_files (list[str]): 同梱するマップファイル
+    """
+    os.makedirs(out_dir)
+    os.makedirs(os.path.join(out_dir, os.path.dirname(ATLAS_IMAGE)))
+    shutil.copy(os.path.abspath(__file__), os.path.join(out_dir, "main.py"))
+    for map_file in map_files:
+        shutil.copy(map_file, os.path.join(out_dir, map_file))
+    build_atlas([path for path, _ in PRELOAD_IMAGES],
+                os.path.join(out_dir, ATLAS_IMAGE), os.path.join(out_dir, ATLAS_INDEX))
+
+
+def load_map(map_file: str) -> 'Map':
+    """
+    マップを読み込んで返す。同じ内容のファイルは一度だけ読み込む(Mapはゲーム中に書き換えない)。
+    ファイルを読んで内容のハッシュを比べるので、同じ名前で作り直したマップは読み直す
+    (前の Map は使っているレベルがあればそのまま使え、参照が無くなればメモリマップも解放される)。
+    
+    引数:
+        map_file (str): マップファイルのパス
+    戻り値:
+        Map: マップ
+    """
+    with open(map_file, 'rb') as f:
+        key = map_cache_key(f.read())
+    cached = _map_cache.get(map_file)
+    if cached is None or cached.key != key:
+        map_data = take_preloaded(("map", map_file))
+        _map_cache[map_file] = map_data if map_data is not None and map_data.key == key else Map(map_file)
+    return _map_cache[map_file]
+
+
+class View:
+    """
+    論理解像度(WIDTH×HEIGHT)で扱うゲーム画面を、ウィンドウの大きさに合わせて拡大縮小して描くためのクラス。
+    縦横比を保って最大の倍率で中央に置き、余白は黒のままにする。
+    画像とフォントは倍率ごとに一度だけ作ってキャッシュし、ウィンドウの大きさが変わったときだけ作り直す。
+    """
+    def __init__(self) -> None:
+        self.canvas = None  # present で最後に表示した静止画面
+        self.backdrop = None  # 静止画面の下にあったゲーム画面(表示したときの大きさ)
+        self.resize((WIDTH, HEIGHT))
+
+    def resize(self, size: tuple[int, int]) -> None:
+        """
+        ウィンドウの大きさを設定し、倍率が変わったら画像とフォントのキャッシュを捨てる。
+        
+        引数:
+            size (tuple[int, int]): ウィンドウの大きさ(ピクセル)
+        """
+        scale = min(size[0] / WIDTH, size[1] / HEIGHT)
+        if getattr(self, 'scale', None) != scale:
+            self.images: dict[pg.Surface, pg.Surface] = {}
+            self.fonts: dict[int, pg.font.Font] = {}
+        self.size = tuple(size)
+        self.scale = scale
+        self.offset = ((size[0] - int(WIDTH * scale)) // 2, (size[1] - int(HEIGHT * scale)) // 2)
+
+    def point(self, pos: tuple[float, float]) -> tuple[int, int]:
+        """論理座標を画面上の座標に変換する。"""
+        return self.offset[0] + int(pos[0] * self.scale), self.offset[1] + int(pos[1] * self.scale)
+
+    def rect(self, rect) -> pg.Rect:
+        """
+        論理座標の矩形を画面上の矩形に変換する。隣り合う矩形は画面上でも隙間なく並ぶ。
+        
+        引数:
+            rect (pg.Rect | tuple): (x, y, 幅, 高さ)
+        戻り値:
+            pg.Rect: 画面上の矩形
+        """
+        left, top = self.point((rect[0], rect[1]))
+        right, bottom = self.point((rect[0] + rect[2], rect[1] + rect[3]))
+        return pg.Rect(left, top, right - left, bottom - top)
+
+    def image(self, image: pg.Surface) -> pg.Surface:
+        """
+        画像を現在の倍率に拡大縮小して返す(倍率ごとに一度だけ作る)。
+        load_image で読み込んだ画像は、ぼやけないように元画像から直接拡大縮小する。
+        
+        引数:
+            image (pg.Surface): 論理解像度での画像(毎フレーム作り直す画像は渡さないこと)
+        戻り値:
+            pg.Surface: 画面用の画像
+        """
+        if self.scale == 1:
+            return image
+        scaled = self.images.get(image)
+        if scaled is None:
+            source = _image_sources.get(image)
+            if source is None:
+                scaled = self.scale_surface(image, image.get_size())
+            else:
+                path, size, angle, flip = source
+                scaled = self.scale_surface(load_source_image(path), size).convert_alpha()
+                scaled = pg.transform.rotate(pg.transform.flip(scaled, flip, False), angle)
+            self.images[image] = scaled
+        return scaled
+
+    def scale_surface(self, surface: pg.Surface, size: tuple[int, int]) -> pg.Surface:
+        """論理解像度での大きさ size に倍率を掛けた大きさへ拡大縮小する。"""
+        scaled_size = (max(1, round(size[0] * self.scale)), max(1, round(size[1] * self.scale)))
+        if surface.get_bitsize() >= 24:
+            return pg.transform.smoothscale(surface, scaled_size)
+        return pg.transform.scale(surface, scaled_size)
+
+    def font(self, size: int) -> pg.font.Font:
+        """論理解像度での文字の大きさ size に倍率を掛けたフォントを返す。"""
+        if size not in self.fonts:
+            self.fonts[size] = pg.font.Font(None, max(1, round(size * self.scale)))
+        return self.fonts[size]
+
+    def present(self, screen: pg.Surface, canvas: pg.Surface) -> None:
+        """
+        論理解像度で描いた静止画面(タイトル・メニュー・結果画面)を拡大縮小して画面に描く。
+        描き直すときにだけ呼ぶ。
+        
+        引数:
+            screen (pg.Surface): メイン画面
+            canvas (pg.Surface): WIDTH×HEIGHT で描いた画面
+        """
+        self.canvas = canvas
+        self.backdrop = None
+        if canvas is not None:
+            if canvas.get_flags() & pg.SRCALPHA:
+                # 透明な部分のある画面(一時停止・ゲームオーバー)は、下にあるゲーム画面も覚えておく
+                self.backdrop = screen.subsurface(self.rect((0, 0, WIDTH, HEIGHT))).copy()
+            screen.blit(self.scale_surface(canvas, (WIDTH, HEIGHT)) if self.scale != 1 else canvas, self.offset)
+
+    def redraw(self, screen: pg.Surface) -> None:
+        """
+        ウィンドウの大きさが変わったときに、最後に present した静止画面を新しい倍率で描き直す。
+        下にゲーム画面があった場合は、それを拡大縮小して先に描く。
+        
+        引数:
+            screen (pg.Surface): メイン画面
+        """
+        screen.fill(BLACK)
+        if self.backdrop is not None:
+            area = self.rect((0, 0, WIDTH, HEIGHT))
+            scale = pg.transform.smoothscale if self.backdrop.get_bitsize() >= 24 else pg.transform.scale
+            screen.blit(scale(self.backdrop, area.size), area)
+        if self.canvas is not None:
+            screen.blit(self.scale_surface(self.canvas, (WIDTH, HEIGHT)) if self.scale != 1 else self.canvas, self.offset)
+
+
+view = View()
+
+
 class Map:
     """
     マップの管理を行うクラス。
@@ -177,65 +745,310 @@ class Map:
         self.dots_remaining = 0
         self.dots_eaten = 0
 
-        # マップデータの読み込み
-        self.map_data = []
-        with open(map_file, 'r') as f:
-            for line in f:
-                row = [int(cell) for cell in line.strip().split()]
-                self.map_data.append(row)
-        self.height = len(self.map_data)
-        self.width = len(self.map_data[0])
-        
-        # パワーエサとワープトンネルの位置を特定
-        power_pellets = []
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.map_data[y][x] == 3:
-                    power_pellets.append({'x': x, 'y': y})
-        self.power_pellets = power_pellets
-        
-        tunnels = []
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.map_data[y][x] == 5:
-                    tunnels.append({'x': x, 'y': y})
-        self.tunnels = tunnels
-        
-        # プレイフィールドの作成
-        playfield = []
-        for y in range(self.height):
-            row = []
-            for x in range(self.width):
-                cell = {
-                    'path': self.map_data[y][x] in [0, 2, 3, 4, 5],
-                    'dot': 1 if self.map_data[y][x] == 2 else 2 if self.map_data[y][x] == 3 else 0,
-                    'intersection': False,
-                    'tunnel': self.map_data[y][x] == 5
-                }
-                if cell['dot'] > 0:
-                    self.dots_remaining += 1
-                row.append(cell)
-            playfield.append(row)
-        
-        # 交差点の判定
-        for y in range(1, self.height - 1):
-            for x in range(1, self.width - 1):
-                if playfield[y][x]['path']:
-                    paths = 0
-                    if playfield[y-1][x]['path']: paths += 1
-                    if playfield[y+1][x]['path']: paths += 1
-                    if playfield[y][x-1]['path']: paths += 1
-                    if playfield[y][x+1]['path']: paths += 1
-                    playfield[y][x]['intersection'] = (paths > 2)
-        self.playfield = playfield
-
-        # 敵の初期位置を特定
-        self.enemy_start_positions = []
-        for y in range(self.height):
-            for x in range(self.width):
-                if self.map_data[y][x] == 4:
-                    self.enemy_start_positions.append((x, y))
-    
+        # マップデータと派生データは、マップの内容のハッシュで引くキャッシュから読む
+        # (無いか内容が変わっていれば、テキストを読み直して作り、保存する)
+        with open(map_file, 'rb') as f:
+            content = f.read()
+        self.key = key = map_cache_key(content)
+        cache_file = map_file + MAP_CACHE_SUFFIX
+        cached = read_map_cache(cache_file, key)
+        if cached is None:
+            self.map_data = [[int(cell) for cell in line.strip().split()] for line in content.decode().splitlines()]
+            self.height = len(self.map_data)
+            self.width = len(self.map_data[0])
+            info, arrays = self.build_derived()
+            write_map_cache(cache_file, key, info, arrays)
+            cached = read_map_cache(cache_file, key)
+            if cached is None:
+                # 書き込めない場所(読み取り専用・ブラウザ版など)ではメモリ上のものを使う
+                cached = info, {name: memoryview(values) for name, values in arrays.items()}
+        info, arrays = cached
+        self.arrays = arrays  # close で解放する
+        self.width = info["width"]
+        self.height = info["height"]
+        codes = arrays["codes"]
+        self.map_data = [codes[y * self.width:(y + 1) * self.width].tolist() for y in range(self.height)]
+        self.dots_remaining = info["dots_remaining"]
+
+        # セルごとの情報(ビット0: 通路, ビット1: 交差点, ビット2〜5: 左右上下の隣が通路)
+        self.flags = arrays["flags"]
+        # セルが属する連結成分(成分の最初のセルの番号 y*幅+x。壁は -1。トンネルでつながったセルも同じ成分)
+        self.component = arrays["component"]
+        # 盤面の各セルから最も近いトンネルまでのマンハッタン距離(distance を毎回トンネル全部と比べずに済ませる)
+        self.tunnel_distance = arrays.get("tunnel_distance")
+
+        self.power_pellets = [{'x': x, 'y': y} for x, y in info["power_pellets"]]
+        self.tunnels = [{'x': x, 'y': y} for x, y in info["tunnels"]]
+        self.enemy_start_positions = [tuple(cell) for cell in info["enemy_start_positions"]]
+        self.tunnel_pairs = {tuple(cell): tuple(partner) for cell, partner in info["tunnel_pairs"]}
+        self.tunnel_cells = list(self.tunnel_pairs)
+
+        # プレイフィールドの作成(Mapはゲーム中に書き換えないので、同じ内容のセルは同じ辞書を共有する)
+        cell_types = {
+            (code, intersection): {
+                'path': code in [0, 2, 3, 4, 5, 6],
+                'dot': 1 if code == 2 else 2 if code == 3 else 0,
+                'intersection': intersection,
+                'tunnel': code == 5
+            }
+            for code in range(256) for intersection in (False, True)
+        }
+        flags = self.flags
+        self.playfield = [
+            [cell_types[code, bool(flags[y * self.width + x] & 2)] for x, code in enumerate(row)]
+            for y, row in enumerate(self.map_data)
+        ]
+
+        # 通行可能セル。隣接リストは経路探索で初めて調べたセルの分だけ作る
+        width = self.width
+        self.path_cells = [(i % width, i // width) for i, flags in enumerate(self.flags) if flags & 1]
+        self.adjacency = {}
+        self.nearest_cells = {}  # 連結成分 -> 盤面の各セルから最も近いその成分のセル(必要になった時に作る)
+
+    def close(self) -> None:
+        """
+        派生データを手放し、キャッシュファイルのメモリマップを閉じる
+        (マップを作り直すツールなどで、ファイルを早く手放したいときに呼ぶ)。閉じた後はこの Map を使わないこと。
+        """
+        mapped = {id(values.obj): values.obj for values in self.arrays.values()}
+        for values in self.arrays.values():
+            values.release()
+        self.arrays = {}
+        for base in mapped.values():
+            if isinstance(base, mmap.mmap):
+                base.close()
+
+    def build_derived(self) -> tuple[dict, dict]:
+        """
+        マップデータから派生データを作る(キャッシュが使えないときだけ呼ばれる)。
+        
+        戻り値:
+            tuple[dict, dict]: (座標のリストなどJSONにできる情報, セルごとの配列(array)の辞書)
+        """
+        width, height = self.width, self.height
+        codes = [code for row in self.map_data for code in row]
+        is_path = [code in (0, 2, 3, 4, 5, 6) for code in codes]
+        cells = lambda code: [[i % width, i // width] for i, c in enumerate(codes) if c == code]
+
+        flags = array('B', bytes(width * height))
+        for i, path in enumerate(is_path):
+            if not path:
+                continue
+            x, y = i % width, i // width
+            neighbors = 0
+            for bit, (dx, dy) in enumerate([(-1, 0), (1, 0), (0, -1), (0, 1)]):
+                if 0 <= x + dx < width and 0 <= y + dy < height and is_path[i + dy * width + dx]:
+                    neighbors |= 1 << bit
+            paths = bin(neighbors).count("1")
+            # 交差点は盤面の端のセルを除いて判定する
+            intersection = 0 < x < width - 1 and 0 < y < height - 1 and paths > 2
+            flags[i] = 1 | intersection << 1 | neighbors << 2
+
+        tunnels = cells(5)
+        tunnel_pairs = self.pair_tunnels([tuple(cell) for cell in tunnels])
+        partner = {y * width + x: py * width + px for (x, y), (px, py) in tunnel_pairs.items()}
+        steps = [-1, 1, -width, width]
+
+        component = array('i', [-1]) * (width * height)
+        for first, path in enumerate(is_path):
+            if not path or component[first] >= 0:
+                continue
+            component[first] = first
+            queue = deque([first])
+            while queue:
+                current = queue.popleft()
+                next_cells = [current + step for bit, step in enumerate(steps) if flags[current] >> 2 + bit & 1]
+                if current in partner:
+                    next_cells.append(partner[current])
+                for next_cell in next_cells:
+                    if component[next_cell] < 0:
+                        component[next_cell] = first
+                        queue.append(next_cell)
+        arrays = {"flags": flags, "component": component}
+
+        if tunnel_pairs:
+            distance = array('i', [-1]) * (width * height)
+            queue = deque()
+            for x, y in tunnel_pairs:
+                distance[y * width + x] = 0
+                queue.append((x, y))
+            while queue:
+                x, y = queue.popleft()
+                for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                    if 0 <= nx < width and 0 <= ny < height and distance[ny * width + nx] < 0:
+                        distance[ny * width + nx] = distance[y * width + x] + 1
+                        queue.append((nx, ny))
+            arrays["tunnel_distance"] = distance
+
+        arrays["codes"] = array('B', codes)
+        info = {
+            "width": width,
+            "height": height,
+            "dots_remaining": sum(code in (2, 3) for code in codes),
+            "power_pellets": cells(3),
+            "tunnels": tunnels,
+            # 敵の出現位置のセルがあればその全て、無ければ従来どおりゴーストの家の先頭 ENEMY_COUNT 個
+            "enemy_start_positions": cells(CELL_SPAWN) or cells(CELL_ENEMY)[:ENEMY_COUNT],
+            "tunnel_pairs": [[list(cell), list(pair)] for cell, pair in tunnel_pairs.items()],
+        }
+        return info, arrays
+
+    @staticmethod
+    def pair_tunnels(cells: list[tuple[int, int]]) -> dict[tuple[int, int], tuple[int, int]]:
+        """
+        ワープトンネルを2つずつ組にする。
+        同じ行にちょうど2つあるもの(左右の端)、同じ列にちょうど2つあるもの(上下の端)の順に組にし、
+        残りは読み込み順に2つずつ組にする。
+
+        引数:
+            cells (list[tuple[int, int]]): トンネルのグリッド座標
+        戻り値:
+            dict[tuple[int, int], tuple[int, int]]: トンネル座標からワープ先の座標への対応
+        """
+        pairs = {}
+        for axis in (1, 0):
+            groups = {}
+            for cell in cells:
+                if cell not in pairs:
+                    groups.setdefault(cell[axis], []).append(cell)
+            for group in groups.values():
+                if len(group) == 2:
+                    pairs[group[0]], pairs[group[1]] = group[1], group[0]
+        rest = [cell for cell in cells if cell not in pairs]
+        for a, b in zip(rest[0::2], rest[1::2]):
+            pairs[a], pairs[b] = b, a
+        return pairs
+
+    def distance(self, a: tuple[int, int], b: tuple[int, int]) -> int:
+        """
+        2点間の距離の下限(トンネルを考慮したマンハッタン距離)を返す。
+        トンネルを使う場合は「最寄りのトンネルまで + ワープ1歩 + トンネルから目的地まで」と比べて小さい方。
+        LOD の間引き間隔や、ゴーストの目標の決定に使う。
+        """
+        direct = abs(a[0] - b[0]) + abs(a[1] - b[1])
+        if not self.tunnel_cells:
+            return direct
+        if 0 <= a[0] < self.width and 0 <= a[1] < self.height and 0 <= b[0] < self.width and 0 <= b[1] < self.height:
+            to_tunnel = self.tunnel_distance[a[1] * self.width + a[0]]
+            from_tunnel = self.tunnel_distance[b[1] * self.width + b[0]]
+            return min(direct, to_tunnel + 1 + from_tunnel)
+        to_tunnel = min(abs(a[0] - t[0]) + abs(a[1] - t[1]) for t in self.tunnel_cells)
+        from_tunnel = min(abs(t[0] - b[0]) + abs(t[1] - b[1]) for t in self.tunnel_cells)
+        return min(direct, to_tunnel + 1 + from_tunnel)
+
+    def get_neighbors(self, pos: tuple[int, int]) -> list[tuple[int, int]]:
+        """
+        経路探索用の近傍ノードを返す。壁ではなくpathがTrueになっているセルと、
+        トンネルならワープ先のセルが隣接セルとなる。セルごとに初めて調べたときにリストを作る。
+        """
+        neighbors = self.adjacency.get(pos)
+        if neighbors is None:
+            x, y = pos
+            neighbors = []
+            if 0 <= x < self.width and 0 <= y < self.height:
+                flags = self.flags[y * self.width + x]
+                neighbors = [
+                    (x + dx, y + dy) for bit, (dx, dy) in enumerate([(-1, 0), (1, 0), (0, -1), (0, 1)])
+                    if flags >> 2 + bit & 1
+                ]
+                if pos in self.tunnel_pairs:
+                    neighbors.append(self.tunnel_pairs[pos])
+            self.adjacency[pos] = neighbors
+        return neighbors
+
+    def get_component(self, pos: tuple[int, int]) -> int:
+        """セルが属する連結成分の番号を返す(壁や盤面の外なら -1)。"""
+        x, y = pos
+        if 0 <= x < self.width and 0 <= y < self.height:
+            return self.component[y * self.width + x]
+        return -1
+
+    def reachable(self, start: tuple[int, int], goal: tuple[int, int]) -> bool:
+        """start から goal まで通路をたどって行けるかを返す(O(1))。"""
+        component = self.get_component(start)
+        return component >= 0 and self.get_component(goal) == component
+
+    def nearest_reachable(self, start: tuple[int, int], goal: tuple[int, int]) -> tuple[int, int]:
+        """
+        start から行けるセルのうち goal に最も近い(マンハッタン距離)セルを返す。
+        goal に行けるなら goal をそのまま返す。start が通路でなければ何もしない(goal を返す)。
+        成分ごとの「最も近いセル」の表は、その成分で初めて必要になった時に盤面全体を一度だけ幅優先探索して作る。
+        
+        引数:
+            start (tuple[int, int]): 開始座標
+            goal (tuple[int, int]): 目標座標(壁や盤面の外でもよい)
+        戻り値:
+            tuple[int, int]: 目標にする座標
+        """
+        component = self.get_component(start)
+        if component < 0 or self.get_component(goal) == component:
+            return goal
+        nearest = self.nearest_cells.get(component)
+        if nearest is None:
+            nearest = [None] * (self.width * self.height)
+            queue = deque()
+            for i, cell_component in enumerate(self.component):
+                if cell_component == component:
+                    nearest[i] = (i % self.width, i // self.width)
+                    queue.append(nearest[i])
+            while queue:
+                x, y = queue.popleft()
+                for nx, ny in ((x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)):
+                    if 0 <= nx < self.width and 0 <= ny < self.height and nearest[ny * self.width + nx] is None:
+                        nearest[ny * self.width + nx] = nearest[y * self.width + x]
+                        queue.append((nx, ny))
+            self.nearest_cells[component] = nearest
+        x = min(max(goal[0], 0), self.width - 1)
+        y = min(max(goal[1], 0), self.height - 1)
+        return nearest[y * self.width + x]
+
+    def find_paths(self, starts: list[tuple[int, int]], goal: tuple[int, int],
+                   counts: list[int] | None = None) -> list[list]:
+        """
+        同じ goal を目指す複数の開始座標の経路をまとめて求める。
+        goal から一度だけ幅優先探索で距離を広げ、各 start からは距離が1ずつ減る
+        セルを(get_neighbors の順で最初のものを)たどって経路を復元する。
+        次のセルは今いるセルだけで決まるので、経路の途中のセルから求めた経路は元の経路の後半と一致する
+        (path_cache はこの性質を使って、キャッシュした経路の後半を返す)。
+        goal に行けない開始座標は探索せずに空リストにする。
+        
+        引数:
+            starts (list[tuple[int, int]]): 開始座標のリスト
+            goal (tuple[int, int]): 目標座標
+            counts (list[int] | None): 渡すと [展開したノード数, キューへの追加数] に加算する
+        戻り値:
+            list[list]: starts と同じ順の経路リスト(到達できない場合は空リスト)
+        """
+        distance = {goal: 0}
+        remaining = {start for start in starts if start != goal and self.reachable(start, goal)}
+        queue = deque([goal])
+        expanded = 0
+        while queue and remaining:
+            current = queue.popleft()
+            expanded += 1
+            for next_pos in self.get_neighbors(current):
+                if next_pos not in distance:
+                    distance[next_pos] = distance[current] + 1
+                    remaining.discard(next_pos)
+                    queue.append(next_pos)
+        if counts is not None:
+            counts[0] += expanded
+            counts[1] += len(distance)
+
+        paths = []
+        for start in starts:
+            if start == goal or start not in distance:
+                paths.append([])
+                continue
+            path = [start]
+            current = start
+            while current != goal:
+                step = distance[current] - 1
+                current = next(pos for pos in self.get_neighbors(current) if distance.get(pos) == step)
+                path.append(current)
+            paths.append(path)
+        return paths
+
     def draw(self, screen: pg.Surface, field_start: tuple[int, int]) -> None:
         """
         マップを描画する。
@@ -248,7 +1061,8 @@ class Map:
             0: (0, 0, 0),       # 通路: 黒
             1: (54, 67, 100),   # 壁: 青
             4: (255, 192, 203), # ゴーストの家の入り口: ピンク
-            5: (0, 255, 0)      # ワープトンネル: 緑
+            5: (0, 255, 0),     # ワープトンネル: 緑
+            6: (0, 0, 0)        # 敵の初期位置: 通路と同じ黒
         }
         
         for y, row in enumerate(self.map_data):
@@ -256,10 +1070,263 @@ class Map:
                 rect_x = field_start[0] + (x * GRID_SIZE)
                 rect_y = field_start[1] + (y * GRID_SIZE)
                 if cell in colors:
-                    pg.draw.rect(screen, colors[cell], (rect_x, rect_y, GRID_SIZE, GRID_SIZE))
+                    pg.draw.rect(screen, colors[cell], view.rect((rect_x, rect_y, GRID_SIZE, GRID_SIZE)))
 
 
-class Player(pg.sprite.Sprite):
+def generate_maze(width: int, height: int, seed: int | None = None, enemy_count: int = 4,
+                  tunnel_pairs: int = 1, braid: float = 1.0) -> list[list[int]]:
+    """
+    シード付きで迷路マップを自動生成する。
+    Map と同じセル種別(壁・エサ・パワーエサ・ワープトンネル・敵の初期位置 CELL_SPAWN)を使い、
+    全ての通路が連結したマップを返す。同じ引数なら常に同じ迷路になるため、
+    大きなマップでの負荷テスト用の再現可能なデータとして使える。
+
+    引数:
+        width (int): マップの幅(セル数, 7以上)
+        height (int): マップの高さ(セル数, 7以上)
+        seed (int | None): 乱数シード
+        enemy_count (int): 敵の初期位置(CELL_SPAWN)の数。マップの敵の数になる。
+                           置ける通路(プレイヤー初期位置以外)より多いと ValueError
+        tunnel_pairs (int): 左右の端をつなぐワープトンネルの組数
+        braid (float): 行き止まりをつぶしてループにする割合(0.0〜1.0)
+    戻り値:
+        list[list[int]]: 行ごとのセル種別のリスト
+    """
+    if width < 7 or height < 7:
+        raise ValueError(f"maze size must be at least 7x7: {width}x{height}")
+    rng = random.Random(seed)
+    grid = [[CELL_WALL] * width for _ in range(height)]
+    directions = [(-1, 0), (1, 0), (0, -1), (0, 1)]
+
+    # 奇数座標のセルを部屋とみなし、穴掘り法で全域木を作る(大きなマップ用に反復版)
+    x_max = width - 2 if width % 2 == 1 else width - 3
+    y_max = height - 2 if height % 2 == 1 else height - 3
+    grid[1][1] = CELL_PATH
+    stack = [(1, 1)]
+    while stack:
+        x, y = stack[-1]
+        candidates = [
+            (x + dx * 2, y + dy * 2) for dx, dy in directions
+            if 1 <= x + dx * 2 <= x_max and 1 <= y + dy * 2 <= y_max
+            and grid[y + dy * 2][x + dx * 2] == CELL_WALL
+        ]
+        if not candidates:
+            stack.pop()
+            continue
+        nx, ny = rng.choice(candidates)
+        grid[(y + ny) // 2][(x + nx) // 2] = CELL_PATH
+        grid[ny][nx] = CELL_PATH
+        stack.append((nx, ny))
+
+    # 行き止まりの壁を崩してループを作る(パックマンらしい周回できる迷路にする)
+    for y in range(1, y_max + 1, 2):
+        for x in range(1, x_max + 1, 2):
+            openings = [(dx, dy) for dx, dy in directions if grid[y + dy][x + dx] != CELL_WALL]
+            if len(openings) == 1 and rng.random() < braid:
+                walls = [
+                    (dx, dy) for dx, dy in directions
+                    if grid[y + dy][x + dx] == CELL_WALL
+                    and 1 <= x + dx * 2 <= x_max and 1 <= y + dy * 2 <= y_max
+                ]
+                if walls:
+                    dx, dy = rng.choice(walls)
+                    grid[y + dy][x + dx] = CELL_PATH
+
+    # ワープトンネル(左右の端を同じ行で結ぶ)
+    tunnel_rows = list(range(3, y_max - 1, 2)) or [1]
+    tunnel_pairs = min(tunnel_pairs, len(tunnel_rows))
+    for i in range(tunnel_pairs):
+        y = tunnel_rows[(i + 1) * len(tunnel_rows) // (tunnel_pairs + 1)]
+        for x in range(x_max + 1, width - 1):
+            grid[y][x] = CELL_PATH
+        grid[y][0] = CELL_TUNNEL
+        grid[y][width - 1] = CELL_TUNNEL
+
+    # 敵の初期位置(中央に最も近い通路から幅優先で選ぶ)
+    center = (min(x_max, (width // 2) | 1), min(y_max, (height // 2) | 1))
+    queue = deque([center])
+    visited = {center}
+    enemy_cells = []
+    while queue and len(enemy_cells) < enemy_count:
+        x, y = queue.popleft()
+        if (x, y) != (1, 1) and grid[y][x] == CELL_PATH:
+            enemy_cells.append((x, y))
+        for dx, dy in directions:
+            nx, ny = x + dx, y + dy
+            if (nx, ny) not in visited and grid[ny][nx] == CELL_PATH:
+                visited.add((nx, ny))
+                queue.append((nx, ny))
+    if len(enemy_cells) < enemy_count:
+        raise ValueError(f"only {len(enemy_cells)} cells for {enemy_count} enemies in a {width}x{height} maze")
+    for x, y in enemy_cells:
+        grid[y][x] = CELL_SPAWN
+
+    # エサを配置し、プレイヤー初期位置(1, 1)以外の角にパワーエサを置く
+    for y in range(height):
+        for x in range(width):
+            if grid[y][x] == CELL_PATH and (x, y) != (1, 1):
+                grid[y][x] = CELL_DOT
+    for x, y in [(x_max, 1), (1, y_max), (x_max, y_max)]:
+        if grid[y][x] == CELL_DOT:
+            grid[y][x] = CELL_POWER
+    return grid
+
+
+def map_cache_key(content: bytes) -> str:
+    """
+    マップファイルの内容から、キャッシュを引くためのハッシュを返す(派生データの作り方の版を含む)。
+    
+    引数:
+        content (bytes): マップファイルの内容
+    戻り値:
+        str: ハッシュ(16進数)
+    """
+    return hashlib.sha256(str(MAP_CACHE_VERSION).encode() + b"\0" + content).hexdigest()
+
+
+def read_map_cache(cache_file: str, key: str) -> tuple[dict, dict] | None:
+    """
+    マップの派生データのキャッシュをメモリマップして読む。
+    
+    引数:
+        cache_file (str): キャッシュファイルのパス
+        key (str): マップの内容のハッシュ
+    戻り値:
+        tuple[dict, dict] | None: (情報, 配列名 -> ファイルを直接参照する memoryview)。無い・壊れている・古い場合は None
+    """
+    try:
+        with open(cache_file, 'rb') as f:
+            mapped = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+    try:
+        if mapped[:len(MAP_CACHE_MAGIC)] != MAP_CACHE_MAGIC:
+            raise ValueError("not a map cache")
+        start = len(MAP_CACHE_MAGIC) + 4
+        header_size = int.from_bytes(mapped[len(MAP_CACHE_MAGIC):start], "little")
+        info = json.loads(mapped[start:start + header_size])
+        if info.get("key") != key or info.get("byteorder") != sys.byteorder:
+            raise ValueError("stale map cache")
+        # 途中で切れたファイルを読まないように、全ての配列がセル数ぶんファイルに収まっているかを先に調べる
+        cells = info["width"] * info["height"]
+        data = -(-(start + header_size) // 8) * 8
+        layout = info["arrays"]
+        for name in ("codes", "flags", "component"):
+            if name not in layout:
+                raise ValueError(f"missing array: {name}")
+        end = data
+        for typecode, offset, size in layout.values():
+            if size != cells * array(typecode).itemsize or offset < 0 or data + offset + size > len(mapped):
+                raise ValueError("truncated map cache")
+            end = max(end, data + offset + -(-size // 8) * 8)
+        if len(mapped) != end:
+            raise ValueError("map cache size mismatch")
+    except (ValueError, KeyError, TypeError, AttributeError):
+        mapped.close()
+        return None
+    view = memoryview(mapped)
+    arrays = {
+        name: view[data + offset:data + offset + size].cast(typecode)
+        for name, (typecode, offset, size) in layout.items()
+    }
+    return info, arrays
+
+
+def write_map_cache(cache_file: str, key: str, info: dict, arrays: dict) -> None:
+    """
+    マップの派生データをキャッシュファイルに書く(書きかけを読まれないように置き換える。書けなければ何もしない)。
+    形式: MAP_CACHE_MAGIC, ヘッダ(JSON)のバイト数(4バイト), ヘッダ, 8バイト境界から各配列(このマシンのバイト順)
+    
+    引数:
+        cache_file (str): キャッシュファイルのパス
+        key (str): マップの内容のハッシュ
+        info (dict): JSONにできる情報
+        arrays (dict): 配列名 -> array
+    """
+    layout = {}
+    offset = 0
+    for name, values in arrays.items():
+        size = len(values) * values.itemsize
+        layout[name] = (values.typecode, offset, size)
+        offset += -(-size // 8) * 8
+    header = json.dumps(dict(info, key=key, byteorder=sys.byteorder, arrays=layout)).encode()
+    start = len(MAP_CACHE_MAGIC) + 4 + len(header)
+    temp_file = f"{cache_file}.{os.getpid()}.{threading.get_ident()}.tmp"
+    try:
+        with open(temp_file, 'wb') as f:
+            f.write(MAP_CACHE_MAGIC + len(header).to_bytes(4, "little") + header)
+            f.write(bytes(-(-start // 8) * 8 - start))
+            for name, values in arrays.items():
+                data = values.tobytes()
+                f.write(data + bytes(-(-len(data) // 8) * 8 - len(data)))
+        os.replace(temp_file, cache_file)
+    except OSError:
+        try:
+            os.remove(temp_file)
+        except OSError:
+            pass
+
+
+def write_map_file(map_file: str, grid: list[list[int]]) -> None:
+    """
+    マップデータを Map が読み込める形式(空白区切りのセル種別)でファイルに書き出す。
+
+    引数:
+        map_file (str): 書き出し先のファイルパス
+        grid (list[list[int]]): 行ごとのセル種別のリスト
+    """
+    with open(map_file, 'w') as f:
+        for row in grid:
+            f.write(" ".join(str(cell) for cell in row) + "\n")
+
+
+class GridMover:
+    """
+    プレイヤーと敵で共通の、グリッドに沿った移動処理。
+    位置(中心座標)を SUBPIXEL 単位の整数で持ち、1ティックの移動は整数の加減算だけで行うため、
+    速度が1ピクセルで割り切れなくても誤差が溜まらず、同じ入力なら常に同じ位置になる。
+    使う側は self.rect を持っていること。
+    """
+    def place(self, pixel_pos: tuple[int, int]) -> None:
+        """
+        指定したピクセル座標にそのまま配置する。
+        
+        引数:
+            pixel_pos (tuple[int, int]): 中心のピクセル座標
+        """
+        self.pos = [pixel_pos[0] * SUBPIXEL, pixel_pos[1] * SUBPIXEL]
+        self.rect.center = pixel_pos
+
+    def step_towards(self, pixel_target: tuple[int, int], speed: int) -> bool:
+        """
+        目標のピクセル座標へ speed(サブピクセル)だけ軸に沿って進む。
+        x方向を先に、残りの移動量でy方向を詰める。目標までの距離が speed 以下なら目標に揃える。
+        
+        引数:
+            pixel_target (tuple[int, int]): 目標の中心ピクセル座標
+            speed (int): 1ティックの移動量(サブピクセル)
+        戻り値:
+            bool: 目標に到達したら True
+        """
+        tx = pixel_target[0] * SUBPIXEL
+        ty = pixel_target[1] * SUBPIXEL
+        dx = tx - self.pos[0]
+        dy = ty - self.pos[1]
+        if abs(dx) + abs(dy) <= speed:
+            self.place(pixel_target)
+            return True
+
+        step = min(speed, abs(dx))
+        self.pos[0] += step if dx > 0 else -step
+        rest = speed - step
+        if rest and dy:
+            step = min(rest, abs(dy))
+            self.pos[1] += step if dy > 0 else -step
+        self.rect.center = (self.pos[0] // SUBPIXEL, self.pos[1] // SUBPIXEL)
+        return False
+
+
+class Player(GridMover, pg.sprite.Sprite):
     """
     プレイヤー(パックマン)を管理するクラス。
     移動、アニメーション、残機管理、死亡処理などの機能を持つ。
@@ -269,12 +1336,11 @@ class Player(pg.sprite.Sprite):
         self.grid_pos = grid_pos
         self.map_data = map_data
         self.lives = 3  # 残機の初期値
-        self.font = pg.font.Font(None, 30)
 
         # --- パックマン本体画像 (アニメ用) ---
         self.original_images = [
-            pg.transform.scale(pg.image.load("fig/pacman_open.png").convert_alpha(), (PLAYER_SIZE, PLAYER_SIZE)),
-            pg.transform.scale(pg.image.load("fig/pacman_circle.png").convert_alpha(), (PLAYER_SIZE, PLAYER_SIZE))
+            load_image("fig/pacman_open.png", (PLAYER_SIZE, PLAYER_SIZE)),
+            load_image("fig/pacman_circle.png", (PLAYER_SIZE, PLAYER_SIZE))
         ]
         self.current_frame = 0
         self.animation_counter = 0
@@ -283,19 +1349,17 @@ class Player(pg.sprite.Sprite):
         self.rect = self.image.get_rect()
 
         # --- 残機アイコン (小さめパックマン画像) ---
-        self.life_icon = pg.transform.scale(
-            pg.image.load("fig/pacman_circle.png").convert_alpha(),
-            (int(PLAYER_SIZE * 0.8), int(PLAYER_SIZE * 0.8))
-        )
+        self.life_icon = load_image("fig/pacman_circle.png", (int(PLAYER_SIZE * 0.8), int(PLAYER_SIZE * 0.8)))
 
         # 位置関連
-        self.rect.center = get_pixel_pos(*grid_pos)
+        self.place(get_pixel_pos(*grid_pos))
         self.target_pos = self.rect.center
         self.moving = False
 
         # 移動関連
         self.current_direction = None
         self.queued_direction = None
+        self.held_directions = []  # 押し続けている方向(押した順)
 
         # 回転関連
         self.angle = 0
@@ -305,54 +1369,70 @@ class Player(pg.sprite.Sprite):
         # ワープ関連
         self.can_warp = True
         self.last_warp_pos = None
-        self.warp_cells = [tuple(cell.values()) for cell in map_data.tunnels]
 
         # 死亡アニメーション関連
         self.is_dying = False
         self.death_images = [
-            pg.transform.scale(pg.image.load(f"fig/pacman_death/pacman_open_{i:02d}.png").convert_alpha(), 
-                                (PLAYER_SIZE, PLAYER_SIZE))
+            load_image(f"fig/pacman_death/pacman_open_{i:02d}.png", (PLAYER_SIZE, PLAYER_SIZE))
             for i in range(20)
         ]
         self.death_frame = 0
-        self.death_timer = 0
+        self.death_timer = None  # 次のコマに進める予定
         self.death_duration = 4
         self.death_start_time = 0
         self.game_over = False
 
     def reset_position(self):
         """プレイヤーを初期位置にリセットする。"""
-        self.rect.center = get_pixel_pos(*self.grid_pos)
+        self.place(get_pixel_pos(*self.grid_pos))
         self.current_direction = None
         self.queued_direction = None
         self.moving = False
         self.angle = 0
         self.target_angle = 0
+
+    def reset_level(self) -> None:
+        """プレイヤーをレベル開始時の状態(残機も含む)に戻す。画像などはそのまま使う。"""
+        self.reset_position()
+        self.held_directions.clear()
+        self.lives = 3
+        self.is_dying = False
+        self.game_over = False
+        self.death_frame = 0
+        self.death_timer = None
+        self.can_warp = True
+        self.last_warp_pos = None
+        self.current_frame = 0
+        self.animation_counter = 0
+        self.image = self.original_images[0]
     
-    def handle_input(self, keys: pg.key.ScancodeWrapper) -> None:
+    def handle_input(self, key: int, pressed: bool) -> None:
         """
-        プレイヤーの入力を受け取り、移動方向を更新する。
+        方向キーの押下/解放を受け取り、移動方向を更新する。
+        押された方向は次の曲がり角まで予約され、1フレームより短い押下でも失われない。
         
         引数:
-            keys (pg.key.ScancodeWrapper): 押下されているキー情報
+            key (int): キー
+            pressed (bool): 押されたなら True、離されたなら False
         """
+        direction = DIRECTION_KEYS.get(key)
+        if direction is None:
+            return
+        if direction in self.held_directions:
+            self.held_directions.remove(direction)
+        if pressed:
+            self.held_directions.append(direction)
+
         if self.is_dying or self.game_over:
             return
         
-        new_direction = None
-        if keys[pg.K_LEFT]:
-            new_direction = (-1, 0)
-        elif keys[pg.K_RIGHT]:
-            new_direction = (1, 0)
-        elif keys[pg.K_UP]:
-            new_direction = (0, -1)
-        elif keys[pg.K_DOWN]:
-            new_direction = (0, 1)
-        
-        if new_direction:
-            self.queued_direction = new_direction
+        if pressed:
+            self.queued_direction = direction
             if not self.moving:
-                self.try_move(new_direction)
+                self.try_move(direction)
+        elif self.held_directions:
+            # まだ押されている方向キーがあればそちらを予約し直す
+            self.queued_direction = self.held_directions[-1]
     
     def try_move(self, direction: tuple[int, int]) -> bool:
         """
@@ -374,7 +1454,7 @@ class Player(pg.sprite.Sprite):
         if self.map_data.playfield[next_pos[1]][next_pos[0]]['tunnel'] and self.can_warp:
             warp_pos = self.get_warp_destination(next_pos)
             if warp_pos:
-                self.rect.center = get_pixel_pos(*warp_pos)
+                self.place(get_pixel_pos(*warp_pos))
                 self.target_pos = self.rect.center
                 self.last_warp_pos = warp_pos
                 self.can_warp = False
@@ -429,7 +1509,7 @@ class Player(pg.sprite.Sprite):
     
     def get_warp_destination(self, current_pos: tuple[int, int]) -> tuple[int, int] | None:
         """
-        ワープトンネル通過後の座標を取得する。
+        ワープトンネル通過後の座標(Map.tunnel_pairs で組になったトンネル)を取得する。
         同じトンネルセルでの連続ワープは防ぐ。
 
         引数:
@@ -439,25 +1519,26 @@ class Player(pg.sprite.Sprite):
         """
         if self.last_warp_pos == current_pos:
             return None
-        for cell in self.warp_cells:
-            if cell != current_pos and cell != self.last_warp_pos:
-                return cell
-        return None
+        destination = self.map_data.tunnel_pairs.get(current_pos)
+        if destination == self.last_warp_pos:
+            return None
+        return destination
 
     def update(self) -> None:
         """
         プレイヤーの状態を更新する。移動や回転アニメーション、死亡アニメーションを処理。
         """
         if self.is_dying:
-            self.update_death_animation()
+            # 死亡アニメーションは scheduler から進める
             return
+
+        # 方向キーを押し続けている間は、止まっていれば毎ティック移動を試みる
+        if self.held_directions and not self.moving:
+            self.queued_direction = self.held_directions[-1]
+            self.try_move(self.queued_direction)
         
         if self.moving:
-            dx = self.target_pos[0] - self.rect.centerx
-            dy = self.target_pos[1] - self.rect.centery
-            
-            if abs(dx) <= PLAYER_SPEED and abs(dy) <= PLAYER_SPEED:
-                self.rect.center = self.target_pos
+            if self.step_towards(self.target_pos, PLAYER_SPEED * SUBPIXEL):
                 self.moving = False
                 if self.queued_direction:
                     if not self.try_move(self.queued_direction):
@@ -470,11 +1551,6 @@ class Player(pg.sprite.Sprite):
                 if not self.is_tunnel_position(current_pos):
                     self.can_warp = True
                     self.last_warp_pos = None
-            else:
-                move_x = PLAYER_SPEED * (1 if dx > 0 else -1 if dx < 0 else 0)
-                move_y = PLAYER_SPEED * (1 if dy > 0 else -1 if dy < 0 else 0)
-                self.rect.centerx += move_x
-                self.rect.centery += move_y
         
         # 回転
         if self.angle != self.target_angle:
@@ -488,7 +1564,7 @@ class Player(pg.sprite.Sprite):
         self.update_animation()
         
         # 角度に基づいて画像を回転
-        self.image = pg.transform.rotate(self.original_images[self.current_frame], -self.angle)
+        self.image = transform_image(self.original_images[self.current_frame], -self.angle)
     
     def update_animation(self) -> None:
         """
@@ -503,19 +1579,21 @@ class Player(pg.sprite.Sprite):
             self.current_frame = 0
             self.animation_counter = 0
     
-    def draw(self, screen: pg.Surface) -> None:
+    def draw(self, screen: pg.Surface) -> list[pg.Rect]:
         """
         プレイヤーをメイン画面に描画する。残機数の描画も行う。
 
         引数:
             screen (pg.Surface): メイン画面
+        戻り値:
+            list[pg.Rect]: 描画した範囲
         """
         # 1) プレイヤー本体を描画
-        screen.blit(self.image, self.rect)
+        rects = [screen.blit(view.image(self.image), view.point(self.rect.topleft))]
 
         # 2) "LIFE" の文字を描画
-        label_text = self.font.render("LIFE", True, (255, 255, 255))
-        screen.blit(label_text, (WIDTH - 180, 10)) 
+        label_text = view.font(30).render("LIFE", True, (255, 255, 255))
+        rects.append(screen.blit(label_text, view.point((WIDTH - 180, 10))))
 
         # 3) 残機アイコンを右上に横並びで描画
         offset = 30
@@ -524,7 +1602,41 @@ class Player(pg.sprite.Sprite):
         for i in range(self.lives):
             icon_x = x_base - i * offset
             icon_y = y_base
-            screen.blit(self.life_icon, (icon_x, icon_y))
+            rects.append(screen.blit(view.image(self.life_icon), view.point((icon_x, icon_y))))
+        return rects
+
+    def get_state(self, now: float) -> tuple:
+        """
+        スナップショット用に現在の状態をタプルで返す。時刻は now からの経過時間として保存する。
+        
+        引数:
+            now (float): 現在のゲーム内時刻
+        戻り値:
+            tuple: 状態
+        """
+        return (
+            tuple(self.pos), self.target_pos, self.moving, self.current_direction, self.queued_direction,
+            tuple(self.held_directions), self.angle, self.target_angle, self.can_warp, self.last_warp_pos,
+            self.current_frame, self.animation_counter, self.is_dying, now - self.death_start_time,
+            self.death_frame, self.death_timer, self.lives, self.game_over, self.image,
+        )
+
+    def set_state(self, state: tuple, now: float) -> None:
+        """
+        get_state で得た状態を復元する。
+        
+        引数:
+            state (tuple): 状態
+            now (float): 現在のゲーム内時刻
+        """
+        (pos, self.target_pos, self.moving, self.current_direction, self.queued_direction,
+         held_directions, self.angle, self.target_angle, self.can_warp, self.last_warp_pos,
+         self.current_frame, self.animation_counter, self.is_dying, death_elapsed,
+         self.death_frame, self.death_timer, self.lives, self.game_over, self.image) = state
+        self.pos = list(pos)
+        self.rect.center = (pos[0] // SUBPIXEL, pos[1] // SUBPIXEL)
+        self.held_directions = list(held_directions)
+        self.death_start_time = now - death_elapsed
 
     def get_grid_pos(self) -> tuple[int, int]:
         """プレイヤーの現在グリッド座標を返す。"""
@@ -537,39 +1649,359 @@ class Player(pg.sprite.Sprite):
     
     def start_death_animation(self) -> None:
         """
-        プレイヤーの死亡アニメーションを開始する。
-        残機を一つ減らし、死亡アニメーション後にリセットを行う。
+        プレイヤーの死亡アニメーションを開始する。
+        残機を一つ減らし、死亡アニメーション後にリセットを行う。
+        """
+        self.is_dying = True
+        self.lives -= 1
+        self.death_frame = 0
+        self.death_start_time = game_clock.now()
+        self.image = self.death_images[0]
+        self.schedule_death_frame()
+
+    def schedule_death_frame(self) -> None:
+        """死亡アニメーションの次のコマに進める予定を登録する(コマは death_duration を等分した時刻で切り替わる)。"""
+        frame_time = self.death_duration * (self.death_frame + 1) / len(self.death_images)
+        self.death_timer = scheduler.schedule_at(self.death_start_time + frame_time, self.update_death_animation)
+    
+    def update_death_animation(self) -> None:
+        """
+        死亡アニメーションを1コマ進める(scheduler から呼ばれる)。アニメ終了後は残機を確認し、ゲームオーバーか
+        リスポーンかを判定する。
+        """
+        self.death_frame += 1
+        if self.death_frame < len(self.death_images):
+            self.image = self.death_images[self.death_frame]
+            self.schedule_death_frame()
+        else:
+            self.is_dying = False
+            if self.lives <= 0:
+                self.game_over = True
+                return
+            
+            self.death_frame = 0
+            self.image = self.original_images[0]
+            self.reset_position()
+            if Enemy.enemies_group:
+                for enemy in Enemy.enemies_group:
+                    enemy.reset(enemy.start_delay)
+
+
+class PathCache:
+    """
+    敵の経路探索の結果を (開始座標, 目標座標) ごとに覚えておく、大きさに上限のあるLRUキャッシュ。
+    全ての敵で共有し、別のマップの探索を頼まれたら捨てる。
+    経路は Map.find_paths の結果で、途中のセルから同じ目標への経路は元の経路の後半と一致するため、
+    開始座標がキャッシュした経路の上にあれば探索せずにその後半を返す。
+    これは、Map.find_paths の経路がマップと目標だけで決まることに依存している(幅優先探索の距離は
+    探索をどこで打ち切っても同じで、次のセルは get_neighbors の決まった順で最初に距離が1減るセルを選ぶ)。
+    同じ距離の候補を乱数や探索の順番で選ぶように変えると、後半を返した経路が新しく探索した経路と
+    一致しなくなり、スレッドの有無やキャッシュの中身で進行が変わるので、その場合はこのキャッシュも直すこと。
+    この性質により、どの経路を返すかはキャッシュの中身によらないので、スナップショットには含めなくてよい。
+    探索スレッドとメインスレッドの両方から使うのでロックで守る。
+    """
+    def __init__(self, max_cells: int = 50000) -> None:
+        self.max_cells = max_cells  # キャッシュした経路のセル数の合計の上限
+        self.lock = threading.Lock()
+        self.clear()
+
+    def clear(self) -> None:
+        """キャッシュを捨てる。"""
+        self.map_data = None
+        self.paths: OrderedDict[tuple, tuple] = OrderedDict()  # (開始, 目標) -> 経路(古い順)
+        self.cells: dict[tuple, dict] = {}  # 目標 -> {経路上のセル: (paths のキー, 経路中の位置)}
+        self.size = 0
+
+    def lookup(self, start: tuple[int, int], goal: tuple[int, int]) -> list | None:
+        """start から goal への経路をキャッシュから返す(無ければ None)。ロックを取ってから呼ぶこと。"""
+        found = self.cells.get(goal, {}).get(start)
+        if found is None:
+            return None
+        key, index = found
+        self.paths.move_to_end(key)
+        return list(self.paths[key][index:])
+
+    def store(self, start: tuple[int, int], goal: tuple[int, int], path: list) -> None:
+        """経路を覚え、上限を超えたら古いものから捨てる。ロックを取ってから呼ぶこと。"""
+        key = (start, goal)
+        if key in self.paths:
+            return
+        path = tuple(path)
+        self.paths[key] = path
+        self.size += max(1, len(path))
+        cells = self.cells.setdefault(goal, {})
+        # 目標のセルは経路の後半にならないので除く。到達できない場合は空の経路を start で引けるようにする
+        for index, cell in enumerate(path[:-1] or (start,)):
+            cells[cell] = (key, index)
+        while self.size > self.max_cells and len(self.paths) > 1:
+            self.evict()
+
+    def evict(self) -> None:
+        """最も長く使っていない経路を捨てる。"""
+        key, path = self.paths.popitem(last=False)
+        self.size -= max(1, len(path))
+        cells = self.cells[key[1]]
+        for cell in path or key[:1]:
+            if cells.get(cell, (None,))[0] == key:
+                del cells[cell]
+        if not cells:
+            del self.cells[key[1]]
+
+    def find_paths(self, map_data: 'Map', starts: list[tuple[int, int]], goal: tuple[int, int],
+                   counts: list[int] | None = None) -> list[list]:
+        """
+        Map.find_paths と同じ経路を、キャッシュにあるものは探索せずに返す。
+        
+        引数:
+            map_data (Map): マップ
+            starts (list[tuple[int, int]]): 開始座標のリスト
+            goal (tuple[int, int]): 目標座標
+            counts (list[int] | None): 渡すと [展開したノード数, キューへの追加数, キャッシュから返した経路数] に加算する
+        戻り値:
+            list[list]: starts と同じ順の経路リスト(到達できない場合は空リスト)
+        """
+        with self.lock:
+            if map_data is not self.map_data:
+                self.clear()
+                self.map_data = map_data
+            paths = [[] if start == goal else self.lookup(start, goal) for start in starts]
+        missing = [start for start, path in zip(starts, paths) if path is None]
+        if counts is not None:
+            counts[2] += len(starts) - len(missing)
+        if not missing:
+            return paths
+        found = dict(zip(missing, map_data.find_paths(missing, goal, counts)))
+        with self.lock:
+            if map_data is self.map_data:
+                for start, path in found.items():
+                    self.store(start, goal, path)
+        return [found[start] if path is None else path for start, path in zip(starts, paths)]
+
+
+path_cache = PathCache()
+
+
+class PathStats:
+    """
+    敵のAI(経路探索と目標座標の計算)のコストを、敵ごとと全体で数えるクラス。
+    探索は path_planner の結果を受け取る時(メインスレッド)に記録する。
+    同じ目標の敵をまとめた1回の探索は、全体では1回として数え、参加した敵それぞれにも
+    その探索のノード数を加える。キャッシュから返した経路数は参加した敵で分け合い、敵ごとの合計が全体と一致するようにする。
+    pincer・random は経路探索の目標を決めた時だけ数える(デバッグ表示で目標を見ても数えない)。dump_file を指定すると dump_every 秒ごとにJSONで書き出す。
+
+    数える項目(COUNTERS):
+        searches:     経路探索の回数
+        failures:     目標に到達できなかった回数(開始座標が目標と同じ場合は除く)
+        expanded:     展開したノード数
+        pushes:       幅優先探索のキューに追加した数
+        cache_hits:   探索せずに path_cache から返した経路の数
+        path_length:  見つかった経路の長さ(マス数)の合計
+        max_expanded: 1回の探索で展開したノード数の最大値(暴走した探索の検出用)
+        pincer:       get_pincer_position の呼び出し回数
+        pincer_scan:  get_pincer_position が近くの通路を探して調べたセル数
+        random:       get_random_position の呼び出し回数
+    """
+    COUNTERS = ("searches", "failures", "expanded", "pushes", "cache_hits", "path_length", "max_expanded",
+                "pincer", "pincer_scan", "random")
+
+    def __init__(self, dump_file: str | None = None, dump_every: float = 5.0) -> None:
+        self.dump_file = dump_file
+        self.dump_every = dump_every
+        self.last_dump = time.monotonic()
+        self.reset()
+
+    def reset(self) -> None:
+        """集計をリセットする。"""
+        self.total = dict.fromkeys(self.COUNTERS, 0)
+        self.enemies: dict[int, dict[str, int]] = {}
+
+    def counters(self, enemy_id: int) -> dict[str, int]:
+        """敵ごとの集計(無ければ作る)を返す。"""
+        if enemy_id not in self.enemies:
+            self.enemies[enemy_id] = dict.fromkeys(self.COUNTERS, 0)
+        return self.enemies[enemy_id]
+
+    def record_search(self, enemy_ids: list[int], starts: list[tuple[int, int]], goal: tuple[int, int],
+                      paths: list[list], counts: list[int]) -> None:
+        """
+        1回の経路探索(複数の敵をまとめたものを含む)を記録する。
+        
+        引数:
+            enemy_ids (list[int]): 探索した敵の番号
+            starts (list[tuple[int, int]]): 敵ごとの開始座標
+            goal (tuple[int, int]): 目標座標
+            paths (list[list]): 敵ごとの経路
+            counts (list[int]): [展開したノード数, 追加数, キャッシュから返した経路数]
+        """
+        expanded, pushes, cache_hits = counts
+        total = self.total
+        total["searches"] += 1
+        total["expanded"] += expanded
+        total["pushes"] += pushes
+        total["cache_hits"] += cache_hits
+        total["max_expanded"] = max(total["max_expanded"], expanded)
+        share, extra = divmod(cache_hits, len(enemy_ids))
+        for i, (enemy_id, start, path) in enumerate(zip(enemy_ids, starts, paths)):
+            stats = self.counters(enemy_id)
+            stats["cache_hits"] += share + (i < extra)
+            stats["searches"] += 1
+            stats["expanded"] += expanded
+            stats["pushes"] += pushes
+            stats["max_expanded"] = max(stats["max_expanded"], expanded)
+            if path:
+                stats["path_length"] += len(path) - 1
+                total["path_length"] += len(path) - 1
+            elif start != goal:
+                stats["failures"] += 1
+                total["failures"] += 1
+
+    def record(self, enemy_id: int, name: str, amount: int = 1) -> None:
+        """
+        敵ごとと全体の項目 name に amount を加える。
+        
+        引数:
+            enemy_id (int): 敵の番号
+            name (str): 項目名(COUNTERS のいずれか)
+            amount (int): 加える値
+        """
+        self.total[name] += amount
+        self.counters(enemy_id)[name] += amount
+
+    def get(self, enemy_id: int | None = None) -> dict[str, int]:
+        """
+        集計のコピーを返す。
+        
+        引数:
+            enemy_id (int | None): 敵の番号。None なら全体
+        戻り値:
+            dict[str, int]: 項目名 -> 値
+        """
+        return dict(self.total if enemy_id is None else self.counters(enemy_id))
+
+    def as_dict(self) -> dict:
+        """全体と敵ごとの集計をJSONにできる辞書で返す。"""
+        return {
+            "total": dict(self.total),
+            "enemies": {str(enemy_id): dict(stats) for enemy_id, stats in sorted(self.enemies.items())},
+        }
+
+    def dump(self, path: str | None = None) -> None:
+        """
+        集計をJSONファイルに書き出す(書きかけのファイルが読まれないように置き換える)。
+        
+        引数:
+            path (str | None): 書き出し先。None なら dump_file
+        """
+        path = path or self.dump_file
+        with open(path + ".tmp", 'w') as f:
+            json.dump(self.as_dict(), f, indent=2)
+        os.replace(path + ".tmp", path)
+
+    def maybe_dump(self) -> None:
+        """dump_file が指定されていて、前回から dump_every 秒たっていれば書き出す。1フレームに1回呼ぶ。"""
+        if self.dump_file and time.monotonic() - self.last_dump >= self.dump_every:
+            self.last_dump = time.monotonic()
+            self.dump()
+
+
+path_stats = PathStats()
+
+
+class PathPlanner:
+    """
+    敵の経路探索を描画と別のスレッドで行うクラス。
+    request で (敵, 開始座標, 目標座標) の探索を受け付け、結果は次のティックの collect で敵に渡す。
+    探索は Map(ゲーム中に書き換えない)を読むだけなので、そのまま別スレッドから使える。
+    スレッドを使わない設定や、スレッドが使えない環境(ブラウザ版など)では request の時にその場で探索する。
+    wait_budget が None なら collect は終わるまで待ち、結果は常にちょうど1ティック後に渡すため、
+    スレッドを使うかどうかでゲームの進行は変わらない(PacmanEnv やスナップショットの再生はこちら)。
+    wait_budget に秒数を指定すると collect はその時間までしか待たず、終わっていない探索は次のティックに回す。
+    その間、敵は今の経路を進み続けるので長い探索でもフレームは止まらないが、探索が間に合わなかった時だけ
+    受け取るティックが実行時間で変わり、スレッドを使わない場合と進行がずれる(画面のあるゲームで使う)。
+    """
+    def __init__(self, threaded: bool = True, wait_budget: float | None = None) -> None:
+        self.threaded = threaded
+        self.wait_budget = wait_budget
+        self.executor = None
+        self.jobs = []  # (探索結果の Future または経路のリスト, 依頼内容)
+
+    def request(self, map_data: 'Map', enemies: list['Enemy'], starts: list[tuple[int, int]],
+                goal: tuple[int, int]) -> None:
+        """
+        同じ目標を目指す敵の経路探索を依頼する。
+        
+        引数:
+            map_data (Map): マップ
+            enemies (list[Enemy]): 依頼する敵
+            starts (list[tuple[int, int]]): 敵ごとの開始座標
+            goal (tuple[int, int]): 目標座標
         """
-        self.is_dying = True
-        self.lives -= 1
-        self.death_frame = 0
-        self.death_timer = 0
-        self.death_start_time = time.time()
-        self.image = self.death_images[0]
-    
-    def update_death_animation(self) -> None:
+        order = (map_data, goal, tuple(starts), tuple((enemy, enemy.plan_id) for enemy in enemies))
+        for enemy in enemies:
+            enemy.planning = True
+        self.jobs.append(self.submit(map_data, starts, goal) + (order,))
+
+    def submit(self, map_data: 'Map', starts: list[tuple[int, int]], goal: tuple[int, int]) -> tuple:
         """
-        死亡アニメーションの進行を管理。アニメ終了後は残機を確認し、ゲームオーバーか
-        リスポーンかを判定する。
+        探索を始め、(結果の Future(スレッドを使わない場合は経路のリスト), 探索のコスト [展開数, 追加数, キャッシュの利用数]) を返す。
+        コストは探索が終わってから読むこと。探索は path_cache を通す。
+        """
+        counts = [0, 0, 0]
+        if self.threaded and self.executor is None:
+            try:
+                self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="planner")
+            except RuntimeError:
+                self.threaded = False
+        if self.threaded:
+            try:
+                return self.executor.submit(path_cache.find_paths, map_data, list(starts), goal, counts), counts
+            except RuntimeError:
+                self.threaded = False
+        return path_cache.find_paths(map_data, list(starts), goal, counts), counts
+
+    def collect(self) -> None:
         """
-        current_time = time.time()
-        time_elapsed = current_time - self.death_start_time
+        前のティックまでに依頼した探索の結果を敵に渡す。終わっていなければ wait_budget 秒まで待ち、
+        それでも終わらない探索(と、その後に依頼した探索)は次のティックに回す。
+        依頼後にリセットされた・食べられた敵の結果は捨てる。探索のコストは path_stats に記録する。
+        """
+        jobs, self.jobs = self.jobs, []
+        deadline = None if self.wait_budget is None else time.perf_counter() + self.wait_budget
+        for i, (job, counts, (_, goal, starts, members)) in enumerate(jobs):
+            if isinstance(job, Future):
+                try:
+                    paths = job.result(None if deadline is None else max(0.0, deadline - time.perf_counter()))
+                except TimeoutError:
+                    # 探索は依頼した順に1つずつ行うので、残りもまだ終わっていない。依頼の順を保って持ち越す
+                    self.jobs = jobs[i:]
+                    return
+            else:
+                paths = job
+            path_stats.record_search([enemy.enemy_id for enemy, _ in members], starts, goal, paths, counts)
+            for (enemy, plan_id), path in zip(members, paths):
+                if enemy.plan_id == plan_id:
+                    enemy.receive_path(path)
+
+    def clear(self) -> None:
+        """依頼中の探索を全て捨てる(レベルの開始時など)。"""
+        self.jobs = []
+
+    def get_state(self) -> tuple:
+        """スナップショット用に、依頼中の探索の内容を返す。"""
+        return tuple(order for _, _, order in self.jobs)
+
+    def set_state(self, state: tuple) -> None:
+        """
+        get_state で得た依頼をやり直す(探索結果は同じなので、1ティック後に同じ経路が渡される)。
         
-        frame_index = int((time_elapsed / self.death_duration) * len(self.death_images))
-        if frame_index < len(self.death_images):
-            self.image = self.death_images[frame_index]
-        else:
-            self.is_dying = False
-            if self.lives <= 0:
-                self.game_over = True
-                return
-            
-            self.death_frame = 0
-            self.image = self.original_images[0]
-            self.reset_position()
-            if Enemy.enemies_group:
-                for enemy in Enemy.enemies_group:
-                    enemy.reset(enemy.enemy_id)
+        引数:
+            state (tuple): get_state の戻り値
+        """
+        self.jobs = [self.submit(map_data, starts, goal) + ((map_data, goal, starts, members),)
+                     for map_data, goal, starts, members in state]
+
+
+path_planner = PathPlanner()
 
 
 class EnemyMode(Enum):
@@ -581,74 +2013,77 @@ class EnemyMode(Enum):
     WEAK = auto()
 
 
-class Enemy(pg.sprite.Sprite):
+class Enemy(GridMover, pg.sprite.Sprite):
     """
     敵キャラクター（ゴースト）を管理するクラス。
     追跡やテリトリーモード、弱体化モードなど、モードごとに行動を変化させる。
     """
     enemies_group: list['Enemy'] = []
+    lod_max_interval = 8  # プレイヤーから遠い敵の判断(経路探索・衝突判定)を何ティックに1回まで減らすか(1で無効)
 
     def __init__(self, enemy_id: int, player: 'Player', map_data: 'Map') -> None:
         super().__init__()
         self.enemy_id = enemy_id
         self.player = player
         self.map_data = map_data
-        Enemy.enemies_group.append(self)
+
+        # 5体目以降は1〜4体目の見た目・行動パターンを順に繰り返す
+        self.personality = (enemy_id - 1) % 4 + 1
 
         image_idex = [0, 4, 5, 7]
         
-        self.normal_image_base = pg.transform.scale(
-            pg.image.load(f"fig/{image_idex[enemy_id-1]}.png").convert_alpha(), 
-            (ENEMY_SIZE, ENEMY_SIZE)
-        )
+        self.normal_image_base = load_image(f"fig/{image_idex[self.personality-1]}.png", (ENEMY_SIZE, ENEMY_SIZE))
         self.normal_image_lst = {
             (-1, 0): self.normal_image_base,
-            (1, 0): pg.transform.flip(self.normal_image_base, True, False),
+            (1, 0): transform_image(self.normal_image_base, flip=True),
             (0, -1): self.normal_image_base,
-            (0, 1): pg.transform.rotozoom(self.normal_image_base, 90, 1)
+            (0, 1): transform_image(self.normal_image_base, 90)
         }
         self.initial_direction = (1, 0)
         self.normal_image = self.normal_image_lst[self.initial_direction]
 
         self.weak_images = [
-            pg.transform.scale(pg.image.load("fig/chicken.png").convert_alpha(), (ENEMY_SIZE, ENEMY_SIZE)),
-            pg.transform.scale(pg.image.load("fig/food_christmas_chicken.png").convert_alpha(), (ENEMY_SIZE, ENEMY_SIZE)),
-            pg.transform.scale(pg.image.load("fig/chicken_honetsuki.png").convert_alpha(), (ENEMY_SIZE, ENEMY_SIZE)),
+            load_image("fig/chicken.png", (ENEMY_SIZE, ENEMY_SIZE)),
+            load_image("fig/food_christmas_chicken.png", (ENEMY_SIZE, ENEMY_SIZE)),
+            load_image("fig/chicken_honetsuki.png", (ENEMY_SIZE, ENEMY_SIZE)),
         ]
         self.current_weak_image = None
 
-        self.eaten_image = pg.transform.scale(
-            pg.image.load("fig/pet_hone.png").convert_alpha(), 
-            (ENEMY_SIZE, ENEMY_SIZE)
-        )
+        self.eaten_image = load_image("fig/pet_hone.png", (ENEMY_SIZE, ENEMY_SIZE))
         
         self.image = self.normal_image
         self.rect = self.image.get_rect()
         
         # 初期位置の設定
         self.start_pos = map_data.enemy_start_positions[enemy_id-1]
-        self.rect.center = get_pixel_pos(*self.start_pos)
+        self.place(get_pixel_pos(*self.start_pos))
         
-        # 移動関連
-        self.default_speed = 2
+        # 移動関連(速度は1ティックあたりのサブピクセル数)
+        self.default_speed = 2 * SUBPIXEL
         self.speed = self.default_speed
         self.current_path = []
         self.moving = False
         self.direction = self.initial_direction
+        self.planning = False  # 経路探索を依頼して結果を待っている
+        self.plan_id = 0       # 依頼した探索の番号(リセット時に増やし、古い結果を捨てる)
+        self.lod_wait = 0      # 次に判断するまでの、移動だけを行うティック数
         
-        # スタート時の遅延
-        self.start_delay = enemy_id * 1
-        self.game_start_time = time.time()
+        # スタート時の遅延(start_level で開始する)
+        self.start_delay = self.personality * 1
         self.can_move = False
         
         # モード関連
         self.mode = EnemyMode.CHASE
-        self.mode_timer = time.time()
         self.chase_duration = 15
         self.territory_duration = 4
         self.weak_duration = 10
-        self.weak_start_time = 0
         self.is_eaten = False
+
+        # scheduler に登録した予定
+        self.wake_timer = None  # 止まっている敵が動き出す(スタート・再スタート・復活)
+        self.mode_timer = None  # CHASE と TERRITORY の切り替え
+        self.weak_timer = None  # WEAK モードの終了
+        self.pause_timer = None  # 食べられた直後の一時停止の終了
         
         self.territory_corners = [
             (1, 1), 
@@ -656,151 +2091,230 @@ class Enemy(pg.sprite.Sprite):
             (map_data.width-2, 1),
             (map_data.width-2, map_data.height-2)
         ]
-        self.current_corner = self.enemy_id - 1
+        self.current_corner = self.personality - 1
         self.revive_delay = 3
-        self.revive_start_time = 0
-        self.is_reviving = False
-        self.restart_delay = 0
-        self.restart_start_time = 0
-        self.is_restarting = False
+        self.eaten_pause = 1  # 食べられた直後にゲーム全体を止める秒数
 
         self.eaten_after = False
 
+    def start(self) -> None:
+        """レベルの開始時に、スタート時の遅延とモード切り替えのタイマーを始める。"""
+        self.start_mode_cycle()
+        self.wait(self.start_delay)
+
+    def wait(self, delay: float) -> None:
+        """
+        delay 秒間止まり、その後に動き出す。
+        
+        引数:
+            delay (float): 止まっている秒数
+        """
+        self.can_move = False
+        if self.wake_timer is not None:
+            self.wake_timer.cancel()
+        self.wake_timer = scheduler.schedule(delay, self.wake)
+
+    def wake(self) -> None:
+        """止まっていた敵を動き出させる(scheduler から呼ばれる)。"""
+        self.can_move = True
+
+    def start_mode_cycle(self) -> None:
+        """CHASE モードから、CHASE と TERRITORY の切り替えを始め直す。"""
+        self.mode = EnemyMode.CHASE
+        if self.mode_timer is not None:
+            self.mode_timer.cancel()
+        self.mode_timer = scheduler.schedule(self.chase_duration, self.switch_mode)
+
+    def switch_mode(self) -> None:
+        """CHASE と TERRITORY を切り替え、次の切り替えを予約する(scheduler から呼ばれる)。"""
+        if self.mode == EnemyMode.CHASE:
+            self.mode = EnemyMode.TERRITORY
+            duration = self.territory_duration
+        else:
+            self.mode = EnemyMode.CHASE
+            duration = self.chase_duration
+        self.mode_timer = scheduler.schedule(duration, self.switch_mode)
+
     def update(self) -> None:
         """
-        敵の状態を更新する。モードの切り替え、A*経路探索、プレイヤー衝突判定など。
+        敵の状態を更新する。経路探索、プレイヤー衝突判定など。
+        モードの切り替えなどのタイマーは scheduler(update_game から進める)が処理する。
         """
-        current_time = time.time()
-        if self.is_reviving:
-            if current_time - self.revive_start_time >= self.revive_delay:
-                self.is_reviving = False
-                self.can_move = True
-            else:
-                return
+        Enemy.update_all([self])
 
-        if self.is_restarting:
-            if current_time - self.restart_start_time >= self.restart_delay:
-                self.is_restarting = False
-                self.can_move = True
-            else:
-                return
-        
-        if self.eaten_after:
-            # 敵が食べられたあとの一時停止
-            time.sleep(1)
-            self.eaten_after = False
-        
-        # スタート時の遅延
-        if not self.can_move and not self.is_reviving and not self.is_restarting:
-            if current_time - self.game_start_time >= self.start_delay:
-                self.can_move = True
-            else:
-                return
+    @classmethod
+    def update_all(cls, enemies) -> None:
+        """
+        全ての敵をまとめて1ステップ更新する。
+        状態更新 → 経路の受け取りと探索の依頼 → 移動・衝突判定 の順に全員分を処理する。
+        経路探索は同じ目標を目指す敵同士で1回の探索にまとめて path_planner に依頼し、
+        結果は次のティックで受け取る(それまでは今の経路を進み続ける)。
+        プレイヤーから遠い敵は get_lod_interval ティックに1回だけ判断(目標の決定・経路探索・衝突判定)し、
+        間のティックは経路に沿った移動だけを行う。間隔はその間にプレイヤーに触れられない長さにするので、
+        衝突を見逃すことはない。経路が途切れた敵はすぐに判断に戻す。
+        ただし目標を決めるティックが変わるため、敵の動きは間引かない場合と同じにはならない
+        (比べられる再現実行には lod_max_interval を1にする。--no-lod は Enemy のクラス属性を、
+        PacmanEnv(lod=False) はその環境の敵のインスタンス属性を変える)。
+
+        引数:
+            enemies (Iterable[Enemy]): 更新する敵
+        """
+        active = [enemy for enemy in enemies if enemy.update_state()]
+
+        # 前のティックで依頼した経路を受け取り、新たな探索を依頼する(目標座標ごとにまとめる)
+        path_planner.collect()
+        requests = {}
+        deciding = []
+        for enemy in active:
+            if enemy.lod_wait > 0 and (enemy.moving or enemy.planning):
+                enemy.lod_wait -= 1
+                continue
+            interval = enemy.get_lod_interval()
+            enemy.lod_wait = interval - 1
+            deciding.append(enemy)
+            goal = enemy.get_plan_goal(enemy.get_cells_per_ticks(interval))
+            if goal is not None:
+                requests.setdefault(goal, []).append(enemy)
+        for goal, group in requests.items():
+            path_planner.request(group[0].map_data, group, [enemy.get_plan_start() for enemy in group], goal)
+
+        # 移動(全員毎ティック)と衝突判定(このティックに判断する敵だけ)
+        for enemy in active:
+            enemy.move()
+        for enemy in deciding:
+            enemy.check_collision()
+
+    def update_state(self) -> bool:
+        """
+        このフレームに行動するかを返す。
+        モードやタイマーの更新は scheduler から呼ばれるため、ここでは時刻を調べない。
+
+        戻り値:
+            bool: このフレームに行動する(経路探索・移動する)なら True
+        """
+        return self.can_move
+
+    def end_eaten_pause(self) -> None:
+        """食べられた直後の一時停止を終える(scheduler から呼ばれる)。"""
+        self.eaten_after = False
+        self.pause_timer = None
+
+    def get_lod_interval(self) -> int:
+        """
+        次に判断するまでのティック数を返す(1なら毎ティック)。
+        衝突は矩形の重なりで、敵(ENEMY_SIZE)はマスより大きいため、中心のマスが離れていても重なる。
+        中心がいるマスの差が x・y ともに2以下(マンハッタン距離4以下)なら重なりうるが、どちらかが3以上なら
+        中心の差は41ピクセル以上になり、重なる範囲((PLAYER_SIZE + ENEMY_SIZE) / 2 = 25ピクセル未満)を超える。
+        つまり重ならないと言えるのはマンハッタン距離5以上のときだけで、Map.distance はその下限になる。
+        1ティックに進むのは敵もプレイヤーも1マス(トンネルのワープを含む)以内なので、距離は1ティックに
+        2マスまでしか縮まない。今の距離が d なら、次の判断までに省く n - 1 ティックの間の距離は
+        d - 2(n - 1) 以上で、これが5以上になる n = (d - 3) // 2 までなら衝突を見逃さない。
+        d が7未満ではこの値が1以下になり、間引かない(重なりうる距離に近づく前に毎ティックの判断に戻る)。
+        食べられた敵は家に着いたことを毎ティック調べるため、常に1を返す。
+        """
+        if self.is_eaten or self.eaten_after or self.lod_max_interval <= 1:
+            return 1
+        distance = self.map_data.distance(self.get_grid_pos(), self.player.get_grid_pos())
+        return max(1, min(self.lod_max_interval, (distance - 3) // 2))
+
+    def get_cells_per_ticks(self, ticks: int) -> int:
+        """今の速さで ticks ティックの間に進むマス数(切り上げ、1ティック目の残りを含む)を返す。"""
+        if ticks <= 1:
+            return 0
+        return -(-ticks * self.speed // (GRID_SIZE * SUBPIXEL))
+
+    def get_plan_goal(self, lookahead: int = 0) -> tuple[int, int] | None:
+        """
+        経路探索が必要なら目標座標を返す。探索の結果待ちや、経路の残りが lookahead + 2 マス以上あるなら None。
+        経路の最後の1マスを進んでいる間に次の探索を依頼しておき、止まらずに次の経路へつなぐ。
+        次に判断するまでに進む分(lookahead マス)だけ早めに依頼すれば、間引いた敵も止まらない。
+        食べられた状態では初期位置(ゴーストの家)が目標になる。
+        目標に行けない場合は、行ける中で目標に最も近いセルを返す。
+
+        引数:
+            lookahead (int): 次に判断するまでに進むマス数
+        """
+        if self.planning or (self.moving and len(self.current_path) > 1 + lookahead):
+            return None
+        if self.is_eaten:
+            goal = self.start_pos
+        elif self.can_move:
+            goal = self.get_target_position(record=True)
+        else:
+            return None
+        # 壁や行けないセルが目標のときは、行ける中で最も近いセルを目指す
+        return self.map_data.nearest_reachable(self.get_plan_start(), goal)
+
+    def get_plan_start(self) -> tuple[int, int]:
+        """経路探索の開始座標を返す。移動中なら今の経路の終点から探索する。"""
+        if self.moving and self.current_path:
+            return self.current_path[-1]
+        return self.get_grid_pos()
+
+    def receive_path(self, path: list) -> None:
+        """
+        依頼した経路探索の結果を受け取る(path_planner から呼ばれる)。
+        まだ今の経路を進んでいれば、その終点から続けて進む。
         
-        # 食べられた状態
+        引数:
+            path (list): 経路(到達できない場合は空リスト)
+        """
+        self.planning = False
+        if self.moving and self.current_path:
+            self.current_path.extend(path[1:])
+        else:
+            self.current_path = path
+            self.moving = bool(path)
+            if not path and self.mode == EnemyMode.TERRITORY:
+                # もう角(に最も近いセル)にいるので次の角へ
+                self.current_corner = (self.current_corner + 1) % len(self.territory_corners)
+
+    def cancel_plan(self) -> None:
+        """依頼中の経路探索の結果を捨てる。"""
+        self.plan_id += 1
+        self.planning = False
+
+    def check_collision(self) -> None:
+        """
+        移動後の判定を行う。食べられた敵は初期位置に戻ったら復活し、
+        それ以外はプレイヤーとの衝突を判定する。
+        """
         if self.is_eaten:
-            if not self.moving:
-                self.current_path = self.find_path(self.get_grid_pos(), self.start_pos)
-                if self.current_path:
-                    self.moving = True
-            self.move()
             if self.get_grid_pos() == self.start_pos:
                 self.revive()
             return
-        
-        # 通常モード(CHASE or TERRITORY)
-        if self.mode != EnemyMode.WEAK:
-            if self.mode == EnemyMode.CHASE and current_time - self.mode_timer > self.chase_duration:
-                self.mode = EnemyMode.TERRITORY
-                self.mode_timer = current_time
-            elif self.mode == EnemyMode.TERRITORY and current_time - self.mode_timer > self.territory_duration:
-                self.mode = EnemyMode.CHASE
-                self.mode_timer = current_time
-        else:
-            # WEAKモード
-            if current_time - self.weak_start_time > self.weak_duration:
-                self.mode = EnemyMode.CHASE
-                self.image = self.normal_image_lst[self.initial_direction]
-                self.speed = self.default_speed
-        
-        # 経路探索
-        if not self.moving and self.can_move:
-            target = self.get_target_position()
-            self.current_path = self.find_path(self.get_grid_pos(), target)
-            if self.current_path:
-                self.moving = True
-        
-        # 移動
-        self.move()
-        
-        # プレイヤー衝突判定
+
         if pg.sprite.collide_rect(self, self.player):
-            if self.mode == EnemyMode.WEAK and not self.is_eaten:
+            if self.mode == EnemyMode.WEAK:
                 self.get_eaten()
-            elif self.mode != EnemyMode.WEAK and not self.is_eaten:
+            elif not self.player.is_dying:
                 self.player.start_death_animation()
 
-    def get_target_position(self) -> tuple[int, int]:
+    def get_target_position(self, record: bool = False) -> tuple[int, int]:
         """
         敵が次に向かうターゲット座標を決定する。
         通常モード(CHASE/TERRITORY)の場合とWEAKモードの場合で処理が異なる。
+
+        引数:
+            record (bool): True なら path_stats に数える(経路探索の目標を決める時)
         """
         if self.mode == EnemyMode.WEAK:
-            return self.get_random_position()
+            return self.get_random_position(record)
         
         if self.mode == EnemyMode.TERRITORY:
             return self.territory_corners[self.current_corner]
         
-        # CHASEモード時の行動パターンはenemy_idにより変化
+        # CHASEモード時の行動パターンはpersonality(enemy_idから決まる)により変化
         player_pos = self.player.get_grid_pos()
-        if self.enemy_id == 1:
+        if self.personality == 1:
             return player_pos
-        elif self.enemy_id == 2:
+        elif self.personality == 2:
             return self.get_position_ahead(player_pos, 4)
-        elif self.enemy_id == 3:
-            return self.get_pincer_position()
-        else:  # enemy_id == 4
-            distance = self.calculate_distance(self.get_grid_pos(), player_pos)
-            return player_pos if distance > 8 else self.get_random_position()
-
-    def find_path(self, start: tuple[int, int], goal: tuple[int, int]) -> list:
-        """
-        A* アルゴリズムを用いて、start から goal までの最短経路を求める。
-        
-        引数:
-            start (tuple[int, int]): 開始座標
-            goal (tuple[int, int]): 目標座標
-        戻り値:
-            list: 最短経路を構成する座標のリスト
-        """
-        def heuristic(a: tuple[int, int], b: tuple[int, int]) -> int:
-            return abs(a[0] - b[0]) + abs(a[1] - b[1])
-        
-        frontier = []
-        heapq.heappush(frontier, (0, start))
-        came_from = {start: None}
-        cost_so_far = {start: 0}
-        
-        while frontier:
-            current = heapq.heappop(frontier)[1]
-            if current == goal:
-                break
-            
-            for next_pos in self.get_neighbors(current):
-                new_cost = cost_so_far[current] + 1
-                if next_pos not in cost_so_far or new_cost < cost_so_far[next_pos]:
-                    cost_so_far[next_pos] = new_cost
-                    priority = new_cost + heuristic(next_pos, goal)
-                    heapq.heappush(frontier, (priority, next_pos))
-                    came_from[next_pos] = current
-        
-        path = []
-        current = goal
-        while current is not None:
-            path.append(current)
-            current = came_from.get(current)
-        path.reverse()
-        return path if len(path) > 1 else []
+        elif self.personality == 3:
+            return self.get_pincer_position(record)
+        else:  # personality == 4
+            distance = self.map_data.distance(self.get_grid_pos(), player_pos)
+            return player_pos if distance > 8 else self.get_random_position(record)
 
     def move(self) -> None:
         """
@@ -811,33 +2325,33 @@ class Enemy(pg.sprite.Sprite):
         
         next_pos = self.current_path[0]
         target = get_pixel_pos(*next_pos)
-        current_pos = pg.math.Vector2(self.rect.center)
-        target_pos = pg.math.Vector2(target)
-        
-        move_vector = target_pos - current_pos
-        distance = move_vector.length()
-        
-        if distance <= self.speed:
-            self.rect.center = target
+
+        # トンネルの組の間はワープする
+        if self.map_data.tunnel_pairs.get(self.get_grid_pos()) == next_pos:
+            self.place(target)
+            self.current_path.pop(0)
+            if not self.current_path:
+                self.moving = False
+            return
+
+        dx = target[0] * SUBPIXEL - self.pos[0]
+        dy = target[1] * SUBPIXEL - self.pos[1]
+        if self.step_towards(target, self.speed):
             self.current_path.pop(0)
             if not self.current_path:
                 self.moving = False
                 if self.mode == EnemyMode.TERRITORY:
-                    self.current_corner = (self.current_corner + 1) % 4
+                    self.current_corner = (self.current_corner + 1) % len(self.territory_corners)
         else:
-            if move_vector.length() > 0:
-                move_vector = move_vector.normalize() * self.speed
-                self.rect.center = tuple(current_pos + move_vector)
-
-                # 移動方向
-                if abs(move_vector.x) > abs(move_vector.y):
-                    self.direction = (1 if move_vector.x > 0 else -1, 0)
-                else:
-                    self.direction = (0, 1 if move_vector.y > 0 else -1)
+            # 移動方向
+            if abs(dx) > abs(dy):
+                self.direction = (1 if dx > 0 else -1, 0)
+            else:
+                self.direction = (0, 1 if dy > 0 else -1)
 
-                # 画像の向き
-                if self.direction in self.normal_image_lst and not self.is_eaten and self.mode != EnemyMode.WEAK:
-                    self.image = self.normal_image_lst[self.direction]
+            # 画像の向き
+            if self.direction in self.normal_image_lst and not self.is_eaten and self.mode != EnemyMode.WEAK:
+                self.image = self.normal_image_lst[self.direction]
 
     def make_weak(self) -> None:
         """
@@ -845,11 +2359,21 @@ class Enemy(pg.sprite.Sprite):
         """
         if not self.is_eaten:
             self.mode = EnemyMode.WEAK
-            self.weak_start_time = time.time()
+            # WEAK の間は CHASE と TERRITORY の切り替えを止め、終了の予定を取り直す
+            for timer in (self.mode_timer, self.weak_timer):
+                if timer is not None:
+                    timer.cancel()
+            self.weak_timer = scheduler.schedule(self.weak_duration, self.end_weak)
             if self.current_weak_image is None:
                 self.current_weak_image = random.choice(self.weak_images)
             self.image = self.current_weak_image
-            self.speed = self.default_speed * 0.8
+            self.speed = self.default_speed * 4 // 5
+
+    def end_weak(self) -> None:
+        """WEAK モードを終えて CHASE モードに戻る(scheduler から呼ばれる)。"""
+        self.image = self.normal_image_lst[self.initial_direction]
+        self.speed = self.default_speed
+        self.start_mode_cycle()
 
     def get_eaten(self) -> None:
         """
@@ -857,24 +2381,24 @@ class Enemy(pg.sprite.Sprite):
         画像を食べられた用の画像に変え、リスポーン位置へ移動するまで速度を上げる。
         """
         self.is_eaten = True
+        if self.weak_timer is not None:
+            self.weak_timer.cancel()
         self.image = self.eaten_image
         self.speed = self.default_speed * 2
         self.current_path = []
         self.moving = False
+        self.cancel_plan()
+        # 一時停止の間は update_game がプレイヤーと敵を止める(ゲームループとタイマーは止めない)
         self.eaten_after = True
+        self.pause_timer = scheduler.schedule(self.eaten_pause, self.end_eaten_pause)
     
     def revive(self) -> None:
         """
         敵をリスポーンさせる。位置や状態を初期化し、少し待ってから追跡行動を再開する。
         """
         self.reset()
-        self.mode = EnemyMode.CHASE
-        self.mode_timer = time.time()
-        self.weak_start_time = 0
         self.is_eaten = False
-        self.is_reviving = True
-        self.revive_start_time = time.time()
-        self.can_move = False
+        self.wait(self.revive_delay)
     
     def reset(self, delay=0.0) -> None:
         """
@@ -883,41 +2407,79 @@ class Enemy(pg.sprite.Sprite):
         引数:
             delay (float): 再スタートまでの遅延秒数
         """
-        self.rect.center = get_pixel_pos(*self.start_pos)
+        self.place(get_pixel_pos(*self.start_pos))
+        self.speed = self.default_speed
+        self.current_path = []
+        self.moving = False
+        self.cancel_plan()
+        self.lod_wait = 0
+        self.direction = self.initial_direction
+        self.image = self.normal_image_lst[self.initial_direction]
+        if self.weak_timer is not None:
+            self.weak_timer.cancel()
+        if self.pause_timer is not None:
+            self.pause_timer.cancel()
+            self.end_eaten_pause()
+        self.start_mode_cycle()
+        self.current_weak_image = None
+        self.wait(delay)
+
+    def reset_level(self) -> None:
+        """
+        敵をレベル開始時の状態に戻す。画像などはそのまま使う。
+        タイマーは start_level で scheduler を空にしてから start で始める。
+        """
+        self.place(get_pixel_pos(*self.start_pos))
         self.speed = self.default_speed
         self.current_path = []
         self.moving = False
+        self.cancel_plan()
+        self.lod_wait = 0
         self.direction = self.initial_direction
         self.image = self.normal_image_lst[self.initial_direction]
         self.mode = EnemyMode.CHASE
-        self.mode_timer = time.time()
         self.current_weak_image = None
+        self.current_corner = self.personality - 1
         self.can_move = False
-        self.is_restarting = True
-        self.restart_delay = delay
-        self.restart_start_time = time.time()
+        self.is_eaten = False
+        self.eaten_after = False
+        self.wake_timer = None
+        self.mode_timer = None
+        self.weak_timer = None
+        self.pause_timer = None
 
-    def get_grid_pos(self) -> tuple[int, int]:
-        """敵の現在グリッド座標を返す。"""
-        return self.rect.centerx // GRID_SIZE, self.rect.centery // GRID_SIZE
+    def get_state(self) -> tuple:
+        """
+        スナップショット用に現在の状態をタプルで返す。タイマーの残り時間は scheduler 側で保存する。
+        
+        戻り値:
+            tuple: 状態
+        """
+        return (
+            tuple(self.pos), self.speed, tuple(self.current_path), self.moving, self.direction,
+            self.can_move, self.mode, self.current_corner, self.is_eaten, self.eaten_after,
+            self.current_weak_image, self.image, self.wake_timer, self.mode_timer, self.weak_timer,
+            self.pause_timer, self.planning, self.plan_id, self.lod_wait,
+        )
 
-    def get_neighbors(self, pos: tuple[int, int]) -> list[tuple[int, int]]:
+    def set_state(self, state: tuple) -> None:
         """
-        A*用の近傍ノードを返す。壁ではなくpathがTrueになっているセルが隣接セルとなる。
+        get_state で得た状態を復元する。
+        
+        引数:
+            state (tuple): 状態
         """
-        x, y = pos
-        neighbors = []
-        for dx, dy in [(-1, 0), (1, 0), (0, -1), (0, 1)]:
-            nx, ny = x + dx, y + dy
-            if (0 <= nx < self.map_data.width and 
-                0 <= ny < self.map_data.height and 
-                self.map_data.playfield[ny][nx]['path']):
-                neighbors.append((nx, ny))
-        return neighbors
+        (pos, self.speed, current_path, self.moving, self.direction,
+         self.can_move, self.mode, self.current_corner, self.is_eaten, self.eaten_after,
+         self.current_weak_image, self.image, self.wake_timer, self.mode_timer, self.weak_timer,
+         self.pause_timer, self.planning, self.plan_id, self.lod_wait) = state
+        self.pos = list(pos)
+        self.rect.center = (pos[0] // SUBPIXEL, pos[1] // SUBPIXEL)
+        self.current_path = list(current_path)
 
-    def calculate_distance(self, pos1: tuple[int, int], pos2: tuple[int, int]) -> int:
-        """マップ上の2点間のマンハッタン距離を返す。"""
-        return abs(pos1[0] - pos2[0]) + abs(pos1[1] - pos2[1])
+    def get_grid_pos(self) -> tuple[int, int]:
+        """敵の現在グリッド座標を返す。"""
+        return self.rect.centerx // GRID_SIZE, self.rect.centery // GRID_SIZE
 
     def get_position_ahead(self, pos: tuple[int, int], distance: int) -> tuple[int, int]:
         """
@@ -941,11 +2503,14 @@ class Enemy(pg.sprite.Sprite):
                     return (pos[0], new_y)
         return pos
 
-    def get_pincer_position(self) -> tuple[int, int]:
+    def get_pincer_position(self, record: bool = False) -> tuple[int, int]:
         """
         「挟み撃ち」ゴースト用のターゲット座標を計算する。
         他のゴーストの位置を参照し、プレイヤーと他ゴーストの座標から2倍先の位置を狙う。
+        record が True なら呼び出しと調べたセル数を path_stats に数える。
         """
+        if record:
+            path_stats.record(self.enemy_id, "pincer")
         if not Enemy.enemies_group or len(Enemy.enemies_group) < 1:
             return self.get_grid_pos()
         enemy1 = Enemy.enemies_group[0]
@@ -967,8 +2532,12 @@ class Enemy(pg.sprite.Sprite):
         min_distance = float('inf')
         best_pos = enemy1_pos
         
-        for y in range(max(0, target_y-2), min(self.map_data.height, target_y+3)):
-            for x in range(max(0, target_x-2), min(self.map_data.width, target_x+3)):
+        rows = range(max(0, target_y-2), min(self.map_data.height, target_y+3))
+        columns = range(max(0, target_x-2), min(self.map_data.width, target_x+3))
+        if record:
+            path_stats.record(self.enemy_id, "pincer_scan", len(rows) * len(columns))
+        for y in rows:
+            for x in columns:
                 if self.map_data.playfield[y][x]['path']:
                     dist = abs(x - target_x) + abs(y - target_y)
                     if dist < min_distance:
@@ -977,56 +2546,164 @@ class Enemy(pg.sprite.Sprite):
         
         return best_pos
 
-    def get_random_position(self) -> tuple[int, int]:
+    def get_random_position(self, record: bool = False) -> tuple[int, int]:
         """
         マップ内の通行可能セルからランダムに1つ選んで返す。
-        WEAKモードなど、ランダム移動に使用。
+        WEAKモードなど、ランダム移動に使用。record が True なら呼び出しを path_stats に数える。
         """
-        valid_positions = []
-        for y in range(self.map_data.height):
-            for x in range(self.map_data.width):
-                if self.map_data.playfield[y][x]['path']:
-                    valid_positions.append((x, y))
+        if record:
+            path_stats.record(self.enemy_id, "random")
+        valid_positions = self.map_data.path_cells
         return random.choice(valid_positions) if valid_positions else self.get_grid_pos()
 
 
-class Item(pg.sprite.Sprite):
+class Item:
     """
-    アイテム（エサ）を管理するクラス。衝突判定によりスコアを加算し自身を消滅する。
+    アイテム（エサ）1つ分の情報を持つクラス。
+    画像はエサの種類ごとに1枚だけ作って全てのエサで共有し、インスタンスは座標と種類のみを持つ。
     """
-    def __init__(self, grid_pos: tuple[int, int], item_type: int, score: 'Score') -> None:
-        super().__init__()
-        self.image = pg.Surface((GRID_SIZE, GRID_SIZE), pg.SRCALPHA)
+    __slots__ = ('grid_pos', 'item_type', 'rect')
+
+    color = (255, 105, 180)
+    radius = {1: 3, 2: 6}  # 1: 通常エサ, 2: パワーエサ
+    images: dict[tuple[int, float], pg.Surface] = {}
+
+    def __init__(self, grid_pos: tuple[int, int], item_type: int) -> None:
         self.grid_pos = grid_pos
         self.item_type = item_type
+        self.rect = pg.Rect(0, 0, GRID_SIZE, GRID_SIZE)
+        self.rect.center = get_pixel_pos(*grid_pos)
+
+    @property
+    def image(self) -> pg.Surface:
+        """エサの種類に対応する共有画像を返す。"""
+        return Item.get_image(self.item_type)
+
+    @classmethod
+    def get_image(cls, item_type: int, scale: float = 1) -> pg.Surface:
+        """
+        エサの種類・倍率ごとの画像を返す。初回だけ作成する(拡大縮小せずにその大きさで描く)。
+        View のキャッシュと同じく、倍率が変わったら前の倍率の画像は捨てる(論理解像度の画像だけは残す)。
+        
+        引数:
+            item_type (int): エサの種類(1: 通常エサ, 2: パワーエサ)
+            scale (float): 描画の倍率
+        戻り値:
+            pg.Surface: エサの画像
+        """
+        key = (item_type, scale)
+        if key not in cls.images:
+            for old_key in [old_key for old_key in cls.images if old_key[1] not in (1, scale)]:
+                del cls.images[old_key]
+            size = max(1, round(GRID_SIZE * scale))
+            image = pg.Surface((size, size), pg.SRCALPHA)
+            pg.draw.circle(image, cls.color, (size // 2, size // 2), max(1, round(cls.radius[item_type] * scale)))
+            cls.images[key] = image
+        return cls.images[key]
+
+
+class ItemGroup:
+    """
+    マップ上のエサをグリッド座標ごとに管理するクラス。
+    プレイヤーと重なるセルのエサだけを調べて衝突判定し、食べられたエサのスコアを加算する。
+    """
+    DIFF_BLOCK = 64  # changed_cells でまとめて比べるバイト数
+
+    def __init__(self, score: 'Score', width: int, height: int) -> None:
         self.score = score
-        self.eat_count = 0
+        self.width = width
+        self.items: dict[tuple[int, int], Item] = {}
+        self.all_items: dict[tuple[int, int], Item] = {}  # 食べられたものも含む全てのエサ
+        self.bitmap = bytearray(width * height)  # エサが残っているセルが1(スナップショット用)
+        self.initial_bitmap = b""  # レベル開始時のビットマップ(reset 用)
+
+    def add(self, item: Item) -> None:
+        """エサを追加する。"""
+        self.items[item.grid_pos] = item
+        self.all_items[item.grid_pos] = item
+        self.bitmap[item.grid_pos[1] * self.width + item.grid_pos[0]] = 1
+
+    def get_state(self) -> bytes:
+        """残っているエサのビットマップ(セルごとに1バイト)を返す。"""
+        return bytes(self.bitmap)
+
+    def changed_cells(self, bitmap: bytes) -> list[int]:
+        """
+        現在のビットマップと異なるセルの番号(y * 幅 + x)を返す。
+        DIFF_BLOCK バイトずつまとめて比べ(比較は C で行う)、違うブロックの中だけを1バイトずつ調べるので、
+        変わったセルが少なければマップ全体を Python で回さずに済む。
         
-        center_x = GRID_SIZE // 2
-        center_y = GRID_SIZE // 2
+        引数:
+            bitmap (bytes): get_state で得たビットマップ
+        戻り値:
+            list[int]: 異なるセルの番号(昇順)
+        """
+        current, other = memoryview(self.bitmap), memoryview(bitmap)
+        changed = []
+        for start in range(0, len(current), self.DIFF_BLOCK):
+            end = start + self.DIFF_BLOCK
+            if current[start:end] != other[start:end]:
+                changed.extend(index for index in range(start, min(end, len(current)))
+                               if current[index] != other[index])
+        return changed
+
+    def set_state(self, bitmap: bytes) -> None:
+        """
+        ビットマップからエサの状態を復元する。現在と異なるセルだけを書き換える。
+        
+        引数:
+            bitmap (bytes): get_state で得たビットマップ
+        """
+        for index in self.changed_cells(bitmap):
+            pos = (index % self.width, index // self.width)
+            if bitmap[index]:
+                self.items[pos] = self.all_items[pos]
+            else:
+                del self.items[pos]
+        self.bitmap[:] = bitmap
 
-        if self.item_type == 1: # 通常エサ
-            self.color = (255, 105, 180)
-            self.radius = 3
-            pg.draw.circle(self.image, self.color, (center_x, center_y), self.radius)
-        elif self.item_type == 2: # パワーエサ
-            self.color = (255, 105, 180)
-            self.radius = 6
-            pg.draw.circle(self.image, self.color, (center_x, center_y), self.radius)
+    def reset(self) -> None:
+        """エサをレベル開始時の配置に戻す(食べられたエサのオブジェクトを使い回す)。"""
+        self.set_state(self.initial_bitmap)
+
+    def __len__(self) -> int:
+        return len(self.items)
+
+    def __iter__(self):
+        return iter(list(self.items.values()))
+
+    def draw(self, screen: pg.Surface) -> list[pg.Rect]:
+        """
+        全てのエサを描画する。
         
-        self.rect = self.image.get_rect(center=get_pixel_pos(*grid_pos))
-    
-    def update(self, player: 'Player'):
+        引数:
+            screen (pg.Surface): 描画先
+        戻り値:
+            list[pg.Rect]: 描画した範囲
+        """
+        images = {item_type: Item.get_image(item_type, view.scale) for item_type in Item.radius}
+        return screen.blits([(images[item.item_type], view.point(item.rect.topleft)) for item in self.items.values()])
+
+    def update(self, player: 'Player') -> list[Item]:
         """
-        プレイヤーとの衝突を検知し、衝突した場合はスコアを加算して自身を削除する。
+        プレイヤーとの衝突を検知し、衝突したエサはスコアを加算して削除する。
         
         引数:
             player (Player): プレイヤーオブジェクト
+        戻り値:
+            list[Item]: 食べられたエサ
         """
-        if pg.sprite.collide_rect(self, player):
-            self.score.value += 20
-            self.kill()
-            self.eat_count += 1
+        eaten = []
+        rect = player.rect
+        for y in range(rect.top // GRID_SIZE, (rect.bottom - 1) // GRID_SIZE + 1):
+            for x in range(rect.left // GRID_SIZE, (rect.right - 1) // GRID_SIZE + 1):
+                item = self.items.get((x, y))
+                if item is not None and item.rect.colliderect(rect):
+                    self.score.value += 20
+                    del self.items[(x, y)]
+                    self.bitmap[y * self.width + x] = 0
+                    eaten.append(item)
+        return eaten
 
 
 class Score:
@@ -1034,87 +2711,321 @@ class Score:
     スコアを管理・表示するクラス。
     """
     def __init__(self):
-        self.font = pg.font.Font(None, 40)
         self.color = (255, 255, 255)
         self.value = 0
-        self.image = self.font.render(f"Score: {self.value}", 0, self.color)
-        self.rect = self.image.get_rect()
-        self.rect.center = WIDTH - 110, HEIGHT - 50
+        self.image = None  # draw のたびに描く(フォントと画像はメインスレッドで作る)
+        self.center = (WIDTH - 110, HEIGHT - 50)
 
-    def draw(self, screen: pg.Surface):
+    def draw(self, screen: pg.Surface) -> list[pg.Rect]:
         """
         スコアを画面右下に描画する。
         
         引数:
             screen (pg.Surface): メイン画面
+        戻り値:
+            list[pg.Rect]: 描画した範囲
         """
-        self.image = self.font.render(f"Score: {self.value}", 0, self.color)
-        screen.blit(self.image, self.rect)
+        self.image = view.font(40).render(f"Score: {self.value}", 0, self.color)
+        return [screen.blit(self.image, self.image.get_rect(center=view.point(self.center)))]
 
 
 class DebugInfo:
     """
-    デバッグ情報を表示するクラス。
-    プレイヤーや敵の位置、所要時間、アイテム状態などを描画する。
+    デバッグ情報を表示するクラス。
+    プレイヤーや敵の位置、所要時間、アイテム状態などを描画する。
+    """
+    def __init__(self, player: 'Player', enemies: pg.sprite.Group, baits: 'ItemGroup') -> None:
+        self.player = player
+        self.enemies = enemies
+        self.baits = baits
+        self.item_count = len(baits)
+        self.items_eaten = 0
+        self.enemy_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+        self.max_enemy_rows = 5  # アイテム情報と重ならずに表示できる敵の数
+
+    def update(self):
+        """フレームごとにデバッグ情報の更新を行う。"""
+        self.items_eaten = self.item_count - len(self.baits)
+
+    def draw(self, screen: pg.Surface) -> list[pg.Rect]:
+        """
+        画面右側に各種デバッグ情報を描画する。
+        
+        引数:
+            screen (pg.Surface): メイン画面
+        戻り値:
+            list[pg.Rect]: 描画した範囲
+        """
+        rects = []
+        font = view.font(30)
+        # プレイヤー情報
+        player_pos_text = font.render(f"Player Pos: {self.player.get_grid_pos()}", True, WHITE)
+        rects.append(screen.blit(player_pos_text, view.point((WIDTH - 500, 20))))
+        player_moving_text = font.render(f"Moving: {self.player.moving}", True, WHITE)
+        rects.append(screen.blit(player_moving_text, view.point((WIDTH - 500, 50))))
+        player_direction_text = font.render(f"Direction: {self.player.current_direction}", True, WHITE)
+        rects.append(screen.blit(player_direction_text, view.point((WIDTH - 500, 80))))
+
+        # 起動からの経過秒表示
+        elapsed_ms = pg.time.get_ticks()  
+        elapsed_sec = elapsed_ms / 1000
+        current_time_text = font.render(f"Time: {elapsed_sec:.2f}", True, WHITE)
+        rects.append(screen.blit(current_time_text, view.point((WIDTH - 500, 110))))
+
+        # 敵の情報(表示欄に収まる先頭の敵のみ)
+        for i, enemy in enumerate(self.enemies):
+            if i >= self.max_enemy_rows:
+                break
+            color = self.enemy_colors[i % len(self.enemy_colors)]
+            rects.append(screen.fill(color, view.rect((WIDTH - 500, 180 + i * 50, 20, 20))))
+
+            target_pos = enemy.get_target_position()
+            enemy_info_text = font.render(
+                f"Enemy {enemy.enemy_id}: {enemy.mode.name}, Moving: {enemy.moving}, Target: {target_pos}",
+                True, WHITE
+            )
+            rects.append(screen.blit(enemy_info_text, view.point((WIDTH - 480, 180 + i * 50))))
+
+            target_rect = view.rect(pg.Rect(get_pixel_pos(*target_pos), (10, 10)))
+            rects.append(pg.draw.rect(screen, color, target_rect))
+            if enemy.current_path and len(enemy.current_path) >= 2:
+                points = [view.point(get_pixel_pos(*pos)) for pos in enemy.current_path]
+                rects.append(pg.draw.lines(screen, color, False, points, max(1, round(3 * view.scale))))
+
+        # アイテム情報
+        item_count_text = font.render(f"Total Items: {self.item_count}", True, WHITE)
+        rects.append(screen.blit(item_count_text, view.point((WIDTH - 500, 450))))
+        items_eaten_text = font.render(f"Items Eaten: {self.items_eaten}", True, WHITE)
+        rects.append(screen.blit(items_eaten_text, view.point((WIDTH - 500, 480))))
+        return rects
+
+
+class DirtyRegions:
+    """
+    ゲーム画面の書き換えた範囲(ダーティ矩形)を管理するクラス。
+    前フレームで描いた範囲を背景で消してから描き直し、変化した範囲だけを画面に反映する。
+    """
+    def __init__(self, background: pg.Surface) -> None:
+        self.background = background
+        self.drawn = []        # 前フレームで背景の上に描いた範囲
+        self.dirty = []        # 次の反映で画面に送る範囲
+        self.full_update = True
+
+    def clear(self, screen: pg.Surface) -> None:
+        """
+        前フレームで描いた範囲を背景で塗り直す。
+        
+        引数:
+            screen (pg.Surface): メイン画面
+        """
+        if self.full_update:
+            screen.blit(self.background, (0, 0))
+        else:
+            for rect in self.drawn:
+                screen.blit(self.background, rect, rect)
+            self.dirty.extend(self.drawn)
+        self.drawn = []
+
+    def add(self, rects: list[pg.Rect]) -> None:
+        """
+        背景の上に描いた範囲を登録する(次フレームの clear で消される)。
+        
+        引数:
+            rects (list[pg.Rect]): 描画した範囲
+        """
+        self.drawn.extend(rects)
+        self.dirty.extend(rects)
+
+    def update_background(self, screen: pg.Surface, rect: pg.Rect, color: tuple[int, int, int] = BLACK) -> None:
+        """
+        背景の一部を塗りつぶし(食べられたエサの消去など)、画面にも反映する。
+        
+        引数:
+            screen (pg.Surface): メイン画面
+            rect (pg.Rect): 塗りつぶす範囲
+            color (tuple[int, int, int]): 塗りつぶす色
+        """
+        self.background.fill(color, rect)
+        screen.blit(self.background, rect, rect)
+        self.dirty.append(rect)
+
+    def flush(self, update_display: bool = True) -> None:
+        """
+        変化した範囲だけを画面に反映する(初回は画面全体)。
+        
+        引数:
+            update_display (bool): False ならディスプレイには送らず記録だけを消す(画面外のSurface用)
+        """
+        if update_display:
+            if self.full_update:
+                pg.display.update()
+            else:
+                pg.display.update(self.dirty)
+        self.full_update = False
+        self.dirty = []
+
+
+class InputQueue:
+    """
+    キー入力を KEYDOWN/KEYUP イベントとして時刻付きで記録するクラス。
+    ゲームは各ティックでその時刻までに記録した入力を順に受け取るため、
+    1フレームに複数ティック進めても押した順に入力が反映される。
+    pygame 2 のキーイベントには発生時刻が無く、SDL のイベントフィルタも使えないため、
+    時刻は pump でイベントを取り出した時刻になる(精度は1フレーム。同じフレームのイベントは同じティックに入る)。
     """
-    def __init__(self, player: 'Player', enemies: pg.sprite.Group, baits: pg.sprite.Group) -> None:
-        self.player = player
-        self.enemies = enemies
-        self.baits = baits
-        self.font = pg.font.Font(None, 30)
-        self.item_count = len(baits)
-        self.items_eaten = 0
-        self.enemy_colors = [(255, 0, 0), (0, 255, 0), (0, 0, 255), (255, 255, 0)]
+    def __init__(self) -> None:
+        self.events = deque()  # (発生時刻[ms], イベント種別, キー)
+        self.quit = False
+        self.resized = False  # ウィンドウの大きさが変わった
+        self.pause = False    # 一時停止キー(P)が押された
 
-    def update(self):
-        """フレームごとにデバッグ情報の更新を行う。"""
-        self.items_eaten = self.item_count - len(self.baits)
-
-    def draw(self, screen: pg.Surface):
+    def pump(self) -> None:
         """
-        画面右側に各種デバッグ情報を描画する。
+        イベントキューから入力を取り出し、取り出した時刻を付けて記録する。ゲームループ中で1フレームに1回だけ呼ぶ。
+        """
+        now = pg.time.get_ticks()
+        for event in pg.event.get():
+            if event.type == pg.QUIT:
+                self.quit = True
+            elif event.type == pg.VIDEORESIZE:
+                self.resized = True
+            elif event.type == pg.KEYDOWN and event.key == pg.K_p:
+                self.pause = True
+            elif event.type in (pg.KEYDOWN, pg.KEYUP):
+                self.events.append((now, event.type, event.key))
+
+    def pop_until(self, timestamp: int) -> list[tuple[int, int, int]]:
+        """
+        指定時刻までに発生した入力を発生順に取り出す。
         
         引数:
-            screen (pg.Surface): メイン画面
+            timestamp (int): ティックの時刻[ms]
+        戻り値:
+            list[tuple[int, int, int]]: (発生時刻, イベント種別, キー) のリスト
         """
-        # プレイヤー情報
-        player_pos_text = self.font.render(f"Player Pos: {self.player.get_grid_pos()}", True, WHITE)
-        screen.blit(player_pos_text, (WIDTH - 500, 20))
-        player_moving_text = self.font.render(f"Moving: {self.player.moving}", True, WHITE)
-        screen.blit(player_moving_text, (WIDTH - 500, 50))
-        player_direction_text = self.font.render(f"Direction: {self.player.current_direction}", True, WHITE)
-        screen.blit(player_direction_text, (WIDTH - 500, 80))
+        events = []
+        while self.events and self.events[0][0] <= timestamp:
+            events.append(self.events.popleft())
+        return events
 
-        # 起動からの経過秒表示
-        elapsed_ms = pg.time.get_ticks()  
-        elapsed_sec = elapsed_ms / 1000
-        current_time_text = self.font.render(f"Time: {elapsed_sec:.2f}", True, WHITE)
-        screen.blit(current_time_text, (WIDTH - 500, 110))
+    def clear(self) -> None:
+        """記録済みの入力を捨てる(画面の切り替え時など)。"""
+        self.events.clear()
+        self.pause = False
 
-        # 敵の情報
-        for i, enemy in enumerate(self.enemies):
-            color_rect = pg.Surface((20, 20))
-            color_rect.fill(self.enemy_colors[i])
-            screen.blit(color_rect, (WIDTH - 500, 180 + i * 50))
 
-            enemy_info_text = self.font.render(
-                f"Enemy {enemy.enemy_id}: {enemy.mode.name}, Moving: {enemy.moving}, Target: {enemy.get_target_position()}",
-                True, WHITE
-            )
-            screen.blit(enemy_info_text, (WIDTH - 480, 180 + i * 50))
+def update_game(player: 'Player', baits: 'ItemGroup', enemies: pg.sprite.Group) -> list['Item']:
+    """
+    ゲームを1ティック進める。時刻が来たタイマーを呼び出してからエサ・プレイヤー・敵を更新し、
+    パワーエサの効果を適用する。敵が食べられた直後の一時停止中は、タイマーだけを進める。
+    
+    引数:
+        player (Player): プレイヤー
+        baits (ItemGroup): エサ
+        enemies (pg.sprite.Group): 敵
+    戻り値:
+        list[Item]: このティックで食べられたエサ
+    """
+    scheduler.run_due(game_clock.now())
+    if any(enemy.eaten_after for enemy in enemies):
+        return []
+    eaten = baits.update(player)
+    player.update()
+    if not player.is_dying and not player.game_over:
+        Enemy.update_all(enemies)
+
+    # パワーエサの処理
+    for bait in eaten:
+        if bait.item_type == 2:
+            for enemy in enemies:
+                enemy.make_weak()
+    return eaten
+
+
+class GameSnapshot(NamedTuple):
+    """
+    snapshot_game で作るゲーム状態のスナップショット(不変)。
+    タイマーは作成時刻からの経過(残り)時間で持つため、いつ復元しても同じ状態から再開できる。
+    タイマー(Timer とその呼び出し先のメソッド)・敵の画像(Surface)・経路探索の依頼(Map と敵)は
+    コピーせずにそのオブジェクトを参照しているため、pickle できず、ファイルや別プロセスには渡せない。
+    同じプロセスで、作ったレベルのオブジェクトに restore_game する用途(分岐探索・やり直し)に限る。
+    """
+    player: tuple
+    enemies: tuple
+    dots: bytes
+    score: int
+    rng: tuple
+    time: float
+    timers: tuple
+    plans: tuple
 
-            target_pos = enemy.get_target_position()
-            target_rect = pg.Rect(get_pixel_pos(*target_pos), (10, 10))
-            pg.draw.rect(screen, self.enemy_colors[i], target_rect)
-            if enemy.current_path and len(enemy.current_path) >= 2:
-                points = [get_pixel_pos(*pos) for pos in enemy.current_path]
-                pg.draw.lines(screen, self.enemy_colors[i], False, points, 3)
 
-        # アイテム情報
-        item_count_text = self.font.render(f"Total Items: {self.item_count}", True, WHITE)
-        screen.blit(item_count_text, (WIDTH - 500, 450))
-        items_eaten_text = self.font.render(f"Items Eaten: {self.items_eaten}", True, WHITE)
-        screen.blit(items_eaten_text, (WIDTH - 500, 480))
+def snapshot_game(player: 'Player', score: 'Score', baits: 'ItemGroup', enemies) -> GameSnapshot:
+    """
+    現在のゲーム状態(位置・モード・タイマー・残りエサ・スコア・残機・乱数の状態)を保存する。
+    分岐探索AIや死亡直後のやり直し、早送りテストの起点に使う。
+    
+    引数:
+        player (Player): プレイヤー
+        score (Score): スコア
+        baits (ItemGroup): エサ
+        enemies (Iterable[Enemy]): 敵
+    戻り値:
+        GameSnapshot: スナップショット
+    """
+    now = game_clock.now()
+    return GameSnapshot(
+        player.get_state(now),
+        tuple(enemy.get_state() for enemy in enemies),
+        baits.get_state(),
+        score.value,
+        random.getstate(),
+        now,
+        scheduler.get_state(now),
+        path_planner.get_state(),
+    )
+
+
+def restore_game(snapshot: GameSnapshot, player: 'Player', score: 'Score', baits: 'ItemGroup', enemies) -> None:
+    """
+    snapshot_game で保存した状態に戻す。スナップショットを作ったレベルのオブジェクトに対して使う。
+    
+    引数:
+        snapshot (GameSnapshot): スナップショット
+        player (Player): プレイヤー
+        score (Score): スコア
+        baits (ItemGroup): エサ
+        enemies (Iterable[Enemy]): 敵(snapshot_game と同じ順)
+    """
+    if game_clock.manual:
+        # 手動で進める時計は保存時の時刻に戻し、以降の進行をビット単位で再現する
+        game_clock.time = snapshot.time
+    now = game_clock.now()
+    player.set_state(snapshot.player, now)
+    for enemy, state in zip(enemies, snapshot.enemies):
+        enemy.set_state(state)
+    scheduler.set_state(snapshot.timers, now)
+    path_planner.set_state(snapshot.plans)
+    baits.set_state(snapshot.dots)
+    score.value = snapshot.score
+    random.setstate(snapshot.rng)
+
+
+def create_background(map_data: 'Map', baits: 'ItemGroup') -> pg.Surface:
+    """
+    ゲーム画面の背景(マップとエサ)を一度だけ描いたSurfaceを作る。
+    
+    引数:
+        map_data (Map): マップ
+        baits (ItemGroup): エサ
+    戻り値:
+        pg.Surface: 背景
+    """
+    background = pg.Surface(view.size)
+    background.fill(BLACK)
+    map_data.draw(background, (0, 0))
+    baits.draw(background)
+    return background
 
 
 def draw_start_screen(screen):
@@ -1192,7 +3103,7 @@ def draw_game_over(screen):
     screen.blit(over_text, over_rect)
     
     # パックマン画像
-    pacman_image = pg.transform.scale(pg.image.load("fig/pac-man1.png").convert_alpha(), (50, 50))
+    pacman_image = load_image("fig/pac-man1.png", (50, 50))
     pacman_rect = pacman_image.get_rect(center=(screen_center_x, screen_center_y))
     screen.blit(pacman_image, pacman_rect)
 
@@ -1201,6 +3112,27 @@ def draw_game_over(screen):
     screen.blit(instruction_text, (WIDTH // 2 - instruction_text.get_width() // 2, HEIGHT * 2 // 3 - instruction_text.get_height() // 2))
 
 
+def draw_pause(screen: pg.Surface) -> None:
+    """
+    一時停止中の表示を描画する関数。暗めのオーバーレイの上に「PAUSE」を表示する。
+    
+    引数:
+        screen (pg.Surface): 描画先
+    """
+    overlay = pg.Surface((WIDTH, HEIGHT))
+    overlay.fill((0, 0, 0))
+    overlay.set_alpha(128)
+    screen.blit(overlay, (0, 0))
+
+    font = pg.font.Font(None, 74)
+    pause_text = font.render("PAUSE", True, WHITE)
+    screen.blit(pause_text, pause_text.get_rect(center=(WIDTH // 2, HEIGHT // 2)))
+
+    font_instruction = pg.font.Font(None, 40)
+    instruction_text = font_instruction.render("Press P to resume", True, (255, 255, 255))
+    screen.blit(instruction_text, (WIDTH // 2 - instruction_text.get_width() // 2, HEIGHT * 2 // 3 - instruction_text.get_height() // 2))
+
+
 def draw_game_clear(screen: pg.Surface, score: 'Score'):
     """
     ゲームクリア画面を描画する関数。
@@ -1229,137 +3161,1215 @@ def input_map_data(map_n):
     難易度(マップ番号)に応じて、マップやプレイヤー、スコア、エサ、敵等を初期化して返す。
     
     引数:
-        map_n (int): 選択した難易度に応じたマップ番号(1,2,3)
+        map_n (int | str): 選択した難易度に応じたマップ番号(1,2,3)、またはマップファイルのパス
     戻り値:
-        tuple[Map, Player, Score, pg.sprite.Group, pg.sprite.Group, DebugInfo]:
+        tuple[Map, Player, Score, ItemGroup, pg.sprite.Group, DebugInfo]:
             (map_data, player, score, baits, enemies, debug_info)
     """
-    map_dic = {1: "map2.txt", 2: "map3.txt", 3: "map1.txt"}
-    map_data = Map(map_dic[map_n])
-    player = Player((1, 1), map_data)
+    return start_level(build_level(map_n))
+
+
+def build_level_data(map_n) -> tuple:
+    """
+    レベルのうち、画像やフォントを使わないデータ(マップ・スコア・エサ)を組み立てる。
+    Surface もフォントも作らず、ゲーム全体で共有する状態にも触れないので、ワーカースレッドからも呼べる。
+    
+    引数:
+        map_n (int | str): マップ番号(1,2,3)、またはマップファイルのパス
+    戻り値:
+        tuple: (map_data, score, baits)
+    """
+    map_data = load_map(MAP_FILES.get(map_n, map_n))
     score = Score()
-    baits = pg.sprite.Group()
+    baits = ItemGroup(score, map_data.width, map_data.height)
     for x in range(map_data.height):
         for y in range(map_data.width):
             if map_data.playfield[x][y]["dot"] in [1, 2]:
-                baits.add(Item((y, x), map_data.playfield[x][y]["dot"], score))
+                baits.add(Item((y, x), map_data.playfield[x][y]["dot"]))
+    baits.initial_bitmap = baits.get_state()
+    return map_data, score, baits
+
+
+def build_level(map_n, data: tuple | None = None) -> tuple:
+    """
+    レベルを組み立てる。プレイヤーと敵の画像を作るので、メインスレッドから呼ぶ。
+    組み立てたレベルは start_level で開始してから使う。
+    
+    引数:
+        map_n (int | str): マップ番号(1,2,3)、またはマップファイルのパス
+        data (tuple | None): build_level_data で先に組み立てたデータ(None ならここで組み立てる)
+    戻り値:
+        tuple: input_map_data と同じ (map_data, player, score, baits, enemies, debug_info)
+    """
+    map_data, score, baits = data if data is not None else build_level_data(map_n)
+    player = Player((1, 1), map_data)
 
-    Enemy.enemies_group = []
+    # 敵の数はマップ上の初期位置(CELL_SPAWN があればその数、無ければ ENEMY_COUNT)で決まる
     enemies = pg.sprite.Group()
-    for i in range(4):
+    for i in range(len(map_data.enemy_start_positions)):
         enemies.add(Enemy(i+1, player, map_data))
     
     debug_info = DebugInfo(player, enemies, baits)
     return map_data, player, score, baits, enemies, debug_info
 
 
-def main():
+def reset_level(level: tuple) -> tuple:
+    """
+    遊び終えたレベルを、オブジェクトを作り直さずに開始時の状態へ戻す(やり直し用)。
+    マップ・画像・エサのオブジェクトはそのまま使い、エサは開始時のビットマップから戻す。
+    戻したレベルは start_level で開始してから使う。
+    
+    引数:
+        level (tuple): build_level の戻り値
+    戻り値:
+        tuple: level をそのまま返す
+    """
+    map_data, player, score, baits, enemies, debug_info = level
+    player.reset_level()
+    score.value = 0
+    baits.reset()
+    for enemy in enemies:
+        enemy.reset_level()
+    debug_info.update()
+    return level
+
+
+def start_level(level: tuple) -> tuple:
+    """
+    build_level で組み立てたレベルを開始する。
+    敵の一覧を登録し、前のレベルのタイマーを捨てて、敵のタイマーを今の時刻から始める。
+    
+    引数:
+        level (tuple): build_level の戻り値
+    戻り値:
+        tuple: level をそのまま返す
+    """
+    enemies = level[4]
+    Enemy.enemies_group = list(enemies)
+    scheduler.clear()
+    path_planner.clear()
+    for enemy in enemies:
+        enemy.start()
+    return level
+
+
+class LevelLoader:
+    """
+    次にプレイするレベルのデータ(マップの読み込みとエサの配置)をバックグラウンドのスレッドで組み立てておき、
+    ゲーム開始時にすぐ渡せるようにするクラス。pygame の Surface やフォントはスレッドセーフではないため、
+    プレイヤー・敵の画像と背景は take の時にメインスレッドで作る。
+    メニューやクリア画面など入力待ちの間に prepare し、開始時に take で受け取る。
+    遊び終えたレベルを release で戻しておくと、同じマップは作り直さずに初期状態へ戻して使い回す。
+    スレッドが使えない環境(ブラウザ版など)では take の時に同期で組み立てる。
+    """
+    def __init__(self) -> None:
+        self.pending: dict[object, Future] = {}
+        self.pool: dict[object, tuple] = {}  # 遊び終えたレベル (level, 背景)
+        self.executor = None
+        try:
+            self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="level")
+        except RuntimeError:
+            pass
+
+    @staticmethod
+    def build(map_n, data: tuple | None = None) -> tuple:
+        """レベルと、そのマップとエサを描いた背景を組み立てる(メインスレッドで呼ぶ)。"""
+        level = build_level(map_n, data)
+        return level, create_background(level[0], level[3])
+
+    def prepare(self, map_n) -> None:
+        """
+        レベルの組み立てをバックグラウンドで始める。組み立て中・組み立て済みなら何もしない。
+        
+        引数:
+            map_n (int | str): マップ番号(1,2,3)、またはマップファイルのパス
+        """
+        if self.executor is None or map_n in self.pending or map_n in self.pool:
+            return
+        try:
+            self.pending[map_n] = self.executor.submit(build_level_data, map_n)
+        except RuntimeError:
+            self.executor = None
+
+    def take(self, map_n) -> tuple:
+        """
+        組み立てたレベルを開始して返す(組み立て中なら完了を待つ)。
+        他のマップ用に組み立てたものは次回のために残しておく。
+        
+        引数:
+            map_n (int | str): マップ番号(1,2,3)、またはマップファイルのパス
+        戻り値:
+            tuple: (build_level の戻り値, 背景の Surface)
+        """
+        if map_n in self.pool:
+            level, background = self.pool.pop(map_n)
+            reset_level(level)
+            if background.get_size() == view.size:
+                # 食べられて消したエサを背景に描き戻す
+                level[3].draw(background)
+            else:
+                background = create_background(level[0], level[3])
+            return start_level(level), background
+
+        future = self.pending.pop(map_n, None)
+        data = None if future is None or future.exception() is not None else future.result()
+        level, background = self.build(map_n, data)
+        return start_level(level), background
+
+    def release(self, map_n, level: tuple, background: pg.Surface) -> None:
+        """
+        遊び終えたレベルを戻し、次に同じマップを take したときに使い回す。
+        
+        引数:
+            map_n (int | str): マップ番号(1,2,3)、またはマップファイルのパス
+            level (tuple): build_level の戻り値
+            background (pg.Surface): そのレベルの背景
+        """
+        self.pool[map_n] = (level, background)
+
+
+class AllocationTracker:
+    """
+    ゲームループのフェーズ(入力・更新・描画)ごとのメモリ割り当てを計測するクラス。
+    enabled のときだけ tracemalloc を動かし、フェーズごとの増加量(net)と、フェーズ内で確保して
+    解放した分の最大値(transient: ピークから前後の大きい方を引いた値)、確保中のメモリブロック数の増減
+    (blocks: sys.getallocatedblocks の差。確保した回数ではなく、残った数から解放した数を引いた値)、
+    GCの回数と停止時間を集計する。
+    sample_every フレームごとにフェーズ前後の tracemalloc スナップショットを比較し、
+    フェーズの終わりにまだ残っている割り当てを呼び出し箇所ごとに集計する(すぐ解放される一時オブジェクトは
+    ここには出ないので transient で見る)。計測クラス自身の行での割り当ては除く。
+
+    tracemalloc を動かすとゲームは数 fps まで落ち、固定長ティックのループは1フレームで複数ティックを進めたり
+    ティックを捨てたりする。そのため tick_phases のフェーズはティックあたり、それ以外はフレームあたりで出力する。
+    report_every フレームごとに標準エラーへ出力する。
+    """
+    def __init__(self, enabled: bool = False, sample_every: int = 10, report_every: int = 250,
+                 top: int = 8, tick_phases: tuple = ("update",)) -> None:
+        self.enabled = enabled
+        self.sample_every = sample_every
+        self.report_every = report_every
+        self.top = top
+        self.tick_phases = tick_phases
+        self.frame = 0
+        self.own_lines = range(0)
+        self.reset_stats()
+        if enabled:
+            import inspect
+            source, first = inspect.getsourcelines(AllocationTracker)
+            self.own_lines = range(first, first + len(source))
+            print("[alloc] tracemalloc is on: the game slows to a few fps and skips ticks; "
+                  f"{', '.join(tick_phases)} figures are per tick, the rest per frame", file=sys.stderr)
+            tracemalloc.start()
+            gc.callbacks.append(self.on_gc)
+            self.take_snapshot()  # フィルタのパターンを先にコンパイルし、計測に混ざらないようにする
+
+    def reset_stats(self) -> None:
+        """集計をリセットする。"""
+        self.phases = {}       # フェーズ名 -> {"net": バイト, "transient": バイト, "peak": バイト, "blocks": 個数}
+        self.sites = {}        # (フェーズ名, 呼び出し箇所) -> [個数, バイト]
+        self.sampled_frames = 0
+        self.sampled_ticks = 0
+        self.ticks = 0
+        self.skipped_ticks = 0
+        self.gc_counts = [0, 0, 0]
+        self.gc_pause = 0.0
+        self.gc_start = 0.0
+
+    def on_gc(self, phase: str, info: dict) -> None:
+        """gc.callbacks から呼ばれ、GCの回数と停止時間を記録する。"""
+        if phase == "start":
+            self.gc_start = time.perf_counter()
+        else:
+            self.gc_pause += time.perf_counter() - self.gc_start
+            self.gc_counts[info["generation"]] += 1
+
+    def phase(self, name: str):
+        """
+        計測するフェーズを囲むコンテキストマネージャを返す。無効なら何もしない。
+        
+        引数:
+            name (str): フェーズ名
+        """
+        return self.measure(name) if self.enabled else nullcontext()
+
+    @contextmanager
+    def measure(self, name: str):
+        """フェーズ前後のメモリ使用量とスナップショットを比較して集計する。"""
+        before = self.take_snapshot() if self.frame % self.sample_every == 0 else None
+        blocks_before = sys.getallocatedblocks()
+        tracemalloc.reset_peak()
+        start_memory = tracemalloc.get_traced_memory()[0]
+        try:
+            yield
+        finally:
+            memory, peak = tracemalloc.get_traced_memory()
+            blocks = sys.getallocatedblocks() - blocks_before
+            stats = self.phases.setdefault(name, {"net": 0, "transient": 0, "peak": 0, "blocks": 0})
+            stats["net"] += memory - start_memory
+            stats["transient"] += peak - max(memory, start_memory)
+            stats["peak"] = max(stats["peak"], peak - start_memory)
+            stats["blocks"] += blocks
+            if before is not None:
+                for stat in self.take_snapshot().compare_to(before, 'lineno'):
+                    frame = stat.traceback[0]
+                    if frame.filename == __file__ and frame.lineno in self.own_lines:
+                        continue
+                    if stat.count_diff > 0:
+                        site = self.sites.setdefault((name, str(stat.traceback[0])), [0, 0])
+                        site[0] += stat.count_diff
+                        site[1] += stat.size_diff
+
+    @staticmethod
+    def take_snapshot() -> tracemalloc.Snapshot:
+        """計測自体の割り当てを除いたスナップショットを返す。"""
+        return tracemalloc.take_snapshot().filter_traces([
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap*>"),
+        ])
+
+    def end_frame(self, ticks: int = 1, skipped: int = 0) -> None:
+        """
+        1フレームの終わりに呼ぶ。report_every フレームごとに集計を出力してリセットする。
+        
+        引数:
+            ticks (int): このフレームで進めたティック数
+            skipped (int): 処理が追いつかずに捨てたティック数
+        """
+        if not self.enabled:
+            return
+        if self.frame % self.sample_every == 0:
+            self.sampled_frames += 1
+            self.sampled_ticks += ticks
+        self.ticks += ticks
+        self.skipped_ticks += skipped
+        self.frame += 1
+        if self.frame % self.report_every == 0:
+            print(self.report(), file=sys.stderr)
+            self.reset_stats()
+
+    def report(self) -> str:
+        """
+        直近 report_every フレームの集計を文字列で返す。
+        
+        戻り値:
+            str: フェーズごとの1ティック(または1フレーム)あたりの増加量・一時的な割り当て・ピーク・
+                 メモリブロック数の増減と、フェーズの終わりに残っていた割り当て(すぐ解放したものは含まない)の
+                 呼び出し箇所ごとの個数・バイト数
+        """
+        frames = self.report_every
+        lines = [
+            f"[alloc] frame {self.frame}: last {frames} frames, {self.ticks} ticks "
+            f"({self.skipped_ticks} ticks skipped while tracing)"
+        ]
+        for name, stats in self.phases.items():
+            if name in self.tick_phases:
+                unit, count, sampled = "tick", self.ticks, self.sampled_ticks
+            else:
+                unit, count, sampled = "frame", frames, self.sampled_frames
+            count, sampled = max(1, count), max(1, sampled)
+            lines.append(
+                f"  {name}: net {stats['net'] / count:+.0f} B/{unit}, "
+                f"transient {stats['transient'] / count:.0f} B/{unit}, peak {stats['peak']} B, "
+                f"net {stats['blocks'] / count:+.1f} blocks/{unit}"
+            )
+            sites = sorted(
+                ((key[1], value) for key, value in self.sites.items() if key[0] == name),
+                key=lambda item: item[1][1], reverse=True
+            )
+            for site, (blocks, size) in sites[:self.top]:
+                lines.append(f"    {site}: {blocks / sampled:.1f} blocks/{unit} held, {size / sampled:.0f} B/{unit} held")
+        lines.append(
+            f"  gc: gen0 {self.gc_counts[0]}, gen1 {self.gc_counts[1]}, gen2 {self.gc_counts[2]}, "
+            f"pause {self.gc_pause * 1000:.2f} ms"
+        )
+        return "\n".join(lines)
+
+
+class FrameRecorder:
+    """
+    描画した画面を別スレッドでファイルに書き出すクラス(CIでのプレイ動画や見た目の回帰テスト用)。
+    capture は Surface のピクセルをバッファビュー越しに使い回しのバッファへ1回コピーしてキューに積むだけで、
+    PNG の圧縮やディスクへの書き込みは書き出しスレッドが行う。
+
+    形式(fmt):
+        "raw": フレームを1つのファイルに続けて書く(各行は 幅×バイト数、行末の余白なし)。
+               幅・高さ・ピクセルのバイト順は「ファイル名.json」に書く(例: ffmpeg -f rawvideo -pix_fmt bgr0)。
+               途中で画面の大きさが変わったら「名前-1.raw」のように別のファイルに分ける
+        "png": path のディレクトリに frame_000000.png(番号は capture を呼んだ回数)を書く
+    バッファが全て書き出し待ちのとき、block=False(ゲーム画面)ならそのフレームを捨てて dropped に数え、
+    block=True(画面なしの録画)なら書き出しを待つ。
+    """
+    def __init__(self, path: str, fmt: str = "raw", every: int = 1, buffers: int = 8, block: bool = False) -> None:
+        """
+        引数:
+            path (str): 書き出し先("raw" ならファイル、"png" ならディレクトリ)
+            fmt (str): "raw" または "png"
+            every (int): every フレームに1回だけ書き出す(間引き)
+            buffers (int): 書き出し待ちにできるフレーム数
+            block (bool): バッファが空くのを待つなら True
+        """
+        if fmt not in ("raw", "png"):
+            raise ValueError(f"unknown capture format: {fmt}")
+        if fmt == "png":
+            os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.fmt = fmt
+        self.every = max(1, every)
+        self.buffers = buffers
+        self.block = block
+        self.frame = 0      # capture を呼んだ回数
+        self.written = 0    # 書き出したフレーム数
+        self.dropped = 0    # バッファが足りずに捨てたフレーム数
+        self.error = None   # 書き出しスレッドで起きた例外
+        self.layout = None
+        self.free = None
+        self.queue = queue.Queue()
+        self.thread = threading.Thread(target=self.write_frames, name="recorder", daemon=True)
+        self.thread.start()
+
+    def capture(self, surface: pg.Surface) -> None:
+        """
+        描画済みの Surface を書き出しキューに積む(間引くフレームでは何もしない)。1フレームに1回呼ぶ。
+        
+        引数:
+            surface (pg.Surface): 描画済みの画面
+        """
+        index = self.frame
+        self.frame += 1
+        if index % self.every:
+            return
+        layout = (surface.get_size(), surface.get_pitch(), surface.get_bytesize(), surface.get_masks())
+        if layout != self.layout:
+            # 大きさが変わったらバッファを作り直す(書き出し中の古いバッファは古いキューに戻って捨てられる)
+            self.layout = layout
+            self.free = queue.Queue()
+            for _ in range(self.buffers):
+                self.free.put(bytearray(surface.get_pitch() * surface.get_height()))
+        try:
+            buffer = self.free.get(block=self.block)
+        except queue.Empty:
+            self.dropped += 1
+            return
+        with memoryview(surface.get_buffer()) as pixels:
+            buffer[:] = pixels
+        self.queue.put((buffer, self.free, layout, index))
+
+    def write_frames(self) -> None:
+        """書き出しスレッドの本体。close で None が積まれるまでキューのフレームを書き出す。"""
+        file = None
+        image = None
+        layout = None
+        segment = 0
+        frames = 0
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            buffer, free, frame_layout, index = item
+            (width, height), pitch, bytesize, masks = frame_layout
+            try:
+                if self.error is None:
+                    if self.fmt == "png":
+                        if frame_layout != layout:
+                            image = pg.Surface((width, height), 0, bytesize * 8, masks)
+                        image.get_buffer().write(bytes(buffer))
+                        pg.image.save(image, os.path.join(self.path, f"frame_{index:06d}.png"))
+                    else:
+                        if frame_layout != layout:
+                            if file is not None:
+                                self.close_segment(file, layout, frames)
+                            stem, ext = os.path.splitext(self.path)
+                            name = self.path if segment == 0 else f"{stem}-{segment}{ext}"
+                            file = open(name, 'wb')
+                            segment += 1
+                            frames = 0
+                        row = width * bytesize
+                        if pitch == row:
+                            file.write(buffer)
+                        else:
+                            rows = memoryview(buffer)
+                            for y in range(height):
+                                file.write(rows[y * pitch:y * pitch + row])
+                        frames += 1
+                    layout = frame_layout
+                    self.written += 1
+            except (OSError, pg.error) as e:
+                self.error = e
+            free.put(buffer)
+        if file is not None and self.error is None:
+            self.close_segment(file, layout, frames)
+
+    @staticmethod
+    def close_segment(file, layout: tuple, frames: int) -> None:
+        """raw のファイルを閉じ、大きさとピクセル形式を「ファイル名.json」に書く。"""
+        file.close()
+        (width, height), pitch, bytesize, masks = layout
+        # 各バイトがどの色か(リトルエンディアンなら下位バイトが先頭)
+        shifts = range(bytesize) if sys.byteorder == "little" else reversed(range(bytesize))
+        channels = {mask: name for mask, name in zip(masks, "RGBA") if mask}
+        pixel_format = "".join(channels.get(0xff << (8 * shift), "X") for shift in shifts)
+        with open(file.name + ".json", 'w') as f:
+            json.dump({"width": width, "height": height, "pixel_format": pixel_format, "frames": frames}, f)
+
+    def close(self) -> None:
+        """残りのフレームを書き出してスレッドを終える。書き出しに失敗していたらその例外を送出する。"""
+        self.queue.put(None)
+        self.thread.join()
+        if self.error is not None:
+            raise self.error
+
+
+def record_headless(recorder: FrameRecorder, map_n: int | str, steps: int, seed: int | None = None) -> dict:
+    """
+    画面を開かずにゲームを steps ティック進め、各ティックの画面を recorder で書き出す。
+    プレイヤーはシードで決まるランダムな方向に動く。ゲーム内時刻は実時間を待たずに進む。
+    
+    引数:
+        recorder (FrameRecorder): 書き出し先
+        map_n (int | str): 難易度(1,2,3)またはマップファイルのパス
+        steps (int): 進めるティック数
+        seed (int | None): 乱数シード
+    戻り値:
+        dict: 最後の情報(スコアなど)
+    """
+    env = PacmanEnv(map_n, observation="pixels", recorder=recorder)
+    env.reset(seed=seed)
+    rng = random.Random(seed)
+    action = 0
+    for step in range(steps):
+        if step % 25 == 0:
+            action = rng.randrange(len(PacmanEnv.ACTIONS))
+        _, _, terminated, truncated, info = env.step(action)
+        if terminated or truncated:
+            env.reset()
+    return env.get_info()
+
+
+class PacmanEnv:
+    """
+    エージェントからゲームを操作するための Gym 風の環境クラス。
+    reset(seed) でマップを読み込み直し、step(action) で1ティック進める。
+    ゲーム内時刻は step ごとに TICK_MS だけ進むため、画面なし(headless)でも実時間より速く回せる。
+
+    観測(observation):
+        "grid":   (6, 高さ, 幅) の uint8 配列。チャンネルは GRID_CHANNELS の順
+        "pixels": (HEIGHT, WIDTH, 3) の uint8 配列(描画先Surfaceのメモリをそのまま参照)
+    どちらもコピーせずに内部バッファを返すため、次の step で上書きされる。保持する場合は copy() すること。
+    recorder を渡すと、描いた画面を毎ティック書き出す("pixels" のときだけ)。
+    Enemy.enemies_group と game_clock を共有するため、1プロセスにつき1環境で使う。
+    """
+    ACTIONS = [None, pg.K_LEFT, pg.K_RIGHT, pg.K_UP, pg.K_DOWN]  # 0: 何もしない, 1: 左, 2: 右, 3: 上, 4: 下
+    GRID_CHANNELS = ["wall", "dot", "power", "player", "enemy", "weak_enemy"]
+
+    def __init__(self, map_n: int | str = 1, observation: str = "grid", headless: bool = True,
+                 max_steps: int | None = None, recorder: FrameRecorder | None = None, lod: bool = True) -> None:
+        """
+        引数:
+            map_n (int | str): 難易度(1,2,3)またはマップファイルのパス
+            observation (str): "grid" または "pixels"
+            headless (bool): True ならウィンドウを開かずに動かす(ダミーのビデオドライバを使う)
+            max_steps (int | None): この回数 step したら truncated を返す
+            recorder (FrameRecorder | None): 描いた画面の書き出し先
+            lod (bool): False なら遠い敵の判断の間引きを止め、毎ティック判断する
+                        (間引きの有無で進行が変わるため、比べる実行はそろえること)
+        """
+        import numpy as np
+        self.np = np
+        if observation not in ("grid", "pixels"):
+            raise ValueError(f"unknown observation type: {observation}")
+        if recorder is not None and observation != "pixels":
+            raise ValueError("recorder requires pixel observations")
+        self.map_n = map_n
+        self.observation = observation
+        self.max_steps = max_steps
+        self.recorder = recorder
+        self.lod = lod
+
+        # 画像の convert にはディスプレイが必要なため、無ければ最小の画面を作る
+        if pg.display.get_surface() is None:
+            if headless:
+                os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+            pg.display.init()
+            pg.display.set_mode((1, 1) if headless else (WIDTH, HEIGHT))
+        pg.font.init()
+        view.resize((WIDTH, HEIGHT))  # 観測は論理解像度のまま描く
+        path_planner.threaded = False  # 結果は同じなので、1ティックずつ高速に回すためにその場で探索する
+        path_planner.wait_budget = None  # 探索結果は必ず1ティック後に受け取り、進行を再現できるようにする
+
+        # 描画先は NumPy 配列のメモリを直接使う Surface にし、観測をコピー無しで返す
+        self.frame = None
+        self.use_buffer(None)
+
+        self.grid = None
+        self.level = None
+        self.dirty = None
+        self.held_key = None
+        self.steps = 0
+        game_clock.manual = True
+
+    def reset(self, seed: int | None = None) -> tuple:
+        """
+        ゲームを最初からやり直す。
+        
+        引数:
+            seed (int | None): 乱数シード(敵のランダムな行動を再現するため)
+        戻り値:
+            tuple: (観測, 情報の辞書)
+        """
+        np = self.np
+        if seed is not None:
+            random.seed(seed)
+        game_clock.time = 0.0
+        self.held_key = None
+        self.steps = 0
+        if self.level is not None:
+            # 2回目以降は同じオブジェクトを開始時の状態に戻して使い回す
+            self.level = start_level(reset_level(self.level))
+            baits = self.level[3]
+            self.grid[1:3] = self.dot_types[1:3]
+            if self.observation == "pixels":
+                baits.draw(self.dirty.background)
+                self.dirty.full_update = True
+        else:
+            self.level = input_map_data(self.map_n)
+            map_data, player, score, baits, enemies, _ = self.level
+            if not self.lod:
+                # この環境の敵だけ間引きを止める(Enemy のクラス属性は変えず、他の環境やゲームに影響しない)
+                for enemy in enemies:
+                    enemy.lod_max_interval = 1
+
+            # マップの固定部分(壁)とエサの配置
+            self.grid = np.zeros((len(self.GRID_CHANNELS), map_data.height, map_data.width), np.uint8)
+            self.grid[0] = [[not cell['path'] for cell in row] for row in map_data.playfield]
+            for item in baits:
+                x, y = item.grid_pos
+                self.grid[item.item_type, y, x] = 1
+            self.dot_types = self.grid[:3].copy()  # エサの種類ごとの初期配置(restore・reset 用)
+            if self.observation == "pixels":
+                self.dirty = DirtyRegions(create_background(map_data, baits))
+        self.update_actors()
+
+        if self.observation == "pixels":
+            self.render([])
+        return self.get_observation(), self.get_info()
+
+    def step(self, action: int) -> tuple:
+        """
+        行動(押し続ける方向キー)を与えて1ティック進める。
+        
+        引数:
+            action (int): 0=何もしない, 1=左, 2=右, 3=上, 4=下(範囲外なら ValueError)
+        戻り値:
+            tuple: (観測, 報酬(スコアの増分), terminated, truncated, 情報の辞書)
+        """
+        if not 0 <= action < len(self.ACTIONS):
+            # 負の値がリストの後ろからの添字として通らないようにする
+            raise ValueError(f"action must be 0..{len(self.ACTIONS) - 1}, got {action}")
+        map_data, player, score, baits, enemies, _ = self.level
+        key = self.ACTIONS[action]
+        if key != self.held_key:
+            if self.held_key is not None:
+                player.handle_input(self.held_key, False)
+            if key is not None:
+                player.handle_input(key, True)
+            self.held_key = key
+
+        score_before = score.value
+        game_clock.advance(TICK_MS / 1000)
+        eaten = update_game(player, baits, enemies)
+        self.steps += 1
+
+        for item in eaten:
+            x, y = item.grid_pos
+            self.grid[item.item_type, y, x] = 0
+        self.update_actors()
+        if self.observation == "pixels":
+            self.render(eaten)
+
+        terminated = player.game_over or not baits
+        truncated = self.max_steps is not None and self.steps >= self.max_steps
+        return self.get_observation(), score.value - score_before, terminated, truncated, self.get_info()
+
+    def snapshot(self) -> tuple:
+        """
+        環境の状態を保存する(同じ環境の restore にだけ使える。pickle はできない。GameSnapshot を参照)。
+        
+        戻り値:
+            tuple: restore に渡す状態
+        """
+        map_data, player, score, baits, enemies, _ = self.level
+        return snapshot_game(player, score, baits, enemies), self.held_key, self.steps
+
+    def restore(self, state: tuple):
+        """
+        snapshot で保存した状態に戻す。"pixels" では背景を作り直さず、残りが変わったエサのセルだけを描き直す。
+        
+        引数:
+            state (tuple): snapshot で得た状態
+        戻り値:
+            観測
+        """
+        np = self.np
+        map_data, player, score, baits, enemies, _ = self.level
+        snapshot, self.held_key, self.steps = state
+        changed = baits.changed_cells(snapshot.dots)
+        restore_game(snapshot, player, score, baits, enemies)
+
+        dots = np.frombuffer(snapshot.dots, np.uint8).reshape(map_data.height, map_data.width)
+        self.grid[1] = dots & self.dot_types[1]
+        self.grid[2] = dots & self.dot_types[2]
+        self.update_actors()
+        if self.observation == "pixels":
+            self.dirty.clear(self.surface)
+            for index in changed:
+                item = baits.all_items[(index % map_data.width, index // map_data.width)]
+                self.dirty.update_background(self.surface, view.rect(item.rect))
+                if snapshot.dots[index]:
+                    image = Item.get_image(item.item_type, view.scale)
+                    self.dirty.background.blit(image, view.point(item.rect.topleft))
+                    self.surface.blit(image, view.point(item.rect.topleft))
+            self.render([])
+        return self.get_observation()
+
+    def use_buffer(self, buffer) -> None:
+        """
+        描画先("pixels" の観測)のメモリを buffer(共有メモリなど)に移す。今の画面はコピーして引き継ぐ。
+        
+        引数:
+            buffer: HEIGHT×WIDTH×4 バイト以上の書き込めるバッファ。None なら自前のメモリに戻す
+        """
+        np = self.np
+        frame = np.zeros((HEIGHT, WIDTH, 4), np.uint8) if buffer is None else np.ndarray((HEIGHT, WIDTH, 4), np.uint8, buffer=buffer)
+        if self.frame is not None:
+            frame[...] = self.frame
+        self.frame = frame
+        self.surface = pg.image.frombuffer(frame, (WIDTH, HEIGHT), "RGBX")
+        self.pixels = frame[:, :, :3]
+
+    def update_actors(self) -> None:
+        """観測グリッドのプレイヤーと敵のチャンネルを現在位置で書き直す。"""
+        map_data, player, score, baits, enemies, _ = self.level
+        self.grid[3:] = 0
+        for channel, actor in [(3, player)] + [
+            (5 if enemy.mode == EnemyMode.WEAK or enemy.is_eaten else 4, enemy) for enemy in enemies
+        ]:
+            x, y = actor.get_grid_pos()
+            if 0 <= x < map_data.width and 0 <= y < map_data.height:
+                self.grid[channel, y, x] = 1
+
+    def render(self, eaten: list['Item']) -> None:
+        """
+        観測用のSurfaceに現在の画面を描く(前回描いた範囲だけを描き直す)。
+        
+        引数:
+            eaten (list[Item]): 前回から食べられたエサ
+        """
+        map_data, player, score, baits, enemies, _ = self.level
+        self.dirty.clear(self.surface)
+        for item in eaten:
+            self.dirty.update_background(self.surface, view.rect(item.rect))
+        self.dirty.add(player.draw(self.surface))
+        self.dirty.add(self.surface.blits([(view.image(enemy.image), view.point(enemy.rect.topleft)) for enemy in enemies]))
+        self.dirty.add(score.draw(self.surface))
+        self.dirty.flush(update_display=False)
+        if self.recorder is not None:
+            self.recorder.capture(self.surface)
+
+    def get_observation(self):
+        """現在の観測を返す(内部バッファをそのまま返す)。"""
+        return self.grid if self.observation == "grid" else self.pixels
+
+    def get_info(self) -> dict:
+        """スコアなどの補助情報を返す。"""
+        map_data, player, score, baits, enemies, _ = self.level
+        return {"score": score.value, "lives": player.lives, "dots_left": len(baits), "steps": self.steps}
+
+
+class ControlServer:
+    """
+    別プロセスのエージェントから PacmanEnv を操作するための、Unixドメインソケットのサーバ。
+    要求と応答は1行1つのJSONで、観測は送らずに共有メモリ(multiprocessing.shared_memory)に置き、
+    応答ではその名前・形・型・ストライドだけを返す。"pixels" では環境が共有メモリに直接描くのでコピーも無く、
+    "grid" は step ごとに共有メモリへコピーする。
+    要求に1つずつ順に答えるので、次の要求を送るまでは共有メモリは書き換わらない。
+
+    要求("cmd"):
+        "reset":   {"cmd": "reset", "seed": 任意} ゲームを最初からやり直す
+        "step":    {"cmd": "step", "action": 0〜4, "repeat": 任意} 同じ行動で repeat ティック(終了したらそこまで)進める
+        "observe": {"cmd": "observe"} 今の観測を書き込み直す
+        "close":   {"cmd": "close"} サーバを終了する
+    応答: {"ok": true, "shm": 共有メモリ名, "shape": [...], "dtype": "uint8", "strides": [...], "frame": 書き込んだ回数,
+           "reward": 報酬, "terminated": bool, "truncated": bool, "info": {...}}
+           失敗したときは {"ok": false, "error": "..."}
+    ウィンドウがあれば("pixels" の観測のとき)進めるたびに画面にも表示する。
+    """
+    def __init__(self, env: PacmanEnv, path: str) -> None:
+        """
+        引数:
+            env (PacmanEnv): 操作する環境
+            path (str): ソケットファイルのパス(既にあれば作り直す)
+        """
+        self.env = env
+        self.path = path
+        self.shm = None
+        self.array = None
+        self.frame = 0
+        self.closed = False
+
+    def serve_forever(self) -> None:
+        """close 要求が来るまで接続を1つずつ受け付けて処理する。"""
+        import socket
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server:
+            server.bind(self.path)
+            server.listen(1)
+            try:
+                while not self.closed:
+                    connection, _ = server.accept()
+                    try:
+                        with connection, connection.makefile('rwb') as stream:
+                            for line in stream:
+                                stream.write(json.dumps(self.handle_line(line)).encode() + b"\n")
+                                stream.flush()
+                                if self.closed:
+                                    break
+                    except OSError:
+                        # 途中で切断したクライアントはその接続だけを終え、次の接続を待つ
+                        pass
+            finally:
+                os.unlink(self.path)
+                self.release()
+
+    def handle_line(self, line: bytes) -> dict:
+        """
+        受け取った1行を要求として解釈して処理し、応答を返す。JSONでない・オブジェクトでない行にはエラーを返す。
+        
+        引数:
+            line (bytes): 受け取った1行
+        戻り値:
+            dict: 応答
+        """
+        try:
+            request = json.loads(line)
+        except ValueError as e:
+            return {"ok": False, "error": f"invalid JSON: {e}"}
+        if not isinstance(request, dict):
+            return {"ok": False, "error": "request must be a JSON object"}
+        return self.handle(request)
+
+    def handle(self, request: dict) -> dict:
+        """
+        要求を1つ処理して応答を返す。
+        
+        引数:
+            request (dict): 要求
+        戻り値:
+            dict: 応答
+        """
+        env = self.env
+        command = request.get("cmd")
+        reward = 0
+        terminated = truncated = False
+        try:
+            if command == "close":
+                self.closed = True
+                return {"ok": True}
+            if command == "reset":
+                observation, info = env.reset(seed=request.get("seed"))
+            elif command not in ("step", "observe"):
+                return {"ok": False, "error": f"unknown command: {command}"}
+            elif env.level is None:
+                return {"ok": False, "error": "reset has not been called"}
+            elif command == "step":
+                action = int(request["action"])
+                if not 0 <= action < len(env.ACTIONS):
+                    return {"ok": False, "error": f"action must be 0..{len(env.ACTIONS) - 1}, got {action}"}
+                for _ in range(max(1, int(request.get("repeat", 1)))):
+                    observation, step_reward, terminated, truncated, info = env.step(action)
+                    reward += step_reward
+                    if terminated or truncated:
+                        break
+            else:
+                observation, info = env.get_observation(), env.get_info()
+        except (KeyError, ValueError, TypeError, IndexError) as e:
+            return {"ok": False, "error": f"{type(e).__name__}: {e}"}
+
+        observation = self.publish(observation)
+        return {
+            "ok": True, "shm": self.shm.name, "shape": list(observation.shape), "dtype": str(observation.dtype),
+            "strides": list(observation.strides), "frame": self.frame, "reward": reward, "terminated": terminated, "truncated": truncated, "info": info,
+        }
+
+    def publish(self, observation):
+        """
+        観測を共有メモリに置く(大きさが変わったら共有メモリを作り直す)。
+        
+        引数:
+            observation: 環境の観測
+        戻り値:
+            共有メモリ上の観測
+        """
+        from multiprocessing import shared_memory
+        env = self.env
+        np = env.np
+        if env.observation == "pixels":
+            if self.shm is None:
+                # 以後は環境が共有メモリに直接描く
+                self.shm = shared_memory.SharedMemory(create=True, size=env.frame.nbytes)
+                env.use_buffer(self.shm.buf)
+            observation = env.pixels
+        else:
+            if self.array is None or self.array.shape != observation.shape:
+                self.release()
+                self.shm = shared_memory.SharedMemory(create=True, size=max(1, observation.nbytes))
+                self.array = np.ndarray(observation.shape, observation.dtype, buffer=self.shm.buf)
+            np.copyto(self.array, observation)
+            observation = self.array
+        self.frame += 1
+        window = pg.display.get_surface()
+        if window is not None and window.get_size() != (1, 1) and self.env.observation == "pixels":
+            window.blit(env.surface, (0, 0))
+            pg.display.update()
+            pg.event.pump()
+        return observation
+
+    def release(self) -> None:
+        """共有メモリを解放する。"""
+        if self.shm is not None:
+            self.array = None
+            if self.env.observation == "pixels":
+                self.env.use_buffer(None)
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class ControlClient:
+    """
+    ControlServer を操作するクライアント(エージェント側のプロセスで使う)。
+    観測は共有メモリをそのまま参照する NumPy 配列で返すため、次の要求で上書きされる。保持する場合は copy() すること。
+    """
+    def __init__(self, path: str) -> None:
+        """
+        引数:
+            path (str): サーバのソケットファイルのパス
+        """
+        import socket
+        import numpy as np
+        self.np = np
+        self.socket = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        self.socket.connect(path)
+        self.stream = self.socket.makefile('rwb')
+        self.shm = None
+        self.observation = None
+
+    def call(self, **request) -> dict:
+        """
+        要求を送って応答を返す。観測は応答の "observation" に入れる。
+        
+        引数:
+            **request: 要求(cmd など)
+        戻り値:
+            dict: 応答
+        """
+        self.stream.write(json.dumps(request).encode() + b"\n")
+        self.stream.flush()
+        reply = json.loads(self.stream.readline())
+        if not reply["ok"]:
+            raise RuntimeError(reply["error"])
+        if "shm" in reply:
+            if self.shm is None or self.shm.name != reply["shm"]:
+                self.attach(reply["shm"])
+            if self.observation is None or list(self.observation.shape) != reply["shape"]:
+                self.observation = self.np.ndarray(reply["shape"], reply["dtype"], buffer=self.shm.buf,
+                                                   strides=reply["strides"])
+            reply["observation"] = self.observation
+        return reply
+
+    def attach(self, name: str) -> None:
+        """サーバが作った共有メモリにつなぐ(解放はサーバが行う)。"""
+        from multiprocessing import resource_tracker, shared_memory
+        self.observation = None
+        if self.shm is not None:
+            self.shm.close()
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # Python 3.12 以前はつないだだけでも終了時に解放されてしまうので、追跡を外す
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, "shared_memory")
+
+    def reset(self, seed: int | None = None) -> tuple:
+        """ゲームを最初からやり直し、(観測, 情報の辞書) を返す。"""
+        reply = self.call(cmd="reset", seed=seed)
+        return reply["observation"], reply["info"]
+
+    def step(self, action: int, repeat: int = 1) -> tuple:
+        """行動を与えて進め、(観測, 報酬, terminated, truncated, 情報の辞書) を返す。"""
+        reply = self.call(cmd="step", action=action, repeat=repeat)
+        return reply["observation"], reply["reward"], reply["terminated"], reply["truncated"], reply["info"]
+
+    def observe(self):
+        """今の観測を返す。"""
+        return self.call(cmd="observe")["observation"]
+
+    def close(self, stop_server: bool = False) -> None:
+        """
+        接続を閉じる。
+        
+        引数:
+            stop_server (bool): True ならサーバも終了させる
+        """
+        if stop_server:
+            self.call(cmd="close")
+        self.observation = None
+        if self.shm is not None:
+            self.shm.close()
+            self.shm = None
+        self.stream.close()
+        self.socket.close()
+
+
+def main(map_file: str | None = None, trace_alloc: bool = False, stats_file: str | None = None,
+         recorder: FrameRecorder | None = None):
     """
     メイン関数。
     ゲームループを管理し、スタート画面・ゲーム画面・ゲームオーバー画面・クリア画面の表示切り替えを行う。
+
+    引数:
+        map_file (str | None): 指定した場合は難易度選択を省略し、このマップファイルでプレイする
+        trace_alloc (bool): True ならゲーム中のメモリ割り当てを計測して出力する
+        stats_file (str | None): 指定した場合は経路探索の集計を定期的にこのファイルへJSONで書き出す
+        recorder (FrameRecorder | None): 指定した場合はゲーム画面を毎フレーム書き出す
     """
     pg.display.set_caption("Pacman")
-    screen = pg.display.set_mode((WIDTH, HEIGHT))
+    screen = pg.display.set_mode(WINDOW_SIZE, pg.RESIZABLE)
+    view.resize(screen.get_size())
+
+    # タイトル画面の表示中に画像とマップを読み込んでおく
+    preload_assets([map_file] if map_file else list(MAP_FILES.values()))
     start = True
     game_clear = False
     tmr = 0
     clock = pg.time.Clock()
+    input_queue = InputQueue()
+    alloc_tracker = AllocationTracker(trace_alloc)
+    path_stats.dump_file = stats_file
+    path_planner.wait_budget = PLAN_WAIT_BUDGET
+    level_loader = LevelLoader()
+    choices = [map_file] if map_file else list(MAP_FILES)
+    dirty = None
 
     while True:
-        for event in pg.event.get():
-            if event.type == pg.QUIT:
-                return 0
+        with alloc_tracker.phase("input"):
+            input_queue.pump()
+        if input_queue.quit:
+            return 0
+        if input_queue.resized:
+            # 新しい倍率で背景を作り直し、画像とフォントも次の描画で作り直される
+            input_queue.resized = False
+            screen = pg.display.get_surface()
+            view.resize(screen.get_size())
+            if dirty is not None:
+                dirty = DirtyRegions(create_background(map_data, baits))
 
         if start:
+            # 選ばれうるレベルを入力待ちの間に組み立てておく
+            for choice in choices:
+                level_loader.prepare(choice)
+
             # 1) スタート画面用Surfaceを作り、描画
             start_screen = pg.Surface((WIDTH, HEIGHT))
             draw_start_screen(start_screen)  # スタート画面を描画
 
             # 2) まずは描画した内容を一度画面に反映
-            screen.blit(start_screen, (0, 0))
+            screen.fill(BLACK)
+            view.present(screen, start_screen)
             pg.display.update()
 
-            # 3) Enter キーが押されるまで待機する
-            waiting_for_enter = True
-            while waiting_for_enter:
-                for event in pg.event.get():
-                    if event.type == pg.QUIT:
-                        pg.quit()
-                        sys.exit()
-                    elif event.type == pg.KEYDOWN and event.key == pg.K_RETURN:
-                        waiting_for_enter = False
+            # 3) Enter キーが押されるまで待機する(描き直さずにイベントを待つ)
+            wait_for_key(pg.K_RETURN)
 
             # 4) カーソル付きメニューで難易度選択（Enterで抜ける）
-            difficulty = run_difficulty_menu_with_title(screen)  # 1,2,3 を返す
+            difficulty = map_file or run_difficulty_menu_with_title(screen)  # 1,2,3 を返す
             tmr = 0  # タイマーをリセット
 
-            # 5) map_data等を読み込み
-            map_data, player, score, baits, enemies, debug_info = input_map_data(difficulty)
+            # 5) 組み立て済みの map_data等を受け取る
+            level, background = level_loader.take(difficulty)
+            map_data, player, score, baits, enemies, debug_info = level
+            dirty = DirtyRegions(background)
+            input_queue.clear()
+            sim_time = pg.time.get_ticks()
 
             start = False  # スタート画面フラグOFF
 
         elif player and player.game_over:
-            # プレイヤーが死亡してゲームオーバーになった場合
-            draw_game_over(screen)
-            for event in pg.event.get():
-                if event.type == pg.QUIT:
-                    pg.quit()
-                    sys.exit()
-                if event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
-                    start = True
+            # プレイヤーが死亡してゲームオーバーになった場合(一度だけ描画して入力を待つ)
+            canvas = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+            draw_game_over(canvas)
+            view.present(screen, canvas)
+            pg.display.update()
+            level_loader.release(difficulty, level, dirty.background)
+            for choice in choices:
+                level_loader.prepare(choice)
+            wait_for_key(pg.K_SPACE)
+            start = True
 
         elif game_clear:
-            # 全エサを食べきってクリアした場合
-            draw_game_clear(screen, score)
-            for event in pg.event.get():
-                if event.type == pg.QUIT:
-                    pg.quit()
-                    sys.exit()
-                if event.type == pg.KEYDOWN and event.key == pg.K_SPACE:
-                    start = True
-                    game_clear = False
-                    player.game_over = False
+            # 全エサを食べきってクリアした場合(一度だけ描画して入力を待つ)
+            canvas = pg.Surface((WIDTH, HEIGHT))
+            draw_game_clear(canvas, score)
+            view.present(screen, canvas)
+            pg.display.update()
+            level_loader.release(difficulty, level, dirty.background)
+            for choice in choices:
+                level_loader.prepare(choice)
+            wait_for_key(pg.K_SPACE)
+            start = True
+            game_clear = False
+            player.game_over = False
+
+        elif input_queue.pause:
+            # 一時停止(ゲーム内時計を止めるので、全てのタイマーが一緒に止まる)
+            input_queue.pause = False
+            game_clock.pause()
+            canvas = pg.Surface((WIDTH, HEIGHT), pg.SRCALPHA)
+            draw_pause(canvas)
+            view.present(screen, canvas)
+            pg.display.update()
+            wait_for_key(pg.K_p)
+            game_clock.resume()
+
+            # 一時停止中に離したキーは届かないので、押したままの扱いを解除する
+            player.held_directions.clear()
+            input_queue.clear()
+            sim_time = pg.time.get_ticks()
+            dirty.full_update = True
 
         else:
             # ゲームメイン画面
-            screen.fill(BLACK)
-            map_data.draw(screen, (0, 0))
-
-            baits.draw(screen)
-            baits.update(player)
-
-            keys = pg.key.get_pressed()
-            player.handle_input(keys)
-            player.update()
-            player.draw(screen)
-
-            if not player.is_dying:
-                enemies.update()
-            enemies.draw(screen)
-
-            debug_info.update()
-            debug_info.draw(screen)
-
-            score.draw(screen)
-
-            # パワーエサの処理
-            for bait in baits:
-                if bait.item_type == 2 and pg.sprite.collide_rect(player, bait):
-                    for enemy in enemies:
-                        enemy.make_weak()
+            # (マップとエサは背景に描いておき、前フレームで描いた範囲だけを背景で消して描き直す)
+            dirty.clear(screen)
+
+            # 固定長のティックでゲームを進め、入力は発生した時刻のティックで渡す
+            with alloc_tracker.phase("update"):
+                now = pg.time.get_ticks()
+                ticks = 0
+                skipped = 0
+                while sim_time + TICK_MS <= now and not player.game_over and baits:
+                    if ticks == MAX_TICKS_PER_FRAME:
+                        # 処理が追いつかない分は捨てる
+                        skipped = (now - sim_time) // TICK_MS
+                        sim_time = now
+                        break
+                    sim_time += TICK_MS
+                    ticks += 1
+                    for _, event_type, key in input_queue.pop_until(sim_time):
+                        player.handle_input(key, event_type == pg.KEYDOWN)
+
+                    # 食べられたエサは背景からも消す
+                    for bait in update_game(player, baits, enemies):
+                        dirty.update_background(screen, view.rect(bait.rect))
+
+            with alloc_tracker.phase("render"):
+                dirty.add(player.draw(screen))
+                dirty.add(screen.blits([(view.image(enemy.image), view.point(enemy.rect.topleft)) for enemy in enemies]))
+
+                debug_info.update()
+                dirty.add(debug_info.draw(screen))
+
+                dirty.add(score.draw(screen))
+
+                # 変化した範囲だけを画面に反映
+                dirty.flush()
+                if recorder is not None:
+                    recorder.capture(screen)
 
             # ゲームクリア判定
             if not baits:
                 if not game_clear:
                     game_clear = True
+            alloc_tracker.end_frame(ticks, skipped)
+            path_stats.maybe_dump()
 
-        pg.display.update()
         tmr += 1
         clock.tick(50)
 
 
 if __name__ == "__main__":
-    pg.init()
-    main()
+    parser = argparse.ArgumentParser(description="Pacman")
+    parser.add_argument("--map", help="難易度選択の代わりに使うマップファイル")
+    parser.add_argument("--generate-maze", metavar="MAP_FILE", help="迷路マップを生成して書き出し、終了する")
+    parser.add_argument("--size", type=int, nargs=2, default=(31, 31), metavar=("WIDTH", "HEIGHT"),
+                        help="生成する迷路のサイズ(セル数)")
+    parser.add_argument("--seed", type=int, default=None, help="迷路生成(と画面なしの録画)の乱数シード")
+    parser.add_argument("--enemies", type=int, default=4, help="生成する迷路の敵の数")
+    parser.add_argument("--build-atlas", action="store_true", help="fig の画像をアトラスにまとめて書き出し、終了する")
+    parser.add_argument("--build-web", metavar="DIR",
+                        help="ブラウザ版(pygbag)用に、画像をアトラスだけにしたフォルダを作り、終了する")
+    parser.add_argument("--trace-alloc", action="store_true", help="ゲーム中のメモリ割り当てを計測して標準エラーに出力する")
+    parser.add_argument("--path-stats", metavar="JSON_FILE", help="経路探索の集計を定期的にJSONで書き出す")
+    parser.add_argument("--record", metavar="PATH", help="ゲーム画面を書き出す(raw はファイル、png はディレクトリ)")
+    parser.add_argument("--record-format", choices=("raw", "png"), default="raw", help="書き出す形式")
+    parser.add_argument("--record-every", type=int, default=1, metavar="N", help="N フレームに1回だけ書き出す")
+    parser.add_argument("--headless-steps", type=int, metavar="STEPS",
+                        help="画面を開かずに STEPS ティック進めて --record に書き出し、終了する")
+    parser.add_argument("--serve", metavar="SOCKET", help="このUnixドメインソケットで外部からの操作を受け付ける")
+    parser.add_argument("--observation", choices=("grid", "pixels"), default="grid", help="--serve で返す観測")
+    parser.add_argument("--windowed", action="store_true", help="--serve のときにウィンドウを開いて表示する")
+    parser.add_argument("--no-lod", action="store_true",
+                        help="遠い敵の判断の間引きを止める(間引きの有無で進行が変わるため、比べる実行で使う)")
+    args, _ = parser.parse_known_args()
+    if args.no_lod:
+        Enemy.lod_max_interval = 1
+
+    if args.build_atlas:
+        build_atlas([path for path, _ in PRELOAD_IMAGES])
+        sys.exit()
+
+    if args.build_web:
+        try:
+            build_web(args.build_web, list(MAP_FILES.values()))
+        except FileExistsError:
+            parser.error(f"{args.build_web} already exists")
+        sys.exit()
+
+    if args.generate_maze:
+        try:
+            grid = generate_maze(*args.size, seed=args.seed, enemy_count=args.enemies)
+        except ValueError as e:
+            parser.error(str(e))
+        write_map_file(args.generate_maze, grid)
+        sys.exit()
+
+    recorder = None
+    if args.record:
+        recorder = FrameRecorder(args.record, args.record_format, args.record_every,
+                                 block=args.headless_steps is not None)
+
+    if args.headless_steps is not None:
+        if recorder is None:
+            parser.error("--headless-steps requires --record")
+        info = record_headless(recorder, args.map or 1, args.headless_steps, args.seed)
+        recorder.close()
+        print(f"recorded {recorder.written} frames: {info}")
+        sys.exit()
+
+    if args.serve:
+        if recorder is not None and args.observation != "pixels":
+            parser.error("--record with --serve requires --observation pixels")
+        env = PacmanEnv(args.map or 1, observation=args.observation, headless=not args.windowed, recorder=recorder)
+        ControlServer(env, args.serve).serve_forever()
+        if recorder is not None:
+            recorder.close()
+        sys.exit()
+
+    # 使うのは画面とフォントだけなので、音声などのモジュールは初期化しない
+    pg.display.init()
+    pg.font.init()
+    main(args.map, args.trace_alloc, args.path_stats, recorder)
+    if recorder is not None:
+        recorder.close()
     pg.quit()
     sys.exit()
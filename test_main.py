@@ -0,0 +1,959 @@
+import gc
+import json
+import os
+import random
+import socket
+import tempfile
+import threading
+import tracemalloc
+from collections import deque
+
+os.environ.setdefault("SDL_VIDEODRIVER", "dummy")
+
+import pygame as pg
+import pytest
+
+import main
+
+
+@pytest.fixture(scope="module")
+def assets(tmp_path_factory):
+    """
+    画像(fig)とテスト用の迷路マップを用意して、そのディレクトリで動かす。
+    リポジトリに画像が無ければ、同じ名前・大きさの単色の画像を作る(見た目はテストしない)。
+    """
+    root = os.getcwd()
+    work = tmp_path_factory.mktemp("assets")
+    if not os.path.isdir(os.path.join(root, "fig")):
+        pg.display.init()
+        for path, size in main.PRELOAD_IMAGES:
+            os.makedirs(work / os.path.dirname(path), exist_ok=True)
+            image = pg.Surface(size, pg.SRCALPHA)
+            image.fill((255, 255, 0, 255))
+            pg.image.save(image, str(work / path))
+    else:
+        os.symlink(os.path.join(root, "fig"), work / "fig")
+    main.write_map_file(str(work / "maze.txt"), main.generate_maze(21, 21, seed=7))
+    os.chdir(work)
+    yield work
+    os.chdir(root)
+
+
+@pytest.mark.parametrize("size", [(7, 7), (21, 21), (20, 16), (31, 24), (40, 41)])
+@pytest.mark.parametrize("seed", [0, 1, 2, 3])
+def test_generate_maze_is_connected_and_closed(size, seed):
+    width, height = size
+    grid = main.generate_maze(width, height, seed=seed, enemy_count=4)
+    assert len(grid) == height and all(len(row) == width for row in grid)
+    assert grid == main.generate_maze(width, height, seed=seed, enemy_count=4)
+
+    # 盤面の端は壁かワープトンネル
+    border = grid[0] + grid[-1] + [row[0] for row in grid] + [row[-1] for row in grid]
+    assert set(border) <= {main.CELL_WALL, main.CELL_TUNNEL}
+    for row in grid:
+        assert (row[0] == main.CELL_TUNNEL) == (row[-1] == main.CELL_TUNNEL)
+
+    # トンネルは同じ行の反対側とつながるものとして、全ての通路が (1, 1) から行ける
+    passable = {(x, y) for y, row in enumerate(grid) for x, code in enumerate(row) if code != main.CELL_WALL}
+    seen = {(1, 1)}
+    queue = deque(seen)
+    while queue:
+        x, y = queue.popleft()
+        neighbors = [(x - 1, y), (x + 1, y), (x, y - 1), (x, y + 1)]
+        if grid[y][x] == main.CELL_TUNNEL:
+            neighbors.append((width - 1 - x, y))
+        for cell in neighbors:
+            if cell in passable and cell not in seen:
+                seen.add(cell)
+                queue.append(cell)
+    assert seen == passable
+
+    assert sum(row.count(main.CELL_SPAWN) for row in grid) == 4
+    assert grid[1][1] != main.CELL_SPAWN
+
+
+@pytest.mark.parametrize("size", [(9, 9), (30, 22)])
+def test_generate_maze_places_requested_spawns_or_raises(size):
+    grid = main.generate_maze(*size, seed=5, enemy_count=12)
+    assert sum(row.count(main.CELL_SPAWN) for row in grid) == 12
+    with pytest.raises(ValueError):
+        main.generate_maze(*size, seed=5, enemy_count=size[0] * size[1])
+
+
+def test_ghost_count_comes_from_spawn_cells_or_stays_four(assets):
+    grid = main.generate_maze(21, 21, seed=3, enemy_count=7)
+    main.write_map_file("spawn7.txt", grid)
+    assert len(main.Map("spawn7.txt").enemy_start_positions) == 7
+
+    # 家の入り口(CELL_ENEMY)しかないマップは、入り口がいくつあっても4体
+    house = [[main.CELL_ENEMY if code == main.CELL_SPAWN else code for code in row] for row in grid]
+    house[1] = [main.CELL_ENEMY if code == main.CELL_DOT and x % 2 else code for x, code in enumerate(house[1])]
+    main.write_map_file("house.txt", house)
+    env = main.PacmanEnv("house.txt")
+    env.reset(seed=1)
+    assert len(main.Enemy.enemies_group) == main.ENEMY_COUNT
+
+
+def test_batched_search_matches_single_searches(assets):
+    map_data = main.Map("maze.txt")
+    goal = map_data.path_cells[len(map_data.path_cells) // 2]
+    starts = map_data.path_cells[::17]
+    batched = map_data.find_paths(starts, goal)
+    assert batched == [map_data.find_paths([start], goal)[0] for start in starts]
+    for start, path in zip(starts, batched):
+        if start != goal:
+            assert path[0] == start and path[-1] == goal
+            assert all(b in map_data.get_neighbors(a) for a, b in zip(path, path[1:]))
+
+
+def test_eaten_pause_holds_actors_without_blocking(assets):
+    env = main.PacmanEnv("maze.txt")
+    env.reset(seed=1)
+    map_data, player, score, baits, enemies, _ = env.level
+    ghost = main.Enemy.enemies_group[0]
+    ghost.mode = main.EnemyMode.WEAK
+    ghost.get_eaten()
+    positions = [tuple(player.pos)] + [tuple(enemy.pos) for enemy in enemies]
+    paused = 0
+    while True:
+        env.step(2)
+        if not ghost.eaten_after:
+            break
+        paused += 1
+        assert [tuple(player.pos)] + [tuple(enemy.pos) for enemy in enemies] == positions
+    # ゲーム内時刻で eaten_pause 秒(ティック数)だけ止まり、その後は動き出す
+    assert paused == round(ghost.eaten_pause * 1000 / main.TICK_MS) - 1
+    assert tuple(player.pos) != positions[0]
+
+
+def test_pair_tunnels_prefers_rows_then_columns():
+    pairs = main.Map.pair_tunnels([(0, 3), (5, 0), (9, 3), (5, 9), (2, 2), (7, 7)])
+    assert pairs[(0, 3)] == (9, 3) and pairs[(9, 3)] == (0, 3)
+    assert pairs[(5, 0)] == (5, 9) and pairs[(5, 9)] == (5, 0)
+    assert pairs[(2, 2)] == (7, 7) and pairs[(7, 7)] == (2, 2)
+
+
+def test_paths_use_tunnels_and_distance_is_a_lower_bound(assets):
+    map_data = main.Map("maze.txt")
+    left, right = sorted(map_data.tunnel_pairs)[:2]
+    assert map_data.tunnel_pairs[left] == right
+    # トンネルの隣同士は、盤面を横切らずにワープでつながる
+    start, goal = (left[0] + 1, left[1]), (right[0] - 1, right[1])
+    path = map_data.find_paths([start], goal)[0]
+    assert path == [start, left, right, goal]
+    assert map_data.distance(start, goal) == 3
+
+    cells = map_data.path_cells
+    for goal in cells[::29]:
+        for start, path in zip(cells[::13], map_data.find_paths(cells[::13], goal)):
+            assert map_data.distance(start, goal) <= max(0, len(path) - 1)
+
+
+def test_dirty_regions_restore_only_what_was_drawn():
+    background = pg.Surface((40, 30))
+    background.fill((0, 0, 255))
+    screen = pg.Surface((40, 30))
+    dirty = main.DirtyRegions(background)
+
+    dirty.clear(screen)  # 最初は背景全体
+    assert screen.get_at((39, 29))[:3] == (0, 0, 255)
+    dirty.flush(update_display=False)
+    assert not dirty.full_update and dirty.dirty == []
+
+    dirty.add([screen.fill((255, 0, 0), (5, 5, 4, 4))])
+    screen.fill((0, 255, 0), (20, 20, 2, 2))  # 登録しない描画は消されない
+    dirty.flush(update_display=False)
+    dirty.clear(screen)
+    assert screen.get_at((6, 6))[:3] == (0, 0, 255)
+    assert screen.get_at((20, 20))[:3] == (0, 255, 0)
+    assert dirty.dirty == [pg.Rect(5, 5, 4, 4)] and dirty.drawn == []
+
+    # 背景の書き換え(食べられたエサ)は、背景と画面の両方に残る
+    dirty.update_background(screen, pg.Rect(0, 0, 2, 2), (9, 9, 9))
+    assert background.get_at((1, 1))[:3] == screen.get_at((1, 1))[:3] == (9, 9, 9)
+    assert pg.Rect(0, 0, 2, 2) in dirty.dirty
+
+
+class Eater:
+    def __init__(self, cell: tuple[int, int]) -> None:
+        self.rect = pg.Rect(0, 0, main.PLAYER_SIZE, main.PLAYER_SIZE)
+        self.rect.center = main.get_pixel_pos(*cell)
+
+
+def test_items_share_images_and_only_cells_under_the_player_are_eaten():
+    pg.display.init()
+    score = main.Score()
+    group = main.ItemGroup(score, 5, 5)
+    for x in range(5):
+        group.add(main.Item((x, 2), 1 if x != 4 else 2))
+    assert not hasattr(main.Item((0, 0), 1), "__dict__")
+    items = list(group)
+    assert items[0].image is items[1].image and items[0].image is not items[4].image
+
+    eaten = group.update(Eater((1, 2)))
+    assert [item.grid_pos for item in eaten] == [(1, 2)]
+    assert score.value == 20 and len(group) == 4
+    assert group.get_state()[2 * 5 + 1] == 0
+    assert group.update(Eater((1, 2))) == []
+    assert group.update(Eater((3, 0))) == []
+
+
+def test_preloaded_assets_are_taken_once_and_match_direct_loads(assets):
+    pg.display.init()
+    pg.display.set_mode((1, 1))
+    main._image_cache.clear()
+    main.write_map_file("preload.txt", main.generate_maze(15, 15, seed=11))
+    main.preload_assets(["preload.txt"])
+    path, size = main.PRELOAD_IMAGES[0]
+    image = main.load_image(path, size)
+    assert image.get_size() == size
+    assert main.load_image(path, size) is image
+    assert ("image", path, size) not in main._preload_futures
+
+    map_data = main.load_map("preload.txt")
+    assert main.load_map("preload.txt") is map_data
+    assert map_data.map_data == main.Map("preload.txt").map_data
+    assert ("map", "preload.txt") not in main._preload_futures
+
+
+def test_resize_while_waiting_keeps_the_game_frame_under_the_prompt():
+    pg.display.init()
+    screen = pg.display.set_mode((main.WIDTH, main.HEIGHT))
+    view = main.View()
+    screen.fill((0, 0, 200))  # 止めたときのゲーム画面
+    canvas = pg.Surface((main.WIDTH, main.HEIGHT), pg.SRCALPHA)
+    pg.draw.rect(canvas, (255, 0, 0, 255), (0, 0, 10, 10))
+    view.present(screen, canvas)
+
+    view.resize((main.WIDTH * 2, main.HEIGHT * 2))
+    screen = pg.Surface(view.size)
+    view.redraw(screen)
+    assert screen.get_at((5, 5))[:3] == (255, 0, 0)
+    assert screen.get_at((main.WIDTH, main.HEIGHT))[:3] == (0, 0, 200)
+    assert screen.get_at((main.WIDTH * 2 - 1, main.HEIGHT * 2 - 1))[:3] == (0, 0, 200)
+
+    # 不透明な静止画面では、下の画面は覚えない
+    view.present(screen, pg.Surface((main.WIDTH, main.HEIGHT)))
+    assert view.backdrop is None
+
+
+def test_web_build_ships_the_atlas_instead_of_loose_images(assets, monkeypatch):
+    pg.display.init()
+    pg.display.set_mode((1, 1))
+    out = assets / "web"
+    main.build_web(str(out), ["maze.txt"])
+    files = {os.path.relpath(os.path.join(d, f), out) for d, _, names in os.walk(out) for f in names}
+    assert files == {"main.py", "maze.txt", main.ATLAS_IMAGE, main.ATLAS_INDEX}
+    with pytest.raises(FileExistsError):
+        main.build_web(str(out), ["maze.txt"])
+
+    # ビルドしたフォルダでは、スプライトはアトラスから切り出す
+    monkeypatch.chdir(out)
+    monkeypatch.setattr(main, "_atlas", None)
+    for path, _ in main.PRELOAD_IMAGES:
+        image = main.load_source_image(path)
+        assert image.get_parent() is main._atlas[0]
+        expected = pg.image.load(str(assets / path))
+        assert image.get_size() == expected.get_size()
+        assert pg.image.tobytes(image, "RGBA") == pg.image.tobytes(expected.convert_alpha(), "RGBA")
+
+
+def test_input_queue_keeps_event_order():
+    pg.display.init()
+    pg.event.clear()
+    queue = main.InputQueue()
+    for event_type, key in [(pg.KEYDOWN, pg.K_LEFT), (pg.KEYDOWN, pg.K_UP), (pg.KEYUP, pg.K_LEFT),
+                            (pg.KEYDOWN, pg.K_p), (pg.KEYUP, pg.K_UP)]:
+        pg.event.post(pg.event.Event(event_type, key=key))
+    queue.pump()
+
+    assert queue.pause
+    events = queue.events
+    assert [(event_type, key) for _, event_type, key in events] == [
+        (pg.KEYDOWN, pg.K_LEFT), (pg.KEYDOWN, pg.K_UP), (pg.KEYUP, pg.K_LEFT), (pg.KEYUP, pg.K_UP)
+    ]
+    # 時刻は取り出した時刻(精度は1フレーム)
+    stamp = events[0][0]
+    assert all(timestamp == stamp for timestamp, _, _ in events)
+    assert queue.pop_until(stamp - 1) == []
+    assert len(queue.pop_until(stamp)) == 4
+    assert not queue.events
+
+
+
+def test_short_tap_is_queued_until_the_next_corner(assets):
+    env = main.PacmanEnv("maze.txt")
+    env.reset(seed=1)
+    player = env.level[1]
+    player.handle_input(pg.K_UP, True)
+    player.handle_input(pg.K_UP, False)
+    assert player.queued_direction == main.DIRECTION_KEYS[pg.K_UP]
+    assert player.held_directions == []
+
+    # 押したままの別のキーがあれば、離したときにそちらを予約し直す
+    player.handle_input(pg.K_LEFT, True)
+    player.handle_input(pg.K_DOWN, True)
+    player.handle_input(pg.K_DOWN, False)
+    assert player.queued_direction == main.DIRECTION_KEYS[pg.K_LEFT]
+
+
+def test_env_runs_are_deterministic_and_report_info(assets):
+    def run(env):
+        observation, info = env.reset(seed=4)
+        trace = [(observation.tobytes(), info)]
+        for i in range(120):
+            observation, reward, terminated, truncated, info = env.step((i // 10) % 5)
+            trace.append((observation.tobytes(), reward, terminated, truncated, info))
+        return trace
+
+    env = main.PacmanEnv("maze.txt", max_steps=120)
+    first = run(env)
+    assert run(env) == first  # 同じ環境の reset でも
+    assert run(main.PacmanEnv("maze.txt", max_steps=120)) == first  # 作り直した環境でも同じ
+
+    dots = sum(code in (main.CELL_DOT, main.CELL_POWER) for row in env.level[0].map_data for code in row)
+    assert first[0][1] == {"score": 0, "lives": 3, "dots_left": dots, "steps": 0}
+    assert first[-1][-1]["dots_left"] == len(env.level[3]) < dots
+    assert [entry[-1]["steps"] for entry in first[1:]] == list(range(1, 121))
+    assert [entry[3] for entry in first[1:]] == [False] * 119 + [True]
+    assert sum(entry[1] for entry in first[1:]) == first[-1][-1]["score"] > 0
+
+
+def test_env_observations_are_views_of_the_internal_buffers(assets):
+    np = pytest.importorskip("numpy")
+    env = main.PacmanEnv("maze.txt", observation="pixels")
+    observation, _ = env.reset(seed=2)
+    assert observation.shape == (main.HEIGHT, main.WIDTH, 3)
+    assert np.shares_memory(observation, env.frame)
+    assert env.step(1)[0] is observation
+
+    # 描画先を外部のバッファに移しても、今の画面を引き継いでそのメモリに描く
+    before = observation.copy()
+    buffer = bytearray(main.HEIGHT * main.WIDTH * 4)
+    env.use_buffer(buffer)
+    assert np.array_equal(env.get_observation(), before)
+    env.step(1)
+    assert np.shares_memory(env.get_observation(), np.frombuffer(buffer, np.uint8))
+    assert bytes(buffer) == env.frame.tobytes()
+
+
+@pytest.mark.parametrize("observation", ["grid", "pixels"])
+def test_snapshot_restore_replays_exactly(assets, observation):
+    env = main.PacmanEnv("maze.txt", observation=observation)
+    env.reset(seed=3)
+    for i in range(150):
+        env.step((i // 12) % 5)
+    state = env.snapshot()
+    start = env.get_observation().copy()
+
+    def play():
+        frames = []
+        for i in range(300):
+            observation, reward, terminated, truncated, info = env.step((i // 9 + 1) % 5)
+            frames.append((observation.tobytes(), reward, info))
+            if terminated:
+                break
+        return frames
+
+    expected = play()
+    assert (env.restore(state) == start).all()
+    assert play() == expected
+
+
+
+def test_item_state_restores_only_changed_cells():
+    pg.display.init()
+    width, height = 70, 9  # ブロックの境目をまたぐ大きさ
+    group = main.ItemGroup(main.Score(), width, height)
+    for y in range(height):
+        for x in range(width):
+            group.add(main.Item((x, y), 1))
+    full = group.get_state()
+    rng = random.Random(0)
+    for _ in range(20):
+        state = bytes(rng.random() < 0.9 for _ in range(width * height))
+        expected = [i for i in range(width * height) if state[i] != group.get_state()[i]]
+        assert group.changed_cells(state) == expected
+        group.set_state(state)
+        assert group.get_state() == state
+        assert sorted(y * width + x for x, y in group.items) == [i for i in range(width * height) if state[i]]
+    assert group.changed_cells(group.get_state()) == []
+    group.set_state(full)
+    assert len(group) == width * height
+
+
+def test_allocation_tracker_separates_held_and_transient_allocations():
+    tracker = main.AllocationTracker(enabled=True, sample_every=1, report_every=1000, tick_phases=("hold",))
+    held = []
+    try:
+        for _ in range(5):
+            with tracker.phase("hold"):
+                held.append([object() for _ in range(200)])
+            with tracker.phase("temp"):
+                sum(len(str(i)) for i in range(2000))
+            tracker.end_frame(ticks=2)
+        report = tracker.report()
+    finally:
+        tracemalloc.stop()
+        gc.callbacks.remove(tracker.on_gc)
+
+    hold, temp = tracker.phases["hold"], tracker.phases["temp"]
+    assert hold["net"] > 0 and hold["blocks"] >= 5 * 200
+    assert abs(temp["blocks"]) < 50 and temp["transient"] > 0
+    # 呼び出し箇所はフェーズの終わりに残っていたものだけ
+    assert any(phase == "hold" for phase, _ in tracker.sites)
+    assert not any(phase == "temp" and count >= 100 for (phase, _), (count, _) in tracker.sites.items())
+    assert "blocks/tick" in report and "blocks/frame" in report and "held" in report
+    assert "gc objects" not in report
+
+
+class Mover(main.GridMover):
+    def __init__(self) -> None:
+        self.rect = pg.Rect(0, 0, main.GRID_SIZE, main.GRID_SIZE)
+
+
+def test_grid_mover_accumulates_sub_pixel_steps_exactly():
+    mover = Mover()
+    mover.place((10, 10))
+    speed = main.SUBPIXEL * 2 // 3  # 1ティックに 2/3 ピクセル
+    ticks = 0
+    while not mover.step_towards((30, 10), speed):
+        ticks += 1
+        assert mover.pos[0] == (10 * main.SUBPIXEL + ticks * speed)
+        assert mover.rect.center == (mover.pos[0] // main.SUBPIXEL, 10)
+    assert ticks == -(-20 * main.SUBPIXEL // speed) - 1
+    assert mover.pos == [30 * main.SUBPIXEL, 10 * main.SUBPIXEL]
+    assert mover.rect.center == (30, 10)
+
+
+def test_grid_mover_moves_x_first_then_y_with_the_rest():
+    mover = Mover()
+    mover.place((10, 10))
+    assert not mover.step_towards((11, 20), 3 * main.SUBPIXEL)
+    assert mover.pos == [11 * main.SUBPIXEL, 12 * main.SUBPIXEL]
+
+    # 負の向きも同じ整数の加減算で、目標までの距離が speed 以下なら揃える
+    assert not mover.step_towards((5, 12), main.SUBPIXEL * 5 // 2)
+    assert mover.pos == [11 * main.SUBPIXEL - main.SUBPIXEL * 5 // 2, 12 * main.SUBPIXEL]
+    assert mover.rect.center == (8, 12)
+    assert not mover.step_towards((5, 12), main.SUBPIXEL * 5 // 2)
+    assert mover.step_towards((5, 12), main.SUBPIXEL * 5 // 2)
+    assert mover.pos == [5 * main.SUBPIXEL, 12 * main.SUBPIXEL]
+
+
+def test_level_loader_creates_surfaces_and_fonts_only_on_the_main_thread(assets, monkeypatch):
+    pg.display.init()
+    pg.display.set_mode((main.WIDTH, main.HEIGHT))
+    pg.font.init()
+    main.view.resize((main.WIDTH, main.HEIGHT))
+    threads = []
+
+    class Surface(pg.Surface):
+        def __init__(self, *args, **kwargs):
+            threads.append(threading.current_thread())
+            super().__init__(*args, **kwargs)
+
+    class Font(pg.font.Font):
+        def __init__(self, *args, **kwargs):
+            threads.append(threading.current_thread())
+            super().__init__(*args, **kwargs)
+
+    monkeypatch.setattr(pg, "Surface", Surface)
+    monkeypatch.setattr(pg.font, "Font", Font)
+    monkeypatch.setattr(main.Item, "images", {})
+    main.view.resize((main.WIDTH + 1, main.HEIGHT))  # フォントのキャッシュを捨てる
+    main.write_map_file("loader.txt", main.generate_maze(17, 17, seed=2))
+
+    loader = main.LevelLoader()
+    loader.prepare("loader.txt")
+    map_data, score, baits = loader.pending["loader.txt"].result()
+    assert threads == [] and not hasattr(score, "font") and len(baits) > 0
+
+    level, background = loader.take("loader.txt")
+    assert level[0] is map_data and level[2] is score and level[3] is baits
+    assert background.get_size() == main.view.size
+    level[2].draw(background)
+    assert threads and set(threads) == {threading.main_thread()}
+    main.view.resize((main.WIDTH, main.HEIGHT))
+
+
+def test_dot_images_are_kept_only_for_the_current_scale(monkeypatch):
+    pg.display.init()
+    monkeypatch.setattr(main.Item, "images", {})
+    base = main.Item.get_image(1)
+    for scale in (1.5, 2, 2.5, 3):
+        for item_type in main.Item.radius:
+            image = main.Item.get_image(item_type, scale)
+            assert image.get_width() == round(main.GRID_SIZE * scale)
+        assert set(main.Item.images) == {(1, 1)} | {(item_type, scale) for item_type in main.Item.radius}
+    assert main.Item.get_image(1) is base
+    assert main.Item.get_image(2, 3) is main.Item.images[(2, 3)]
+
+
+def test_scheduler_runs_due_timers_in_time_then_registration_order():
+    scheduler = main.Scheduler()
+    calls = []
+    scheduler.schedule_at(2.0, lambda: calls.append("late"))
+    scheduler.schedule_at(1.0, lambda: calls.append("first"))
+    cancelled = scheduler.schedule_at(1.0, lambda: calls.append("cancelled"))
+    scheduler.schedule_at(1.0, lambda: calls.append("second"))
+    cancelled.cancel()
+
+    scheduler.run_due(1.5)
+    assert calls == ["first", "second"]
+    scheduler.run_due(2.0)
+    assert calls == ["first", "second", "late"]
+    assert scheduler.queue == []
+
+
+def test_scheduler_state_keeps_remaining_time():
+    scheduler = main.Scheduler()
+    calls = []
+    scheduler.schedule_at(3.0, lambda: calls.append("a"))
+    state = scheduler.get_state(1.0)
+    scheduler.run_due(5.0)
+    assert calls == ["a"]
+
+    # 残り2秒の予定として、別の時刻に戻す
+    scheduler.set_state(state, 10.0)
+    scheduler.run_due(11.9)
+    assert calls == ["a"]
+    scheduler.run_due(12.0)
+    assert calls == ["a", "a"]
+
+
+def test_paused_clock_holds_timers(monkeypatch):
+    clock = main.GameClock()
+    wall = [100.0]
+    monkeypatch.setattr(main.time, "monotonic", lambda: wall[0])
+    scheduler = main.Scheduler()
+    calls = []
+    scheduler.schedule_at(clock.now() + 1.0, lambda: calls.append("a"))
+
+    clock.pause()
+    wall[0] += 5.0  # 止めている間の実時間は数えない
+    scheduler.run_due(clock.now())
+    assert calls == [] and clock.now() == 100.0
+    clock.resume()
+    wall[0] += 0.5
+    scheduler.run_due(clock.now())
+    assert calls == []
+    wall[0] += 0.5
+    scheduler.run_due(clock.now())
+    assert calls == ["a"]
+
+
+def test_level_reset_in_place_matches_a_fresh_level(assets):
+    def play(env):
+        observation, _ = env.reset(seed=6)
+        trace = [observation.tobytes()]
+        for i in range(400):
+            observation, reward, terminated, truncated, info = env.step((i // 7) % 5)
+            trace.append((observation.tobytes(), info))
+        return trace
+
+    env = main.PacmanEnv("maze.txt", observation="pixels")
+    first = play(env)
+    map_data, player, score, baits, enemies, debug_info = env.level
+    items = dict(baits.all_items)
+    images = [enemy.normal_image_base for enemy in enemies]
+    assert len(baits) < len(items)
+
+    # やり直しでは同じオブジェクトを開始時の状態に戻して使い、背景のエサも描き戻す
+    assert play(env) == first
+    assert env.level[0] is map_data and env.level[1] is player and env.level[3] is baits
+    assert baits.all_items == items and all(baits.all_items[pos] is item for pos, item in items.items())
+    assert [enemy.normal_image_base for enemy in env.level[4]] == images
+    assert main.Enemy.enemies_group == list(enemies)
+
+    assert play(main.PacmanEnv("maze.txt", observation="pixels")) == first
+
+
+class Ghost:
+    def __init__(self, enemy_id: int) -> None:
+        self.enemy_id = enemy_id
+        self.plan_id = 0
+        self.planning = False
+        self.received = []
+
+    def receive_path(self, path: list) -> None:
+        self.planning = False
+        self.received.append(path)
+
+
+def test_planner_carries_late_results_over_and_keeps_request_order(assets, monkeypatch):
+    map_data = main.Map("maze.txt")
+    cells = map_data.path_cells
+    release = threading.Event()
+    find_paths = main.path_cache.find_paths
+
+    def slow_find_paths(*args):
+        release.wait(5)
+        return find_paths(*args)
+
+    monkeypatch.setattr(main.path_cache, "find_paths", slow_find_paths)
+    planner = main.PathPlanner(threaded=True, wait_budget=0.01)
+    first, second, stale = Ghost(1), Ghost(2), Ghost(3)
+    try:
+        planner.request(map_data, [first], [cells[0]], cells[-1])
+        planner.request(map_data, [second, stale], [cells[5], cells[9]], cells[-5])
+        assert first.planning and second.planning
+
+        # 間に合わない探索は待ち続けずに次のティックへ回し、敵は今の経路のまま
+        planner.collect()
+        assert first.received == second.received == [] and first.planning
+        assert [order[1] for order in planner.get_state()] == [cells[-1], cells[-5]]
+
+        stale.plan_id += 1  # 依頼後にリセットされた敵の結果は捨てる
+        release.set()
+        planner.collect()
+        assert first.received == map_data.find_paths([cells[0]], cells[-1])
+        assert second.received == map_data.find_paths([cells[5]], cells[-5])
+        assert stale.received == [] and planner.jobs == []
+    finally:
+        release.set()
+        planner.executor.shutdown()
+
+
+def test_planner_without_budget_waits_for_the_result(assets):
+    map_data = main.Map("maze.txt")
+    cells = map_data.path_cells
+    ghost = Ghost(1)
+    threaded = main.PathPlanner(threaded=True, wait_budget=None)
+    inline = main.PathPlanner(threaded=False)
+    try:
+        threaded.request(map_data, [ghost], [cells[0]], cells[-1])
+        inline.request(map_data, [ghost], [cells[0]], cells[-1])
+        threaded.collect()
+        inline.collect()
+        assert len(ghost.received) == 2 and ghost.received[0] == ghost.received[1]
+    finally:
+        threaded.executor.shutdown()
+
+
+def test_path_stats_split_group_searches_and_count_failures():
+    stats = main.PathStats()
+    path = [(1, 1), (2, 1), (3, 1)]
+    stats.record_search([1, 2, 3], [(1, 1), (3, 1), (5, 5)], (3, 1), [path, [(3, 1)], []], [40, 55, 2])
+    total = stats.get()
+    assert total["searches"] == 1 and total["expanded"] == 40 and total["pushes"] == 55
+    assert total["path_length"] == 2 and total["failures"] == 1  # 目標にいる敵は失敗に数えない
+    assert [stats.get(enemy_id)["searches"] for enemy_id in (1, 2, 3)] == [1, 1, 1]
+    assert [stats.get(enemy_id)["failures"] for enemy_id in (1, 2, 3)] == [0, 0, 1]
+    assert sum(stats.get(enemy_id)["cache_hits"] for enemy_id in (1, 2, 3)) == total["cache_hits"] == 2
+    stats.get(1)["searches"] = 99  # コピーを返す
+    assert stats.get(1)["searches"] == 1
+
+
+def test_path_stats_count_planning_in_game_and_dump_json(assets, tmp_path, monkeypatch):
+    env = main.PacmanEnv("maze.txt")
+    env.reset(seed=2)
+    main.path_stats.reset()
+    for i in range(600):
+        env.step((i // 15) % 5)
+    total = main.path_stats.get()
+    enemies = main.path_stats.as_dict()["enemies"]
+    assert total["searches"] > 0 and total["expanded"] > 0 and total["max_expanded"] > 0
+    assert set(enemies) <= {str(enemy.enemy_id) for enemy in env.level[4]}
+    for name in ("cache_hits", "path_length", "failures", "pincer", "random"):
+        assert sum(stats[name] for stats in enemies.values()) == total[name]
+
+    # 表示などで目標を見ただけでは数えない
+    for enemy in env.level[4]:
+        enemy.get_target_position()
+    assert main.path_stats.get() == total
+
+    dump_file = str(tmp_path / "stats.json")
+    stats = main.PathStats(dump_file, dump_every=5.0)
+    stats.record(2, "random", 3)
+    clock = [stats.last_dump + 4.9]
+    monkeypatch.setattr(main.time, "monotonic", lambda: clock[0])
+    stats.maybe_dump()
+    assert not os.path.exists(dump_file)
+    clock[0] += 0.1
+    stats.maybe_dump()
+    with open(dump_file) as f:
+        assert json.load(f) == stats.as_dict()
+    assert stats.as_dict()["enemies"]["2"]["random"] == stats.as_dict()["total"]["random"] == 3
+    assert os.listdir(tmp_path) == ["stats.json"]
+
+
+def test_path_cache_evicts_least_recently_used():
+    cache = main.PathCache(max_cells=10)
+    goal = (3, 0)
+    first = [(0, 0), (1, 0), (2, 0), (3, 0)]
+    second = [(3, 3), (3, 2), (3, 1), (3, 0)]
+    third = [(6, 0), (5, 0), (4, 0), (3, 0)]
+    cache.store(first[0], goal, first)
+    cache.store(second[0], goal, second)
+    assert cache.lookup((0, 0), goal) == first  # first を最近使ったことにする
+    cache.store(third[0], goal, third)
+
+    assert cache.size == 8
+    assert cache.lookup((3, 3), goal) is None
+    assert cache.lookup((3, 2), goal) is None
+    assert cache.lookup((6, 0), goal) == third
+    # 経路の途中からは、その後半を返す
+    assert cache.lookup((1, 0), goal) == first[1:]
+
+
+def test_path_cache_matches_fresh_search(assets):
+    map_data = main.Map("maze.txt")
+    cache = main.PathCache()
+    goal = map_data.path_cells[-1]
+    starts = map_data.path_cells[:40:3]
+    counts = [0, 0, 0]
+    first = cache.find_paths(map_data, starts, goal, counts)
+    assert first == map_data.find_paths(starts, goal)
+    assert cache.find_paths(map_data, starts, goal, counts) == first
+    assert counts[2] >= len(starts)
+
+
+def test_path_cache_serves_suffixes_after_the_goal_moves(assets):
+    map_data = main.Map("maze.txt")
+    cache = main.PathCache()
+    cells = map_data.path_cells
+    start = cells[0]
+    for goal in (cells[-1], cells[len(cells) // 2], cells[-1]):
+        counts = [0, 0, 0]
+        path = cache.find_paths(map_data, [start], goal, counts)[0]
+        assert path == map_data.find_paths([start], goal)[0] and path[-1] == goal
+
+        # 新しい目標への経路の途中からは、探索せずにその後半を返し、新しく探索した経路と一致する
+        middle = path[len(path) // 2:-1]
+        counts = [0, 0, 0]
+        assert cache.find_paths(map_data, middle, goal, counts) == map_data.find_paths(middle, goal)
+        assert counts == [0, 0, len(middle)]
+
+    # 前の目標の経路は、新しい目標の探索には使わない
+    other = cells[len(cells) // 3]
+    counts = [0, 0, 0]
+    assert cache.find_paths(map_data, [start], other, counts) == map_data.find_paths([start], other)
+    assert counts[2] == 0 and counts[0] > 0
+
+
+def test_unreachable_goals_snap_to_the_nearest_reachable_cell(assets):
+    grid = [
+        [1, 1, 1, 1, 1, 1, 1, 1, 1],
+        [1, 2, 2, 2, 1, 2, 2, 2, 1],
+        [1, 2, 1, 2, 1, 2, 1, 2, 1],
+        [1, 2, 2, 2, 1, 2, 2, 2, 1],
+        [1, 1, 1, 1, 1, 1, 1, 1, 1],
+    ]
+    main.write_map_file("islands.txt", grid)
+    map_data = main.Map("islands.txt")
+    start = (1, 1)
+    assert not map_data.reachable(start, (5, 1)) and map_data.reachable(start, (3, 3))
+
+    assert map_data.nearest_reachable(start, (3, 3)) == (3, 3)
+    assert map_data.nearest_reachable(start, (5, 1)) == (3, 1)  # 別の島
+    assert map_data.nearest_reachable(start, (4, 2)) == (3, 2)  # 壁
+    assert map_data.nearest_reachable(start, (-5, 3)) == (1, 3)  # 盤面の外
+    wall = map_data.nearest_reachable(start, (2, 2))
+    assert map_data.reachable(start, wall) and abs(wall[0] - 2) + abs(wall[1] - 2) == 1
+    assert map_data.nearest_reachable((0, 0), (5, 1)) == (5, 1)  # 壁からは何もしない
+
+    # 行けない目標は探索せずに空の経路を返す
+    counts = [0, 0]
+    assert map_data.find_paths([start], (5, 1), counts) == [[]]
+    assert counts[0] == 0
+    snapped = map_data.nearest_reachable(start, (5, 1))
+    assert map_data.find_paths([start], snapped)[0][-1] == snapped
+
+
+def frame_surface(size: tuple[int, int], depth: int, index: int) -> pg.Surface:
+    surface = pg.Surface(size, 0, depth)
+    for y in range(size[1]):
+        for x in range(size[0]):
+            surface.set_at((x, y), (x * 40 % 256, y * 60 % 256, index * 30 % 256))
+    return surface
+
+
+def test_recorder_writes_raw_segments_with_sidecars(tmp_path):
+    path = str(tmp_path / "play.raw")
+    recorder = main.FrameRecorder(path, "raw", every=2, block=True)
+    frames = [frame_surface((5, 3), 24, i) for i in range(5)]  # 行末に余白のある 24 ビット
+    assert frames[0].get_pitch() > 5 * 3
+    for surface in frames:
+        recorder.capture(surface)
+    for i in range(5, 7):
+        recorder.capture(frame_surface((4, 2), 32, i))  # 大きさが変わったら別のファイル
+    recorder.close()
+    assert recorder.frame == 7 and recorder.written == 4 and recorder.dropped == 0
+
+    for name, written, size in [(path, frames[0:5:2], (5, 3)), (str(tmp_path / "play-1.raw"), None, (4, 2))]:
+        with open(name + ".json") as f:
+            meta = json.load(f)
+        assert (meta["width"], meta["height"]) == size
+        with open(name, "rb") as f:
+            data = f.read()
+        channels = len(meta["pixel_format"])
+        assert meta["frames"] * size[0] * size[1] * channels == len(data)
+        if written is not None:
+            expected = b"".join(
+                bytes(surface.get_at((x, y))["RGB".index(c)] if c in "RGB" else 0 for c in meta["pixel_format"])
+                for surface in written for y in range(size[1]) for x in range(size[0])
+            )
+            assert data == expected
+
+
+def test_recorder_writes_numbered_pngs(tmp_path):
+    pg.display.init()
+    recorder = main.FrameRecorder(str(tmp_path / "frames"), "png", block=True)
+    frames = [frame_surface((6, 4), 32, i) for i in range(3)]
+    for surface in frames:
+        recorder.capture(surface)
+    recorder.close()
+    assert sorted(os.listdir(tmp_path / "frames")) == [f"frame_{i:06d}.png" for i in range(3)]
+    for i, surface in enumerate(frames):
+        image = pg.image.load(str(tmp_path / "frames" / f"frame_{i:06d}.png"))
+        assert all(image.get_at((x, y))[:3] == surface.get_at((x, y))[:3] for x in range(6) for y in range(4))
+
+
+def test_control_server_rejects_bad_lines(assets):
+    server = main.ControlServer(main.PacmanEnv("maze.txt"), "unused.sock")
+    assert server.handle_line(b"{bad\n")["ok"] is False
+    assert server.handle_line(b"[1, 2]\n") == {"ok": False, "error": "request must be a JSON object"}
+    assert server.handle_line(b"\xff\xfe\n")["ok"] is False
+    assert server.handle_line(b'{"cmd": "bogus"}\n') == {"ok": False, "error": "unknown command: bogus"}
+    assert server.handle_line(b'{"cmd": "step", "action": 0}\n') == {"ok": False, "error": "reset has not been called"}
+    assert server.handle_line(b'{"cmd": "reset"}\n')["ok"] is True
+    assert server.handle_line(b'{"cmd": "step", "action": "left"}\n')["ok"] is False
+
+    # 範囲外の行動(負の値を含む)は進めずに断る
+    for action in (-1, -5, 5):
+        reply = server.handle_line(b'{"cmd": "step", "action": %d}\n' % action)
+        assert reply == {"ok": False, "error": f"action must be 0..4, got {action}"}
+        with pytest.raises(ValueError):
+            server.env.step(action)
+    assert server.env.get_info()["steps"] == 0
+    assert server.handle_line(b'{"cmd": "step", "action": 4}\n')["info"]["steps"] == 1
+    server.release()
+
+
+def test_control_server_survives_broken_clients(assets):
+    path = os.path.join(tempfile.mkdtemp(), "pacman.sock")
+    server = main.ControlServer(main.PacmanEnv("maze.txt"), path)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    while not os.path.exists(path):
+        thread.join(0.01)
+
+    # 不正な行を送ったあと、応答を読まずに切断する
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as broken:
+        broken.connect(path)
+        broken.sendall(b"not json\n[]\n" + b'{"cmd": "reset"}\n' + b'{"cmd": "step", "action": 1}\n' * 200)
+
+    # 同じプロセスで共有メモリを開くと resource_tracker の登録が重なるため、ControlClient は使わない
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client, client.makefile('rwb') as stream:
+        client.connect(path)
+        replies = []
+        for request in (b'{"cmd": "reset", "seed": 1}', b'{"cmd": "step", "action": 2}', b'{"cmd": "close"}'):
+            stream.write(request + b"\n")
+            stream.flush()
+            replies.append(json.loads(stream.readline()))
+    assert [reply["ok"] for reply in replies] == [True, True, True]
+    assert replies[0]["info"]["steps"] == 0
+    assert replies[1]["info"]["steps"] == 1
+    thread.join(5)
+    assert not thread.is_alive()
+    assert not os.path.exists(path)
+
+
+def test_sprites_can_touch_only_within_two_cells_per_axis():
+    reach = set()
+    for player_x in range(main.GRID_SIZE):
+        player = pg.Rect(0, 0, main.PLAYER_SIZE, main.PLAYER_SIZE)
+        player.center = (player_x, 0)
+        for enemy_x in range(-5 * main.GRID_SIZE, 5 * main.GRID_SIZE):
+            enemy = pg.Rect(0, 0, main.ENEMY_SIZE, main.ENEMY_SIZE)
+            enemy.center = (enemy_x, 0)
+            if player.colliderect(enemy):
+                reach.add(abs(enemy_x // main.GRID_SIZE))
+    # 各軸2マスまで重なりうる(マンハッタン距離4で衝突しうる)ので、見逃さないのは距離5以上から
+    assert reach == {0, 1, 2}
+
+
+def test_env_without_lod_does_not_change_other_games(assets):
+    env = main.PacmanEnv("maze.txt", lod=False)
+    env.reset(seed=1)
+    enemies = list(env.level[4])
+    assert main.Enemy.lod_max_interval == 8
+    assert all(enemy.lod_max_interval == 1 for enemy in enemies)
+    for i in range(200):
+        env.step((i // 10) % 5)
+        assert all(enemy.lod_wait == 0 for enemy in enemies)
+    env.reset(seed=1)
+    assert all(enemy.lod_max_interval == 1 for enemy in env.level[4])
+
+    other = main.PacmanEnv("maze.txt")
+    other.reset(seed=1)
+    assert all(enemy.lod_max_interval == 8 for enemy in other.level[4])
+    far = max(other.level[4], key=lambda enemy: other.level[0].distance(enemy.get_grid_pos(), other.level[1].get_grid_pos()))
+    distance = other.level[0].distance(far.get_grid_pos(), other.level[1].get_grid_pos())
+    assert (far.get_lod_interval() > 1) == (distance >= 7)
+
+
+def test_map_cache_round_trip(assets):
+    cache_file = "maze.txt" + main.MAP_CACHE_SUFFIX
+    if os.path.exists(cache_file):
+        os.remove(cache_file)
+    built = main.Map("maze.txt")
+    assert os.path.exists(cache_file)
+    cached = main.Map("maze.txt")
+    for name in ("map_data", "width", "height", "dots_remaining", "enemy_start_positions", "tunnel_pairs", "path_cells"):
+        assert getattr(cached, name) == getattr(built, name)
+    for name in ("flags", "component", "tunnel_distance"):
+        assert bytes(getattr(cached, name)) == bytes(getattr(built, name))
+    with open("maze.txt", 'rb') as f:
+        key = main.map_cache_key(f.read())
+    assert main.read_map_cache(cache_file, key) is not None
+    assert main.read_map_cache(cache_file, "0" * 64) is None
+
+
+@pytest.mark.parametrize("damage", ["truncate", "extend", "garbage"])
+def test_map_cache_rejects_damaged_files(assets, damage):
+    cache_file = "maze.txt" + main.MAP_CACHE_SUFFIX
+    expected = main.Map("maze.txt")
+    map_data, flags = expected.map_data, bytes(expected.flags)
+    with open(cache_file, 'rb') as f:
+        data = f.read()
+    damaged = {"truncate": data[:-7], "extend": data + b"\0", "garbage": b"PACMAP01" + b"\xff" * 40}[damage]
+    # expected がメモリマップしているファイルは書き換えず、別のファイルに置き換える
+    with open(cache_file + ".tmp", 'wb') as f:
+        f.write(damaged)
+    os.replace(cache_file + ".tmp", cache_file)
+    assert main.read_map_cache(cache_file, expected.key) is None
+
+    # 壊れたキャッシュは作り直される
+    rebuilt = main.Map("maze.txt")
+    assert rebuilt.map_data == map_data
+    assert bytes(rebuilt.flags) == flags
+    with open(cache_file, 'rb') as f:
+        assert f.read() == data
+
+
+def test_regenerated_map_with_the_same_name_is_reloaded(assets):
+    main.write_map_file("regen.txt", main.generate_maze(15, 15, seed=1))
+    first = main.load_map("regen.txt")
+    assert main.load_map("regen.txt") is first
+
+    main.write_map_file("regen.txt", main.generate_maze(17, 13, seed=2))
+    second = main.load_map("regen.txt")
+    assert second is not first and (second.width, second.height) == (17, 13)
+    assert second.map_data == main.Map("regen.txt").map_data
+    assert main.load_map("regen.txt") is second
+    assert first.width == 15 and first.flags[0] == 0  # 前の Map は使っているレベルのためにそのまま使える
+
+
+def test_closing_a_map_releases_its_memory_map(assets):
+    main.write_map_file("closing.txt", main.generate_maze(15, 15, seed=3))
+    main.Map("closing.txt")  # キャッシュファイルを作る
+    map_data = main.Map("closing.txt")
+    mapped = map_data.flags.obj
+    assert isinstance(mapped, main.mmap.mmap) and not mapped.closed
+    map_data.close()
+    assert mapped.closed and map_data.arrays == {}
+    with pytest.raises(ValueError):
+        map_data.flags[0]
+    map_data.close()  # 2回目は何もしない